@@ -0,0 +1,544 @@
+# Copyright (c) 2008 ActiveState Software Inc.
+
+r"""An asynchronous variant of `simpleflickrapi.SimpleFlickrAPI`.
+
+All calls and downloads are made from a single thread on an event loop,
+so thousands of requests can be in flight without a thread per request.
+This is built on the standard library's asyncore/asynchat modules.
+
+Usage:
+    api = AsyncSimpleFlickrAPI(api_key, secret)
+    api.get_auth_token("read")
+    calls = [api.photos_getInfo(photo_id=id) for id in ids]
+    for call in calls:
+        info = call.result()[0]   # runs the event loop as necessary
+        ...
+
+Each API method returns an `AsyncCall`. Use `.add_callback()` to be
+called back when it completes, or `.result()` (or `api.run()`) to run
+the event loop until it does.
+"""
+
+import os
+from os.path import exists
+import sys
+import socket
+import asyncore
+import asynchat
+import urlparse
+import httplib
+import mimetools
+import heapq
+import time
+import logging
+from cStringIO import StringIO
+
+from picslib.simpleflickrapi import SimpleFlickrAPI, FlickrAPIError, \
+    FlickrHTTPError
+
+
+
+log = logging.getLogger("pics")
+
+
+
+class AsyncCall(object):
+    """A pending API call or download."""
+    def __init__(self, api):
+        self.api = api
+        self.done = False
+        self._value = None
+        self._exc_info = None
+        self._callbacks = []
+        api._pending.add(self)
+
+    def add_callback(self, callback):
+        """Call `callback(<this AsyncCall>)` when the call completes."""
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self):
+        """Return the call's result (or raise its error), running the
+        event loop until it is done.
+        """
+        if not self.done:
+            self.api.run([self])
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def _set_result(self, value):
+        self._value = value
+        self._finish()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self.done = True
+        self.api._pending.discard(self)
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                log.exception("error in AsyncCall callback")
+
+
+class AsyncSimpleFlickrAPI(SimpleFlickrAPI):
+    """A SimpleFlickrAPI whose calls return `AsyncCall`s.
+
+    The same dotted-method `__getattr__` dispatch, signing and response
+    handling as `SimpleFlickrAPI` is used, e.g.:
+        call = api.photos_getInfo(photo_id=id)
+
+    @param api_key {str} Your Flickr API key.
+    @param secret {str} The shared secret for that key.
+    @param max_connections {int} Max number of concurrent connections
+        per host. Default 8.
+    @param rate_limiter {TokenBucket} The rate limiter for API calls.
+        By default the process-wide `default_rate_limiter` is used.
+    """
+    # Max number of redirects followed by `.download()`.
+    max_redirects = 5
+
+    def __init__(self, api_key=None, secret=None, max_connections=8,
+                 rate_limiter=None):
+        SimpleFlickrAPI.__init__(self, api_key, secret,
+                                 rate_limiter=rate_limiter)
+        self._map = {}
+        self._timers = []
+        self._pending = set()
+        self.http_pool = AsyncHTTPPool(self._map, max_connections)
+
+    def get_auth_token(self, perms="read", exact_perms=True):
+        """Get an authorization token. See
+        `simpleflickrapi.AuthTokenMixin.get_auth_token`.
+
+        This blocks: it is only needed once, before making calls.
+        """
+        api = SimpleFlickrAPI(self.api_key, self.secret,
+                              rate_limiter=self.rate_limiter)
+        api.rest_url = self.rest_url
+        self.auth_token = api.get_auth_token(perms, exact_perms)
+        return self.auth_token
+
+    def call(self, method_name_, response_format_=None,
+             raise_on_api_error_=None, **args):
+        """Call a Flickr API method with signing.
+
+        @returns {AsyncCall} whose result is the handled response.
+        """
+        post_data = self._post_data(method_name_, args)
+        return self._call_async(method_name_, post_data, response_format_,
+                                raise_on_api_error_)
+
+    def unsigned_call(self, method_name_, response_format_=None,
+                      raise_on_api_error_=None, **args):
+        """Call a Flickr API method without signing.
+
+        @returns {AsyncCall} whose result is the handled response.
+        """
+        post_data = self._post_data(method_name_, args, sign=False)
+        return self._call_async(method_name_, post_data, response_format_,
+                                raise_on_api_error_)
+
+    def paging_call(self, method_name_, response_format_=None,
+                    raise_on_api_error_=None, **args):
+        """Call a paging Flickr API method for all pages.
+
+        Once the first page reveals the number of pages, all remaining
+        pages are requested concurrently.
+
+        @returns {AsyncCall} whose result is the list of all items, in
+            page order.
+        """
+        call = AsyncCall(self)
+        page = int(args.get("page", 1))
+        containers = {}
+
+        def request_page(page):
+            page_args = dict(args)
+            page_args["page"] = page
+            page_call = self.call(method_name_, response_format_,
+                                  raise_on_api_error_, **page_args)
+            page_call.add_callback(
+                lambda page_call: on_page(page, page_call))
+
+        def on_page(page, page_call):
+            if call.done:
+                return
+            try:
+                containers[page] = page_call.result()[0]
+            except:
+                call._set_exc_info(sys.exc_info())
+                return
+            if len(containers) == 1:
+                num_pages = int(containers[page].get("pages"))
+                for p in range(page+1, num_pages+1):
+                    request_page(p)
+            num_pages = int(containers[min(containers)].get("pages"))
+            if len(containers) >= num_pages - min(containers) + 1:
+                items = []
+                for p in sorted(containers):
+                    items += list(containers[p])
+                call._set_result(items)
+
+        request_page(page)
+        return call
+
+    def download(self, url, path):
+        """Download the given URL to the given path.
+
+        @returns {AsyncCall} whose result is the number of bytes written.
+        """
+        call = AsyncCall(self)
+        f = open(path, 'wb')
+
+        def on_response(http, url=url, redirects=0):
+            try:
+                status, reason, headers, body = http.result()
+                if status in (301, 302, 303, 307) and headers.get("location"):
+                    if redirects >= self.max_redirects:
+                        raise FlickrHTTPError(url, status, "too many redirects")
+                    f.seek(0)
+                    f.truncate()
+                    new_url = urlparse.urljoin(url, headers["location"])
+                    log.debug("download: redirected to %s", new_url)
+                    self.http_pool.request(AsyncCall(self), "GET", new_url,
+                        sink=f).add_callback(lambda http: on_response(
+                            http, new_url, redirects+1))
+                    return
+                elif status != 200:
+                    raise FlickrHTTPError(url, status, reason)
+                nbytes = f.tell()
+                f.close()
+            except:
+                f.close()
+                if exists(path):
+                    os.remove(path)
+                call._set_exc_info(sys.exc_info())
+            else:
+                call._set_result(nbytes)
+
+        self.http_pool.request(AsyncCall(self), "GET", url, sink=f)\
+            .add_callback(on_response)
+        return call
+
+    def _call_async(self, method_name, post_data, response_format,
+                    raise_on_api_error):
+        call = AsyncCall(self)
+        state = {"attempt": 0}
+
+        def attempt():
+            delay = self.rate_limiter.reserve()
+            if delay > 0:
+                self.call_later(delay, send)
+            else:
+                send()
+
+        def send():
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+            http = self.http_pool.request(AsyncCall(self), "POST",
+                                          self.rest_url, post_data, headers)
+            http.add_callback(on_response)
+
+        def on_response(http):
+            try:
+                status, reason, headers, body = http.result()
+                if status != 200:
+                    raise FlickrHTTPError(self.rest_url, status, reason)
+                result = self._handle_rsp(body,
+                    response_format=response_format,
+                    raise_on_api_error=raise_on_api_error)
+            except (FlickrAPIError, socket.error, httplib.HTTPException), ex:
+                exc_info = sys.exc_info()
+                state["attempt"] += 1
+                delay = self._retry_delay(method_name, ex, state["attempt"])
+                if delay is None:
+                    call._set_exc_info(exc_info)
+                else:
+                    self.call_later(delay, attempt)
+            except:
+                call._set_exc_info(sys.exc_info())
+            else:
+                call._set_result(result)
+
+        attempt()
+        return call
+
+    def call_later(self, delay, callback):
+        """Call `callback()` from the event loop after `delay` seconds."""
+        heapq.heappush(self._timers, (time.time() + delay, callback))
+
+    def run(self, calls=None):
+        """Run the event loop until the given calls are done. If no calls
+        are given, run until there is no pending work.
+        """
+        while True:
+            if calls is None:
+                if not self._pending:
+                    break
+            elif all(c.done for c in calls):
+                break
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                when, callback = heapq.heappop(self._timers)
+                callback()
+            timeout = 1.0
+            if self._timers:
+                timeout = max(0.0, min(timeout, self._timers[0][0] - now))
+            if self._map:
+                asyncore.loop(timeout=timeout, map=self._map, count=1)
+            elif self._timers:
+                time.sleep(timeout)
+            elif calls is not None and not all(c.done for c in calls):
+                raise FlickrAPIError("event loop stalled: no work to wait on")
+            self.http_pool.close_idle()
+
+    def wait(self, calls):
+        """Run the event loop until all the given calls are done and
+        return their results (in order).
+        """
+        self.run(calls)
+        return [c.result() for c in calls]
+
+    def close(self):
+        """Close all connections."""
+        self.http_pool.close_all()
+
+
+
+#---- HTTP support
+
+class AsyncHTTPPool(object):
+    """A pool of keep-alive HTTP/1.1 connections on an asyncore map.
+
+    Requests beyond `max_connections` per host are queued until a
+    connection to that host becomes free.
+    """
+    def __init__(self, map, max_connections=8, idle_timeout=30.0):
+        self.map = map
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._idle_from_key = {}
+        self._active_from_key = {}
+        self._queue_from_key = {}
+
+    def request(self, call, method, url, body=None, headers=None, sink=None):
+        """Queue an HTTP request.
+
+        @param call {AsyncCall} The call to complete with a 4-tuple:
+            (<status>, <reason>, <headers>, <body>) where "headers" is a
+            dict with lowercased names.
+        @param sink {file} Optional file to which to write the response
+            body. If given, "body" in the result is None.
+        @returns {AsyncCall} The given call.
+        """
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+        if scheme != "http":
+            raise FlickrAPIError("unsupported URL scheme: %r" % url)
+        if ':' in netloc:
+            host, port = netloc.split(':', 1)
+            port = int(port)
+        else:
+            host, port = netloc, 80
+        key = (host, port)
+        selector = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+        lines = ["%s %s HTTP/1.1" % (method, selector),
+                 "Host: %s" % netloc]
+        for name, value in (headers or {}).items():
+            lines.append("%s: %s" % (name, value))
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        data = "\r\n".join(lines) + "\r\n\r\n" + (body or "")
+        req = _Request(call, data, sink)
+        self._queue_from_key.setdefault(key, []).append(req)
+        self._dispatch(key)
+        return call
+
+    def _dispatch(self, key):
+        queue = self._queue_from_key.get(key)
+        active = self._active_from_key.setdefault(key, set())
+        while queue:
+            idle = self._idle_from_key.get(key)
+            if idle:
+                channel, last_used = idle.pop()
+            elif len(active) < self.max_connections:
+                channel = _HTTPChannel(self, key, self.map)
+            else:
+                break
+            active.add(channel)
+            channel.start(queue.pop(0))
+
+    def _release(self, channel, keep_alive):
+        """Called by a channel when its request is done."""
+        self._active_from_key[channel.key].discard(channel)
+        if keep_alive:
+            self._idle_from_key.setdefault(channel.key, []).append(
+                (channel, time.time()))
+        else:
+            channel.close()
+        self._dispatch(channel.key)
+
+    def _drop(self, channel, retry_req=None):
+        """Called by a channel when it has been closed."""
+        self._active_from_key.get(channel.key, set()).discard(channel)
+        idle = self._idle_from_key.get(channel.key, [])
+        idle[:] = [(c, t) for c, t in idle if c is not channel]
+        if retry_req is not None:
+            self._queue_from_key.setdefault(channel.key, []).insert(0,
+                retry_req)
+        self._dispatch(channel.key)
+
+    def close_idle(self):
+        """Close connections that have been idle too long."""
+        now = time.time()
+        for key, idle in self._idle_from_key.items():
+            for channel, last_used in idle[:]:
+                if now - last_used > self.idle_timeout:
+                    idle.remove((channel, last_used))
+                    channel.close()
+
+    def close_all(self):
+        for idle in self._idle_from_key.values():
+            for channel, last_used in idle:
+                channel.close()
+        self._idle_from_key = {}
+
+
+class _Request(object):
+    def __init__(self, call, data, sink=None):
+        self.call = call
+        self.data = data
+        self.sink = sink
+        self.retried = False
+
+
+class _HTTPChannel(asynchat.async_chat):
+    """A single HTTP/1.1 client connection handling one request at a
+    time.
+    """
+    def __init__(self, pool, key, map):
+        asynchat.async_chat.__init__(self, map=map)
+        self.pool = pool
+        self.key = key
+        self.req = None
+        self.reused = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(key)
+
+    def start(self, req):
+        self.req = req
+        self.got_data = False
+        self.state = "headers"
+        self.buf = []
+        self.body = StringIO()
+        self.set_terminator("\r\n\r\n")
+        self.push(req.data)
+
+    def handle_connect(self):
+        pass
+
+    def collect_incoming_data(self, data):
+        self.got_data = True
+        if self.state in ("body", "chunk"):
+            (self.req.sink or self.body).write(data)
+        else:
+            self.buf.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        if self.state == "headers":
+            self._handle_headers(data)
+        elif self.state == "body":
+            self._finish()
+        elif self.state == "chunk-size":
+            size = int(data.split(';', 1)[0].strip(), 16)
+            if size == 0:
+                self.state = "trailer"
+                self.set_terminator("\r\n")
+            else:
+                self.state = "chunk"
+                self.set_terminator(size)
+        elif self.state == "chunk":
+            self.state = "chunk-end"
+            self.set_terminator("\r\n")
+        elif self.state == "chunk-end":
+            self.state = "chunk-size"
+        elif self.state == "trailer":
+            if not data:
+                self._finish()
+
+    def _handle_headers(self, data):
+        status_line, header_data = (data.split("\r\n", 1) + [''])[:2]
+        version, status, reason = (status_line.split(None, 2) + [''])[:3]
+        self.status = int(status)
+        self.reason = reason
+        msg = mimetools.Message(StringIO(header_data + "\r\n"), 0)
+        self.headers = dict((k.lower(), v) for k, v in msg.items())
+        self.keep_alive = (version == "HTTP/1.1"
+            and self.headers.get("connection", "").lower() != "close")
+        if self.req.data.startswith("HEAD ") or self.status in (204, 304):
+            self._finish()
+        elif self.headers.get("transfer-encoding", "").lower() == "chunked":
+            self.state = "chunk-size"
+            self.set_terminator("\r\n")
+        elif "content-length" in self.headers:
+            length = int(self.headers["content-length"])
+            self.state = "body"
+            if length == 0:
+                self._finish()
+            else:
+                self.set_terminator(length)
+        else:
+            # Read until the server closes the connection.
+            self.keep_alive = False
+            self.state = "body"
+            self.set_terminator(None)
+
+    def _finish(self):
+        req, self.req = self.req, None
+        body = (req.sink is None and self.body.getvalue() or None)
+        self.reused = True
+        self.pool._release(self, self.keep_alive)
+        req.call._set_result((self.status, self.reason, self.headers, body))
+
+    def handle_close(self):
+        req = self.req
+        if req is not None and self.state == "body" \
+           and self.get_terminator() is None:
+            self.keep_alive = False
+            self._finish()
+            return
+        self.close()
+        self.req = None
+        if req is None:
+            self.pool._drop(self)
+        elif self.reused and not self.got_data and not req.retried:
+            # The server likely dropped this idle keep-alive connection.
+            # Retry on a fresh one.
+            log.debug("stale async connection to %s:%s: retrying", *self.key)
+            req.retried = True
+            self.pool._drop(self, retry_req=req)
+        else:
+            self.pool._drop(self)
+            try:
+                raise socket.error("connection to %s:%s closed" % self.key)
+            except socket.error:
+                req.call._set_exc_info(sys.exc_info())
+
+    def handle_error(self):
+        exc_info = sys.exc_info()
+        req, self.req = self.req, None
+        self.close()
+        self.pool._drop(self)
+        if req is not None:
+            req.call._set_exc_info(exc_info)
+        else:
+            log.debug("error on idle async connection to %s:%s: %s",
+                      self.key[0], self.key[1], exc_info[1])
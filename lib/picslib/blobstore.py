@@ -0,0 +1,275 @@
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""A store of downloaded photo files that can be shared by working copies.
+
+Several working copies of overlapping accounts (or of the same account
+with different permissions or sizes) would otherwise each download and
+store the same photos. With a blob store, each file is downloaded once:
+working copies hardlink (or, where the filesystem supports it, reflink)
+their photo files from the store.
+"""
+
+import os
+from os.path import exists, join, dirname, isdir, expanduser, normpath, \
+    abspath
+import sys
+import logging
+import time
+import threading
+import shutil
+import errno
+import sqlite3
+
+
+
+log = logging.getLogger("pics")
+
+default_blob_store_dir = expanduser(join("~", ".pics", "blobs"))
+
+
+
+class BlobStore(object):
+    """A directory of photo files ("blobs"), each keyed by photo id,
+    secret and size. (The "secret" changes whenever the photo is
+    replaced, so the content for a key never changes.)
+
+    The index ("blobs.sqlite3") records the size, MD5 and mtime of each
+    blob, and the working copies using the store. A blob whose size or
+    mtime has changed -- e.g. a hardlinked photo file edited in a working
+    copy -- is dropped rather than handed out.
+
+    Usage:
+        store = BlobStore(dir)
+        result = store.get(key, path, part_path)
+        if result is None:
+            size, md5 = ...  # download to `path`
+            store.add(key, path, size, md5)
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS blob (
+            key TEXT PRIMARY KEY,
+            bytes INTEGER,
+            md5 TEXT,
+            mtime REAL,
+            refs INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS wc (
+            dir TEXT PRIMARY KEY
+        );
+    """
+
+    # Files in the store that aren't in the index (e.g. left by an
+    # interrupted `add()`) are removed by `gc()` once this many seconds
+    # old.
+    orphan_age = 60*60
+
+    def __init__(self, dir):
+        self.dir = normpath(abspath(dir))
+        self._lock = threading.Lock()
+        if not exists(self.dir):
+            os.makedirs(self.dir)
+        self._cx = sqlite3.connect(join(self.dir, "blobs.sqlite3"),
+                                   timeout=60.0, isolation_level=None,
+                                   check_same_thread=False)
+        self._cx.text_factory = str
+        self._cx.executescript(self.schema)
+
+    def __repr__(self):
+        return "<BlobStore %s>" % self.dir
+
+    def close(self):
+        self._cx.close()
+
+    def path(self, key):
+        """Return the path of the blob with the given key. Blobs are
+        spread over subdirs on the last two digits of the photo id.
+        """
+        id = key.split('_', 1)[0]
+        return join(self.dir, id[-2:], key)
+
+    def _execute(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            return self._cx.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def register(self, wc_dir):
+        """Note that the given working copy uses this store (for `gc()`)."""
+        self._execute("INSERT OR IGNORE INTO wc VALUES (?)",
+                      (normpath(abspath(wc_dir)),))
+
+    def wc_dirs(self):
+        return [row[0] for row in self._execute("SELECT dir FROM wc")]
+
+    def get(self, key, path, part_path=None):
+        """Link (or copy) the blob with the given key to `path`, if it is
+        in the store.
+
+        @param part_path {str} Optional. A temporary path, on the same
+            filesystem as `path`, via which to link. Defaults to `path`
+            plus ".part".
+        @returns {tuple} (<size>, <md5-hexdigest>) of the file, or None
+            if the blob isn't in the store.
+        """
+        rows = self._execute("SELECT bytes, md5, mtime FROM blob WHERE key=?",
+                             (key,))
+        if not rows:
+            return None
+        nbytes, md5, mtime = rows[0]
+        blob_path = self.path(key)
+        try:
+            st = os.stat(blob_path)
+        except OSError:
+            log.debug("blob `%s' is missing: dropping it", key)
+            self._execute("DELETE FROM blob WHERE key=?", (key,))
+            return None
+        if (st.st_size, st.st_mtime) != (nbytes, mtime):
+            log.warn("blob `%s' has been modified: dropping it", blob_path)
+            self._remove(key)
+            return None
+
+        if part_path is None:
+            part_path = path + ".part"
+        if exists(part_path):
+            os.remove(part_path)
+        how = _link_or_copy(blob_path, part_path)
+        if sys.platform == "win32" and exists(path):
+            os.remove(path)  # `os.rename` won't overwrite on Windows
+        os.rename(part_path, path)
+        log.debug("%s `%s' from blob store", how, path)
+        return nbytes, md5
+
+    def add(self, key, path, nbytes, md5):
+        """Add the given downloaded file to the store (linking it, if
+        possible) with the given key.
+        """
+        blob_path = self.path(key)
+        if exists(blob_path):
+            return
+        d = dirname(blob_path)
+        if not isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError, ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        tmp_path = "%s.%d.%d.tmp" % (blob_path, os.getpid(),
+                                     threading.currentThread().ident)
+        _link_or_copy(path, tmp_path)
+        os.rename(tmp_path, blob_path)
+        self._execute("INSERT OR REPLACE INTO blob VALUES (?,?,?,?,?)",
+            (key, nbytes, md5, os.stat(blob_path).st_mtime, None))
+
+    def _remove(self, key):
+        blob_path = self.path(key)
+        if exists(blob_path):
+            os.remove(blob_path)
+        self._execute("DELETE FROM blob WHERE key=?", (key,))
+
+    def gc(self, keys_from_wc_dir, dry_run=False):
+        """Remove the blobs not used by any working copy.
+
+        The reference count of each blob is the number of registered
+        working copies with a file from it. Working copies that no longer
+        exist are forgotten.
+
+        @param keys_from_wc_dir {callable} Returns the blob keys of the
+            files in the working copy at the given dir.
+        @returns {tuple} (<number of blobs removed>, <bytes freed>).
+        """
+        refs_from_key = {}
+        for wc_dir in self.wc_dirs():
+            if not exists(join(wc_dir, ".pics")):
+                log.info("forgetting working copy `%s' (it is gone)", wc_dir)
+                if not dry_run:
+                    self._execute("DELETE FROM wc WHERE dir=?", (wc_dir,))
+                continue
+            for key in keys_from_wc_dir(wc_dir):
+                refs_from_key[key] = refs_from_key.get(key, 0) + 1
+
+        num_removed = bytes_freed = 0
+        keys = set()
+        for key, nbytes in self._execute("SELECT key, bytes FROM blob"):
+            keys.add(key)
+            refs = refs_from_key.get(key, 0)
+            if refs:
+                if not dry_run:
+                    self._execute("UPDATE blob SET refs=? WHERE key=?",
+                                  (refs, key))
+                continue
+            log.info("D  %s", self.path(key))
+            num_removed += 1
+            bytes_freed += nbytes
+            if not dry_run:
+                self._remove(key)
+
+        # Orphaned files, not in the index.
+        now = time.time()
+        for name in os.listdir(self.dir):
+            d = join(self.dir, name)
+            if not isdir(d):
+                continue
+            for key in os.listdir(d):
+                path = join(d, key)
+                if key in keys or now - os.stat(path).st_mtime \
+                                  < self.orphan_age:
+                    continue
+                log.info("D  %s", path)
+                num_removed += 1
+                bytes_freed += os.stat(path).st_size
+                if not dry_run:
+                    os.remove(path)
+        return num_removed, bytes_freed
+
+
+
+#---- internal support stuff
+
+# The Linux FICLONE ioctl: make a copy-on-write clone of a file (on
+# btrfs, XFS and others).
+_FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    """Make `dst` a copy-on-write clone of `src`. Returns false if that
+    isn't supported on this platform or filesystem.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except IOError:
+            fdst.close()
+            os.remove(dst)
+            return False
+        fdst.close()
+    finally:
+        fsrc.close()
+    st = os.stat(src)
+    os.utime(dst, (st.st_atime, st.st_mtime))
+    return True
+
+def _link_or_copy(src, dst):
+    """Reflink, hardlink or (failing those) copy `src` to `dst`.
+
+    A reflink is preferred: unlike a hardlink, editing one file doesn't
+    change the other. The mtime is preserved in all cases.
+
+    @returns {str} How it was done: "reflink", "hardlink" or "copy".
+    """
+    if _reflink(src, dst):
+        return "reflink"
+    if hasattr(os, "link"):
+        try:
+            os.link(src, dst)
+        except OSError, ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+        else:
+            return "hardlink"
+    shutil.copy2(src, dst)
+    return "copy"
@@ -0,0 +1,431 @@
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Resumable, atomic and rate limited downloading of photo and video
+files.
+"""
+
+import os
+from os.path import exists, getsize
+import sys
+import logging
+import time
+import random
+import threading
+import socket
+import httplib
+import urlparse
+import re
+from hashlib import md5
+
+from picslib import simpleflickrapi
+from picslib.errors import PicsError, PicsDownloadError
+
+
+
+log = logging.getLogger("pics")
+
+
+
+class Downloader(object):
+    """Download URLs to files, atomically and resumably.
+
+    The body is streamed to a ".part" file, in chunks, which is renamed to
+    the target path only once complete (checked against the response
+    Content-Length). The MD5 and size of the content are computed as it
+    is written, so the file doesn't have to be read again to get them.
+    If a download is interrupted, the ".part" file is kept and the next
+    attempt -- a retry, or a later `download()` of the same URL to the
+    same path -- resumes from where it left off with an HTTP Range
+    request.
+
+    The URL (and ETag or Last-Modified, if given) of a partial download
+    is kept in a ".src" file beside it. A ".part" file from a different
+    URL -- e.g. a photo replaced on Flickr, which gets a new "secret" in
+    its URL -- is discarded rather than resumed, and the resume request
+    has an If-Range header, so a changed file is downloaded afresh.
+
+    Usage:
+        downloader = Downloader()
+        size, md5_hex = downloader.download(url, path)
+
+    @param http_pool {simpleflickrapi.HTTPConnectionPool} The pool of
+        keep-alive connections to use. By default the process-wide
+        `simpleflickrapi.default_http_pool` is used.
+    @param stats {simpleflickrapi.RequestStats} Optional. Where to record
+        requests, keyed by ("download", <host>).
+    @param rate_limiter {RateLimiter} Optional. Limits the total download
+        rate (of all threads using this downloader).
+    """
+    # Retrying of transient failures. The delay before retry N is random
+    # in [0, retry_backoff * 2**(N-1)), capped at `retry_max_delay`.
+    max_retries = 4
+    retry_backoff = 1.0
+    retry_max_delay = 60.0
+    max_redirects = 5
+    chunk_size = 64*1024
+
+    def __init__(self, http_pool=None, stats=None, rate_limiter=None):
+        if http_pool is None:
+            http_pool = simpleflickrapi.default_http_pool
+        self.http_pool = http_pool
+        self.stats = stats
+        self.rate_limiter = rate_limiter
+
+    def download(self, url, path, part_path=None, priority=0):
+        """Download the given URL to `path`.
+
+        @param part_path {str} Optional. The path to which to write the
+            partial download. Must be on the same filesystem as `path`.
+            Defaults to `path` plus ".part".
+        @param priority {int} The priority of this download's share of a
+            limited download rate: 0 (highest) or greater.
+        @returns {tuple} (<size>, <md5-hexdigest>) of the downloaded file.
+        @raises {PicsDownloadError} if the download failed.
+        """
+        if part_path is None:
+            part_path = path + ".part"
+        attempt = 0
+        while True:
+            try:
+                size, hash = self._download_part(url, part_path, priority)
+            except (PicsDownloadError, socket.error,
+                    httplib.HTTPException), ex:
+                attempt += 1
+                if not self._backoff(url, ex, attempt):
+                    raise
+            else:
+                break
+        if sys.platform == "win32" and exists(path):
+            os.remove(path)  # `os.rename` won't overwrite on Windows
+        os.rename(part_path, path)
+        if exists(part_path + ".src"):
+            os.remove(part_path + ".src")
+        return size, hash.hexdigest()
+
+    def _retry_delay(self, url, ex, attempt):
+        if attempt > self.max_retries:
+            return None
+        if isinstance(ex, PicsDownloadError) and not ex.is_transient:
+            return None
+        delay = random.uniform(0, min(self.retry_max_delay,
+            self.retry_backoff * 2 ** (attempt-1)))
+        log.debug("download `%s' failed (%s): retry %d of %d in %.2fs",
+                  url, ex, attempt, self.max_retries, delay)
+        return delay
+
+    def _backoff(self, url, ex, attempt):
+        delay = self._retry_delay(url, ex, attempt)
+        if delay is None:
+            return False
+        if self.stats is not None:
+            self.stats.record_retry("download", urlparse.urlparse(url)[1])
+        time.sleep(delay)
+        return True
+
+    def _record(self, url, started, nbytes=0, error=False):
+        if self.stats is not None:
+            self.stats.record("download", urlparse.urlparse(url)[1],
+                              time.time() - started, nbytes, error)
+
+    def _open(self, url, headers):
+        """Make a GET request, following redirects, and return the
+        `PooledResponse`.
+        """
+        for i in range(self.max_redirects + 1):
+            rsp = self.http_pool.request("GET", url, headers=headers)
+            if rsp.status not in (301, 302, 303, 307):
+                return rsp
+            location = rsp.getheader("Location")
+            rsp.read()
+            rsp.close()
+            if not location:
+                raise PicsDownloadError(url, rsp.status,
+                                        "redirect without a Location")
+            url = urlparse.urljoin(url, location)
+            log.debug("download redirected to `%s'", url)
+        raise PicsDownloadError(url, rsp.status, "too many redirects")
+
+    def _download_part(self, url, part_path, priority=0):
+        """Download (the rest of) the given URL to `part_path`.
+
+        @returns {tuple} (<size>, <md5-hash-object>) of the complete
+            download.
+        """
+        offset = exists(part_path) and getsize(part_path) or 0
+        headers = {}
+        if offset:
+            src_url, validator = _read_part_source(part_path)
+            if src_url != url:
+                log.debug("discard partial download `%s': it is of `%s', "
+                          "not `%s'", part_path, src_url, url)
+                os.remove(part_path)
+                offset = 0
+        if offset:
+            log.debug("resume download of `%s' at byte %d", url, offset)
+            headers["Range"] = "bytes=%d-" % offset
+            if validator:
+                headers["If-Range"] = validator
+        started = time.time()
+        try:
+            rsp = self._open(url, headers)
+        except (socket.error, httplib.HTTPException):
+            self._record(url, started, error=True)
+            raise
+
+        try:
+            if rsp.status == 206:
+                start, total = _parse_content_range(
+                    rsp.getheader("Content-Range"))
+                if start != offset:
+                    os.remove(part_path)
+                    raise PicsDownloadError(url, rsp.status,
+                        "unexpected Content-Range (%r): restarting"
+                        % rsp.getheader("Content-Range"), is_transient=True)
+                mode = 'ab'
+                hash = _md5_from_path(part_path, self.chunk_size)
+            elif rsp.status == 200:
+                # A full response: no resume (or the file has changed).
+                offset, total, mode = 0, None, 'wb'
+                hash = md5()
+                _write_part_source(part_path, url, rsp.getheader("ETag")
+                                   or rsp.getheader("Last-Modified"))
+            elif rsp.status == 416 and offset:
+                # Range not satisfiable: the ".part" file is complete
+                # already, or is bogus.
+                start, total = _parse_content_range(
+                    rsp.getheader("Content-Range"))
+                rsp.read()
+                if total == offset:
+                    self._record(url, started)
+                    return offset, _md5_from_path(part_path,
+                                                  self.chunk_size)
+                os.remove(part_path)
+                raise PicsDownloadError(url, rsp.status,
+                    "partial download larger than the file: restarting",
+                    is_transient=True)
+            else:
+                raise PicsDownloadError(url, rsp.status, rsp.reason)
+
+            length = rsp.getheader("Content-Length")
+            expected = length is not None and offset + int(length) or total
+            f = open(part_path, mode)
+            try:
+                size = offset
+                while True:
+                    chunk = rsp.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    hash.update(chunk)
+                    size += len(chunk)
+                    if self.rate_limiter is not None:
+                        # Not reading the socket slows the sender.
+                        self.rate_limiter.consume(len(chunk), priority)
+            finally:
+                f.close()
+            if expected is not None and size != expected:
+                raise PicsDownloadError(url, rsp.status,
+                    "incomplete download: got %d of %d bytes"
+                    % (size, expected), is_transient=True)
+        except:
+            self._record(url, started, rsp.bytes_read, error=True)
+            rsp.close()
+            raise
+        rsp.close()
+        self._record(url, started, rsp.bytes_read)
+        return size, hash
+
+
+class RateLimiter(object):
+    """A token bucket limiting the total rate of downloads, shared by the
+    threads downloading.
+
+    The limit can vary by time of day. When the limit is reached, waiting
+    consumers of a higher priority (lower number) go first, e.g. so that
+    photos are downloaded ahead of large videos.
+
+    Usage:
+        limiter = RateLimiter.from_spec("200k@08:00-18:00,2M")
+        ...
+        limiter.consume(len(chunk))  # blocks as necessary
+
+    @param rate {float} The limit, in bytes per second, outside of the
+        given `windows`. None for no limit.
+    @param windows {list} Optional. Time of day windows with their own
+        limit: (<start>, <end>, <rate>) where <start> and <end> are
+        minutes after (local) midnight. A window with <end> before
+        <start> spans midnight.
+    """
+    # The max burst, in seconds' worth of the limit.
+    burst = 1.0
+
+    def __init__(self, rate=None, windows=None):
+        self.rate = rate
+        self.windows = windows or []
+        self._cond = threading.Condition()
+        self._tokens = 0.0
+        self._last_refill = time.time()
+        self._num_waiting_from_priority = {}
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Create a `RateLimiter` from a spec string: a comma-separated
+        list of limits, each optionally limited to a time of day window.
+        A limit is in bytes per second with an optional 'k', 'M' or 'G'
+        suffix. For example:
+            500k                    500KB/s at all times
+            200k@08:00-18:00,2M     200KB/s during the day, else 2MB/s
+            1M@09:00-17:00          1MB/s during the day, else no limit
+
+        A limit must be more than zero: for no limit, leave it out.
+
+        @raises {PicsError} if the spec is invalid.
+        """
+        rate, windows = None, []
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                raise PicsError("invalid download rate limit: %r (empty "
+                                "limit in comma-separated list)" % spec)
+            match = _rate_spec_pat.match(part)
+            if (part.startswith('-')
+                or (match and not float(match.group("num")))):
+                raise PicsError("invalid download rate limit: %r (must be "
+                                "more than zero; leave it out for no "
+                                "limit)" % part)
+            if not match:
+                raise PicsError("invalid download rate limit: %r (expected "
+                                "RATE[@HH:MM-HH:MM],...)" % part)
+            limit = float(match.group("num")) \
+                * _multiplier_from_rate_suffix[match.group("suffix").lower()]
+            if match.group("start"):
+                windows.append((_minutes_from_hhmm(match.group("start")),
+                                _minutes_from_hhmm(match.group("end")),
+                                limit))
+            else:
+                rate = limit
+        return cls(rate, windows)
+
+    def __repr__(self):
+        return "<RateLimiter %r %r>" % (self.rate, self.windows)
+
+    def rate_at(self, t):
+        """Return the limit (bytes per second, or None) at the given time."""
+        tm = time.localtime(t)
+        minutes = tm.tm_hour * 60 + tm.tm_min
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minutes < end:
+                    return rate
+            elif minutes >= start or minutes < end:
+                return rate
+        return self.rate
+
+    def _waiting_ahead_of(self, priority):
+        return [p for p, n in self._num_waiting_from_priority.items()
+                if p < priority and n]
+
+    def consume(self, nbytes, priority=0):
+        """Take `nbytes` from the bucket, first waiting for it to refill,
+        and for waiting consumers of a higher priority, as necessary.
+        """
+        self._cond.acquire()
+        try:
+            waiting = self._num_waiting_from_priority
+            waiting[priority] = waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    now = time.time()
+                    rate = self.rate_at(now)
+                    if not rate:
+                        self._last_refill = now
+                        return
+                    self._tokens = min(self._tokens
+                        + (now - self._last_refill) * rate, rate * self.burst)
+                    self._last_refill = now
+                    if self._tokens > 0 \
+                       and not self._waiting_ahead_of(priority):
+                        # The bytes may well have been read already:
+                        # going into debt keeps the average rate right.
+                        self._tokens -= nbytes
+                        return
+                    if self._tokens > 0:
+                        delay = 0.05  # to let the others ahead go first
+                    else:
+                        delay = max(0.01, -self._tokens / rate)
+                    self._cond.wait(delay)
+            finally:
+                waiting[priority] -= 1
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+
+#---- internal support stuff
+
+def _md5_from_path(path, chunk_size=64*1024):
+    """Return an md5 hash object updated with the content of the given
+    file, read in chunks.
+    """
+    hash = md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hash.update(chunk)
+    finally:
+        f.close()
+    return hash
+
+def _read_part_source(part_path):
+    """Return the (<url>, <validator>) of the given partial download, as
+    written by `_write_part_source`. Either may be None.
+    """
+    src_path = part_path + ".src"
+    if not exists(src_path):
+        return None, None
+    lines = open(src_path, 'r').read().splitlines()
+    url = lines and lines[0] or None
+    validator = len(lines) > 1 and lines[1] or None
+    return url, validator
+
+def _write_part_source(part_path, url, validator=None):
+    f = open(part_path + ".src", 'w')
+    try:
+        f.write("%s\n%s\n" % (url, validator or ""))
+    finally:
+        f.close()
+
+_content_range_pat = re.compile(r"^bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)$")
+
+def _parse_content_range(value):
+    """Parse a Content-Range header value.
+
+    @returns {tuple} (<start>, <total>), either of which may be None if
+        not given.
+    """
+    match = value and _content_range_pat.match(value.strip())
+    if not match:
+        return None, None
+    start, total = match.groups()
+    if start is not None:
+        start = int(start)
+    if total == '*':
+        total = None
+    else:
+        total = int(total)
+    return start, total
+
+_rate_spec_pat = re.compile(r"^(?P<num>\d+(?:\.\d+)?)(?P<suffix>[kmg]?)b?"
+    r"(?:@(?P<start>\d\d?:\d\d)-(?P<end>\d\d?:\d\d))?$", re.I)
+
+_multiplier_from_rate_suffix = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+def _minutes_from_hhmm(hhmm):
+    hh, mm = hhmm.split(':')
+    if int(hh) > 24 or int(mm) > 59:
+        raise PicsError("invalid time of day: %r" % hhmm)
+    return int(hh) * 60 + int(mm)
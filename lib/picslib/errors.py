@@ -7,3 +7,17 @@ class PicsError(Exception):
 class PicsFSError(PicsError):
     """An error in the file system wrapper."""
 
+
+class PicsDownloadError(PicsError):
+    """An error downloading a photo or video file."""
+    # HTTP statuses for which the download is worth retrying.
+    transient_statuses = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, url, status, reason, is_transient=None):
+        PicsError.__init__(self, "`%s': %s (HTTP %s)" % (url, reason, status))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        if is_transient is None:
+            is_transient = status in self.transient_statuses
+        self.is_transient = is_transient
@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+r"""A self-contained stand-in Flickr server, for benchmarking and offline
+testing of pics.
+
+It serves a REST endpoint and the "farm" static photo hosts for a
+generated account, implementing the API methods that `pics checkout`, `pics update` and
+`pics reconcile` use:
+
+    flickr.photos.recentlyUpdated
+    flickr.people.getPhotos (for "me" only)
+    flickr.photos.getInfo
+    flickr.photos.getSizes
+    flickr.photos.comments.getList
+    flickr.auth.checkToken, flickr.auth.getFrob, flickr.auth.getToken
+    flickr.test.echo
+
+Usage:
+    python fakeflickr.py [--photos N] [--latency SECS] ... [PORT]
+
+and point pics at it via the environment variables it prints, e.g.:
+
+    export PICS_FLICKR_REST_URL=http://127.0.0.1:8080/services/rest/
+    export PICS_FLICKR_PHOTO_URL='http://127.0.0.1:8080/farm%(farm)s/%(server)s/%(id)s_'
+    export PICS_FLICKR_API_KEY=fake PICS_FLICKR_SECRET=fake
+    export PICS_FLICKR_AUTH_TOKEN=fake-token
+    pics co flickr://fakeuser/ photos
+
+Or, from Python:
+
+    server = FakeFlickrServer(FakeFlickr(num_photos=1000, latency=0.05))
+    server.start()
+    try:
+        api = SimpleFlickrAPI("fake", "fake")
+        api.rest_url = server.rest_url
+        ...
+    finally:
+        server.stop()
+"""
+
+import sys
+import re
+import time
+import random
+import logging
+import threading
+import socket
+import cgi
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape, quoteattr
+
+
+
+log = logging.getLogger("pics")
+
+
+
+#---- the fake account
+
+class FakePhoto(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+    @property
+    def is_video(self):
+        return self.media == "video"
+
+
+class FakeFlickr(object):
+    """A generated Flickr account and the knobs for serving it.
+
+    @param num_photos {int} Number of photos (and videos) in the account.
+        Default 100.
+    @param video_ratio {float} Fraction of the photos that are videos.
+        Default 0.05.
+    @param photo_size {int} Size in bytes of an original photo. Other
+        sizes are scaled down from this. Videos are 20 times bigger.
+        Default 200KB.
+    @param latency {float} Seconds to wait before answering any request.
+        Default 0.
+    @param bandwidth {int} Max bytes per second for each photo download,
+        or None for no limit. Default None.
+    @param error_rate {float} Fraction of requests that fail with a
+        transient error: an HTTP 503 or Flickr error 105 for API calls,
+        an HTTP 503 for downloads. Default 0.
+    @param seed {int} Seed for generating the account and errors.
+    @param username {str} The account's username. Default "fakeuser".
+    """
+    nsid = "12345678@N00"
+
+    def __init__(self, num_photos=100, video_ratio=0.05,
+                 photo_size=200*1024, latency=0.0, bandwidth=None,
+                 error_rate=0.0, seed=0, username="fakeuser"):
+        self.num_photos = num_photos
+        self.video_ratio = video_ratio
+        self.photo_size = photo_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.username = username
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.num_requests = 0
+        self.photos = self._generate_photos(random.Random(seed))
+        self.photo_from_id = dict((p.id, p) for p in self.photos)
+
+    def _generate_photos(self, rand):
+        photos = []
+        # Spread over the last five years, updated in id order.
+        start = int(time.time()) - 5*365*24*60*60
+        step = max(1, (5*365*24*60*60) // max(1, self.num_photos))
+        for i in range(self.num_photos):
+            posted = start + i*step
+            taken = posted - rand.randint(0, 30*24*60*60)
+            secret = "%010x" % rand.getrandbits(40)
+            photos.append(FakePhoto(
+                id=str(1000000 + i),
+                secret=secret,
+                originalsecret=secret,
+                server=str(rand.randint(1000, 9999)),
+                farm=str(rand.randint(1, 9)),
+                originalformat=rand.choice(["jpg", "jpg", "jpg", "png"]),
+                media=(rand.random() < self.video_ratio and "video"
+                       or "photo"),
+                title="Fake photo %d" % i,
+                description="Description of fake photo %d" % i,
+                ispublic=int(rand.random() < 0.6),
+                isfriend=int(rand.random() < 0.3),
+                isfamily=int(rand.random() < 0.3),
+                posted=posted,
+                taken=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(taken)),
+                lastupdate=posted + rand.randint(0, 24*60*60),
+                tags=rand.sample(["cat", "dog", "sea", "sky", "tree",
+                                  "family", "trip", "food"],
+                                 rand.randint(0, 3)),
+                num_comments=rand.choice([0, 0, 0, 1, 2, 5]),
+                width=rand.choice([2048, 3072, 4000]),
+                height=rand.choice([1536, 2304, 3000]),
+            ))
+        return photos
+
+    def touch(self, id, when=None):
+        """Mark the given photo as updated (e.g. to exercise `pics up`)."""
+        photo = self.photo_from_id[id]
+        photo.lastupdate = int(when or time.time())
+
+    def delete(self, id):
+        """Delete the given photo (e.g. to exercise `pics reconcile`)."""
+        photo = self.photo_from_id.pop(id)
+        self.photos.remove(photo)
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        self._random_lock.acquire()
+        try:
+            return self._random.random() < self.error_rate
+        finally:
+            self._random_lock.release()
+
+    def photo_size_bytes(self, photo, suffix, video=False):
+        """The byte size of the given size of a photo: a photo size suffix
+        (e.g. "_m"), or with `video` true, a video size label. (Like
+        Flickr, a video also has photo sizes: stills from the video.)
+        """
+        if video:
+            return self.photo_size * 20
+        return {
+            "_s": 4*1024, "_t": 8*1024, "_m": 20*1024, "": 60*1024,
+            "_z": 100*1024, "_b": 150*1024,
+        }.get(suffix, self.photo_size)
+
+
+
+#---- the HTTP server
+
+class FakeFlickrServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP server for a `FakeFlickr` account."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, flickr, host="127.0.0.1", port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           _FakeFlickrHandler)
+        self.flickr = flickr
+        self._thread = None
+        self._requests = set()
+        self._requests_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    @property
+    def rest_url(self):
+        return self.base_url + "/services/rest/"
+
+    @property
+    def photo_url_template(self):
+        return self.base_url + "/farm%(farm)s/%(server)s/%(id)s_"
+
+    @property
+    def environ(self):
+        """Environment variables that point pics at this server."""
+        return {
+            "PICS_FLICKR_REST_URL": self.rest_url,
+            "PICS_FLICKR_PHOTO_URL": self.photo_url_template,
+            "PICS_FLICKR_API_KEY": "fake",
+            "PICS_FLICKR_SECRET": "fake",
+            "PICS_FLICKR_AUTH_TOKEN": "fake-token",
+        }
+
+    def process_request_thread(self, request, client_address):
+        self._requests_lock.acquire()
+        try:
+            self._requests.add(request)
+        finally:
+            self._requests_lock.release()
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self,
+                request, client_address)
+        finally:
+            self._requests_lock.acquire()
+            try:
+                self._requests.discard(request)
+            finally:
+                self._requests_lock.release()
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is business as usual.
+        exc = sys.exc_info()[1]
+        if isinstance(exc, socket.error):
+            log.debug("fakeflickr: %s: %s", client_address, exc)
+        else:
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="fakeflickr")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # Drop idle keep-alive connections so their threads finish.
+        self._requests_lock.acquire()
+        try:
+            for request in list(self._requests):
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        finally:
+            self._requests_lock.release()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class _FakeFlickrHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeFlickr/1.0"
+    # Send small responses immediately, rather than being held up by
+    # Nagle's algorithm waiting on a delayed ACK.
+    disable_nagle_algorithm = True
+
+    _photo_path_pat = re.compile(
+        r"^/farm(?P<farm>\d+)/(?P<server>\d+)/(?P<id>\d+)_(?P<secret>\w+?)"
+        r"(?P<suffix>_[stmzbo])?(?P<d>_d)?\.(?P<ext>\w+)$")
+    _video_path_pat = re.compile(r"^/video/(?P<id>\d+)/(?P<label>[\w-]+)\.mov$")
+
+    def log_message(self, format, *args):
+        log.debug("fakeflickr: " + format, *args)
+
+    @property
+    def flickr(self):
+        return self.server.flickr
+
+    def _start(self):
+        self.flickr.num_requests += 1
+        if self.flickr.latency:
+            time.sleep(self.flickr.latency)
+
+    def do_GET(self):
+        self._start()
+        path = urlparse.urlparse(self.path)[2]
+        if path.startswith("/services/rest"):
+            args = dict(cgi.parse_qsl(urlparse.urlparse(self.path)[4]))
+            self._handle_rest(args)
+        else:
+            self._handle_static(path)
+
+    def do_POST(self):
+        self._start()
+        length = int(self.headers.get("Content-Length", 0))
+        args = dict(cgi.parse_qsl(self.rfile.read(length)))
+        self._handle_rest(args)
+
+    def _send(self, status, body, content_type="text/xml; charset=utf-8",
+              headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    #---- REST API
+
+    def _handle_rest(self, args):
+        if self.flickr.should_fail():
+            if random.random() < 0.5:
+                self._send(503, "Service Unavailable", "text/plain")
+            else:
+                self._send_fail(105, "Service currently unavailable")
+            return
+        method = args.get("method", "")
+        handler_name = "_api_" + method.replace("flickr.", "", 1)\
+                                       .replace('.', '_')
+        handler = getattr(self, handler_name, None)
+        if handler is None:
+            self._send_fail(112, "Method \"%s\" not found" % method)
+            return
+        try:
+            self._send_ok(handler(args))
+        except _APIError, ex:
+            self._send_fail(ex.code, ex.msg)
+
+    def _send_ok(self, xml):
+        self._send(200, '<?xml version="1.0" encoding="utf-8" ?>\n'
+                        '<rsp stat="ok">\n%s\n</rsp>\n' % xml)
+
+    def _send_fail(self, code, msg):
+        self._send(200, '<?xml version="1.0" encoding="utf-8" ?>\n'
+                        '<rsp stat="fail">\n\t<err code="%d" msg=%s />\n'
+                        '</rsp>\n' % (code, quoteattr(msg)))
+
+    def _photo_from_args(self, args):
+        try:
+            return self.flickr.photo_from_id[args.get("photo_id")]
+        except KeyError:
+            raise _APIError(1, "Photo not found")
+
+    def _api_test_echo(self, args):
+        return ''.join("<%s>%s</%s>" % (k, escape(v), k)
+                       for k, v in sorted(args.items()) if k != "api_sig")
+
+    def _auth_xml(self, token):
+        return ('<auth><token>%s</token><perms>read</perms>'
+                '<user nsid="%s" username=%s fullname="" /></auth>'
+                % (escape(token), self.flickr.nsid,
+                   quoteattr(self.flickr.username)))
+
+    def _api_auth_checkToken(self, args):
+        if not args.get("auth_token"):
+            raise _APIError(98, "Invalid auth token")
+        return self._auth_xml(args["auth_token"])
+
+    def _api_auth_getFrob(self, args):
+        return "<frob>fake-frob</frob>"
+
+    def _api_auth_getToken(self, args):
+        return self._auth_xml("fake-token")
+
+    def _photo_attrs_xml(self, photo, extras):
+        attrs = [
+            ("id", photo.id), ("owner", self.flickr.nsid),
+            ("secret", photo.secret), ("server", photo.server),
+            ("farm", photo.farm), ("title", photo.title),
+            ("ispublic", photo.ispublic), ("isfriend", photo.isfriend),
+            ("isfamily", photo.isfamily),
+        ]
+        if "last_update" in extras:
+            attrs.append(("lastupdate", photo.lastupdate))
+        if "date_taken" in extras:
+            attrs += [("datetaken", photo.taken),
+                      ("datetakengranularity", 0)]
+        if "original_format" in extras:
+            attrs += [("originalsecret", photo.originalsecret),
+                      ("originalformat", photo.originalformat)]
+        if "media" in extras:
+            attrs += [("media", photo.media), ("media_status", "ready")]
+        if "o_dims" in extras:
+            attrs += [("o_width", photo.width), ("o_height", photo.height)]
+        for size_key, suffix in (("sq", "_s"), ("t", "_t"), ("s", "_m"),
+                                 ("m", ""), ("z", "_z"), ("l", "_b"),
+                                 ("o", "_o")):
+            # For a video these are (like on Flickr) the URLs of stills.
+            if "url_" + size_key in extras:
+                attrs.append(("url_" + size_key,
+                              self._photo_url(photo, suffix)))
+        return ' '.join("%s=%s" % (k, quoteattr(str(v))) for k, v in attrs)
+
+    def _api_photos_recentlyUpdated(self, args):
+        min_date = int(args.get("min_date", 0))
+        extras = set((args.get("extras") or "").split(','))
+        per_page = min(500, int(args.get("per_page", 100)))
+        page = int(args.get("page", 1))
+        photos = [p for p in self.flickr.photos if p.lastupdate >= min_date]
+        photos.sort(key=lambda p: (p.lastupdate, p.id))
+        total = len(photos)
+        pages = max(1, (total + per_page - 1) // per_page)
+        items = photos[(page-1)*per_page:page*per_page]
+        return '<photos page="%d" pages="%d" perpage="%d" total="%d">\n%s\n'\
+               '</photos>' % (page, pages, per_page, total,
+                '\n'.join("\t<photo %s />" % self._photo_attrs_xml(p, extras)
+                          for p in items))
+
+    def _api_people_getPhotos(self, args):
+        # Only the authenticated user's photos ("me") are supported.
+        extras = set((args.get("extras") or "").split(','))
+        per_page = min(500, int(args.get("per_page", 100)))
+        page = int(args.get("page", 1))
+        photos = sorted(self.flickr.photos, key=lambda p: -p.posted)
+        total = len(photos)
+        pages = max(1, (total + per_page - 1) // per_page)
+        items = photos[(page-1)*per_page:page*per_page]
+        return '<photos page="%d" pages="%d" perpage="%d" total="%d">\n%s\n'\
+               '</photos>' % (page, pages, per_page, total,
+                '\n'.join("\t<photo %s />" % self._photo_attrs_xml(p, extras)
+                          for p in items))
+
+    def _api_photos_getInfo(self, args):
+        p = self._photo_from_args(args)
+        tags = ''.join('<tag id="%s-%s" author="%s" raw=%s>%s</tag>'
+                       % (p.id, i, self.flickr.nsid, quoteattr(t), escape(t))
+                       for i, t in enumerate(p.tags))
+        return (
+            '<photo id="%(id)s" secret="%(secret)s" server="%(server)s" '
+            'farm="%(farm)s" dateuploaded="%(posted)s" isfavorite="0" '
+            'license="0" rotation="0" originalsecret="%(originalsecret)s" '
+            'originalformat="%(originalformat)s" views="0" '
+            'media="%(media)s">' % p.__dict__
+            + '<owner nsid="%s" username=%s realname="" location="" />'
+              % (self.flickr.nsid, quoteattr(self.flickr.username))
+            + '<title>%s</title>' % escape(p.title)
+            + '<description>%s</description>' % escape(p.description)
+            + '<visibility ispublic="%(ispublic)s" isfriend="%(isfriend)s" '
+              'isfamily="%(isfamily)s" />' % p.__dict__
+            + '<dates posted="%(posted)s" taken="%(taken)s" '
+              'takengranularity="0" lastupdate="%(lastupdate)s" />'
+              % p.__dict__
+            + '<editability cancomment="0" canaddmeta="0" />'
+            + '<comments>%d</comments>' % p.num_comments
+            + '<notes />'
+            + '<tags>%s</tags>' % tags
+            + '<urls><url type="photopage">http://www.flickr.com/photos/'
+              '%s/%s/</url></urls>' % (self.flickr.username, p.id)
+            + '</photo>')
+
+    def _api_photos_getSizes(self, args):
+        p = self._photo_from_args(args)
+        sizes = []
+        for label, suffix in (("Square", "_s"), ("Thumbnail", "_t"),
+                              ("Small", "_m"), ("Medium", ""),
+                              ("Large", "_b"), ("Original", "_o")):
+            source = self._photo_url(p, suffix)
+            sizes.append('<size label="%s" width="%d" height="%d" '
+                         'source="%s" url="%s" media="photo" />'
+                         % (label, p.width, p.height, source, source))
+        if p.is_video:
+            for label in ("Mobile MP4", "HD MP4", "Video Original"):
+                source = "%s/video/%s/%s.mov" % (self.server.base_url, p.id,
+                    label.lower().replace(' ', '-'))
+                sizes.append('<size label="%s" width="%d" height="%d" '
+                             'source="%s" url="%s" media="video" />'
+                             % (label, p.width, p.height, source, source))
+        return '<sizes canblog="0" canprint="0" candownload="1">%s</sizes>' \
+               % ''.join(sizes)
+
+    def _api_photos_comments_getList(self, args):
+        p = self._photo_from_args(args)
+        comments = ''.join(
+            '<comment id="%s-%d" author="%s" authorname="friend%d" '
+            'datecreate="%s" permalink="">Comment %d</comment>'
+            % (p.id, i, self.flickr.nsid, i, p.lastupdate, i)
+            for i in range(p.num_comments))
+        return '<comments photo_id="%s">%s</comments>' % (p.id, comments)
+
+    #---- static photo hosts
+
+    def _photo_url(self, photo, suffix):
+        url = self.server.photo_url_template % photo.__dict__
+        if suffix == "_o":
+            url += photo.originalsecret + suffix
+            ext = '.' + photo.originalformat
+        else:
+            url += photo.secret + suffix
+            ext = ".jpg"
+        if photo.originalsecret != photo.secret:
+            url += "_d"
+        return url + ext
+
+    def _handle_static(self, path):
+        match = self._photo_path_pat.match(path) \
+                or self._video_path_pat.match(path)
+        photo = match and self.flickr.photo_from_id.get(match.group("id"))
+        if photo is None:
+            self._send(404, "Not Found", "text/plain")
+            return
+        video = "label" in match.groupdict()
+        if video and not photo.is_video:
+            self._send(404, "Not Found", "text/plain")
+            return
+        if not video:
+            suffix = match.group("suffix") or ""
+            secret = (suffix == "_o" and photo.originalsecret
+                      or photo.secret)
+            if match.group("secret") != secret:
+                self._send(404, "Not Found", "text/plain")
+                return
+        else:
+            suffix = match.group("label")
+        if self.flickr.should_fail():
+            self._send(503, "Service Unavailable", "text/plain")
+            return
+
+        size = self.flickr.photo_size_bytes(photo, suffix, video)
+        start, end = 0, size - 1
+        status = 200
+        etag = '"%s-%s%s"' % (photo.id, photo.secret, suffix)
+        headers = {"Accept-Ranges": "bytes", "ETag": etag}
+        range_match = re.match(r"bytes=(\d+)-(\d*)$",
+                               self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if range_match and (if_range is None or if_range == etag):
+            start = int(range_match.group(1))
+            if range_match.group(2):
+                end = min(end, int(range_match.group(2)))
+            if start > end:
+                self._send(416, "Requested Range Not Satisfiable",
+                           "text/plain",
+                           {"Content-Range": "bytes */%d" % size})
+                return
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+
+        self.send_response(status)
+        self.send_header("Content-Type",
+                         video and "video/quicktime" or "image/jpeg")
+        self.send_header("Content-Length", str(end - start + 1))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._write_photo_bytes(photo, start, end + 1)
+
+    def _write_photo_bytes(self, photo, start, end):
+        # Deterministic content, so re-downloads and ranges agree.
+        pattern = (photo.id + photo.secret) * 64
+        chunk_size = 16*1024
+        bandwidth = self.flickr.bandwidth
+        pos = start
+        while pos < end:
+            n = min(chunk_size, end - pos)
+            offset = pos % len(pattern)
+            data = (pattern * (2 + n // len(pattern)))[offset:offset+n]
+            t = time.time()
+            self.wfile.write(data)
+            pos += n
+            if bandwidth:
+                delay = float(n) / bandwidth - (time.time() - t)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class _APIError(Exception):
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+        self.msg = msg
+
+
+
+#---- mainline
+
+def main(argv=sys.argv):
+    import optparse
+    usage = "usage: %prog [OPTIONS...] [PORT]"
+    parser = optparse.OptionParser(prog="fakeflickr", usage=usage,
+        description="Serve a stand-in Flickr API and photo hosts.")
+    parser.add_option("--host", default="127.0.0.1",
+        help="interface to listen on (default 127.0.0.1)")
+    parser.add_option("-n", "--photos", type="int", default=100,
+        help="number of photos in the account (default 100)")
+    parser.add_option("--video-ratio", type="float", default=0.05,
+        help="fraction of photos that are videos (default 0.05)")
+    parser.add_option("--photo-size", type="int", default=200*1024,
+        help="size in bytes of an original photo (default 200KB)")
+    parser.add_option("-l", "--latency", type="float", default=0.0,
+        help="seconds of latency added to each request (default 0)")
+    parser.add_option("-b", "--bandwidth", type="int",
+        help="max bytes/sec for each photo download (default no limit)")
+    parser.add_option("-e", "--error-rate", type="float", default=0.0,
+        help="fraction of requests that fail transiently (default 0)")
+    parser.add_option("--seed", type="int", default=0,
+        help="seed for generating the account (default 0)")
+    parser.add_option("-v", "--verbose", dest="log_level",
+        action="store_const", const=logging.DEBUG,
+        help="log each request")
+    parser.set_defaults(log_level=logging.INFO)
+    opts, args = parser.parse_args(argv[1:])
+    logging.basicConfig(format="%(name)s: %(message)s")
+    log.setLevel(opts.log_level)
+    port = args and int(args[0]) or 8080
+
+    flickr = FakeFlickr(num_photos=opts.photos,
+        video_ratio=opts.video_ratio, photo_size=opts.photo_size,
+        latency=opts.latency, bandwidth=opts.bandwidth,
+        error_rate=opts.error_rate, seed=opts.seed)
+    server = FakeFlickrServer(flickr, opts.host, port)
+    print "Serving %d fake photos for flickr://%s/ at %s" % (
+        opts.photos, flickr.username, server.base_url)
+    print "Point pics at it with:"
+    for name, value in sorted(server.environ.items()):
+        print "  export %s='%s'" % (name, value)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
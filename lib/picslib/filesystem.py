@@ -3,7 +3,7 @@
 """A light class the wraps file-system operations by the WorkingCopy class."""
 
 import sys
-from os.path import exists
+from os.path import exists, join
 import os
 from glob import glob
 
@@ -101,7 +101,7 @@ class FileSystem(object):
                         raise
             elif os.path.isdir(path):
                 for f in os.listdir(path):
-                    rm(join(path, f))
+                    self.rm(join(path, f), log=log)
                 os.rmdir(path)
             else:
                 raise OSError(2, "No such file or directory", path)
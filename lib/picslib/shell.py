@@ -9,6 +9,7 @@ import logging
 from pprint import pprint
 import re
 import time
+import signal
 import datetime
 import webbrowser
 
@@ -24,6 +25,7 @@ from picslib.errors import PicsError
 from picslib import simpleflickrapi
 from picslib import utils
 from picslib.workingcopy import WorkingCopy, wcs_from_paths
+from picslib.blobstore import BlobStore, default_blob_store_dir
 
 
 log = logging.getLogger("pics")
@@ -172,13 +174,26 @@ class PicsShell(cmdln.Cmdln):
              "or just for testing 'pics'.")
     @cmdln.option("-s", "--size", default="original",
         help="Specify a photo size to download. Valid values are 'small', "
-             "'medium', and 'original' (default)")
+             "'medium', and 'original' (default). Separate multiple sizes "
+             "with commas (e.g. 'small,original') to download each photo "
+             "in each size.")
     @cmdln.option("-p", "--permission", default="all",
         help="Photo permissions to retrieve. Valid values:\n"
              "  'all' (default) all photos,\n"
              "  'family' only photos that family would see,\n"
              "  'friend' only photos that friends would see,\n"
              "  'public' only public photos")
+    @cmdln.option("-j", "--jobs", type="int",
+        help="Number of photos to fetch concurrently (default %d)."
+             % WorkingCopy.update_jobs)
+    @cmdln.option("--limit-rate", metavar="RATE",
+        help="Limit the download rate, in bytes/s (e.g. '500k'; must be "
+             "more than zero). See `pics help update' for time of day "
+             "limits.")
+    @cmdln.option("--blob-store", metavar="DIR",
+        help="Share downloaded photo files with other working copies "
+             "through the blob store in DIR (e.g. '%s'). See "
+             "`pics help gc'." % utils.nicepath(default_blob_store_dir))
     @cmdln.alias("co")
     def do_checkout(self, subcmd, opts, url, path=None):
         """${cmd_name}: Checkout a working copy of photos
@@ -211,17 +226,29 @@ class PicsShell(cmdln.Cmdln):
             base_date = datetime.date(t.year, t.month, t.day)
         size = opts.size or "original"
         wc = WorkingCopy.create(path, repo_type, repo_user, base_date, size,
-            opts.permission)
-        wc.update()
+            opts.permission, opts.blob_store)
+        wc.limit_download_rate(opts.limit_rate)
+        wc.update(jobs=opts.jobs)
 
     @cmdln.alias("ls")
     @cmdln.option("-s", dest="format", default="long",
                   action="store_const", const="short",
                   help="use a short listing format")
     @cmdln.option("--format", default="long",
-                  help="specify output format: short, long (default), dict")
+                  help="specify output format: short, long (default), "
+                       "json (an object per line), tsv, dict")
     @cmdln.option("-t", "--tags", action="store_true", default=False,
                   help="list tags as well")
+    @cmdln.option("--sort", default="taken",
+                  help="sort by: taken (default), lastupdate, id")
+    @cmdln.option("-r", "--reverse", action="store_true", default=False,
+                  help="reverse the sort order")
+    @cmdln.option("--taken", metavar="DATE[..DATE]",
+                  help="only list photos taken on the given date (YYYY, "
+                       "YYYY-MM or YYYY-MM-DD) or in the given date range")
+    @cmdln.option("--visibility",
+                  help="only list photos with the given visibility: "
+                       "public, private, friend, family")
     def do_list(self, subcmd, opts, *target):
         """${cmd_name}: List photo entries.
 
@@ -229,6 +256,8 @@ class PicsShell(cmdln.Cmdln):
         ${cmd_option_list}
         """
         targets = target or [os.curdir]
+        wcs = []
+        paths_from_wc = {}
         for wc, path in wcs_from_paths(targets):
             if wc is None:
                 if isdir(path):
@@ -236,8 +265,54 @@ class PicsShell(cmdln.Cmdln):
                 else:
                     log.error("'%s' is not in a working copy", path)
                 break
-            else:
-                wc.list([path], format=opts.format, tags=opts.tags)
+            if wc not in paths_from_wc:
+                wcs.append(wc)
+                paths_from_wc[wc] = []
+            paths_from_wc[wc].append(path)
+        for wc in wcs:
+            wc.list(paths_from_wc[wc], format=opts.format, tags=opts.tags,
+                    sort=opts.sort, reverse=opts.reverse, taken=opts.taken,
+                    visibility=opts.visibility)
+
+    @cmdln.option("-C", "--dir", default=os.curdir,
+                  help="search the working copy containing DIR (default "
+                       "is the current dir)")
+    @cmdln.option("-l", "--long", action="store_true", default=False,
+                  help="also print the photo titles")
+    def do_find(self, subcmd, opts, *query):
+        """${cmd_name}: Search for photos in the working copy.
+
+        ${cmd_usage}
+        ${cmd_option_list}
+        Free text terms are matched (as whole words) against the photo
+        titles, descriptions, tags and comments. End a term with '*' for
+        a prefix match. All terms must match. The following field filters
+        are also supported:
+
+            title:TEXT, desc:TEXT, tag:TEXT, comment:TEXT
+                                Match TEXT against just that field.
+            taken:DATE          Taken on DATE (YYYY, YYYY-MM or YYYY-MM-DD).
+            taken:DATE..DATE    Taken in the given date range (inclusive).
+                                Either end may be omitted.
+            media:photo, media:video
+            is:public, is:private, is:friend, is:family
+            id:ID
+
+        Examples:
+            pics find sunset 'tag:beach'
+            pics find taken:2009-01..2009-03 media:video
+            pics find 'desc:new york' is:public
+        """
+        for wc, path in wcs_from_paths([opts.dir]):
+            if wc is None:
+                log.error("'%s' is not in a working copy", path)
+                break
+            for path, title in wc.find(query):
+                if opts.long:
+                    print "%s  [%s]" % (path,
+                        utils.one_line_summary_from_text(title or '', 40))
+                else:
+                    print path
 
     def do_info(self, subcmd, opts, *target):
         """${cmd_name}: Display info about a photo.
@@ -290,6 +365,28 @@ class PicsShell(cmdln.Cmdln):
     @cmdln.alias("up")
     @cmdln.option("-n", "--dry-run", action="store_true", default=False,
                   help="do a dry-run; just show updates without making changes")
+    @cmdln.option("-j", "--jobs", type="int",
+                  help="number of photos to fetch concurrently (default %d)"
+                       % WorkingCopy.update_jobs)
+    @cmdln.option("-S", "--stats", action="store_true", default=False,
+                  help="print request stats at the end of the update "
+                       "(see `pics help stats')")
+    @cmdln.option("-w", "--watch", action="store_true", default=False,
+                  help="keep running, polling for and applying updates")
+    @cmdln.option("--interval", type="float", metavar="SECS",
+                  help="with --watch, seconds between polls for updates "
+                       "(default %d)" % WorkingCopy.watch_min_interval)
+    @cmdln.option("--max-interval", type="float", metavar="SECS",
+                  help="with --watch, max seconds between polls while idle "
+                       "(default %d)" % WorkingCopy.watch_max_interval)
+    @cmdln.option("--limit-rate", metavar="RATE",
+                  help="limit the download rate, in bytes/s (e.g. '500k', "
+                       "'2M'; must be more than zero), optionally by time "
+                       "of day (see below)")
+    @cmdln.option("--no-cache", dest="cache", action="store_false",
+                  default=True,
+                  help="don't cache API responses (photo info, sizes and "
+                       "comments) in the working copy")
     def do_update(self, subcmd, opts, *path):
         """${cmd_name}: Update working copy with recent changes on flickr.
 
@@ -299,13 +396,132 @@ class PicsShell(cmdln.Cmdln):
 
         ${cmd_usage}
         ${cmd_option_list}
+        With --watch, pics keeps running (e.g. instead of a cron job),
+        polling for updates every --interval seconds. The interval doubles,
+        up to --max-interval, while there are no updates. SIGINT (Ctrl+C)
+        or SIGTERM stops it cleanly, after the photo being updated. A
+        second signal aborts immediately (the update is resumed next
+        time).
+
+        Photos are updated newest first, and downloaded ahead of videos.
+        With --limit-rate, the total download rate is limited. The limit
+        can vary by time of day: give a comma-separated list of
+        RATE@HH:MM-HH:MM (local time) windows and a RATE for other times
+        (or none for no limit). A RATE of zero is an error: leave the
+        limit out instead. For example, to limit downloads to
+        200KB/s during the day and 2MB/s at night:
+
+            pics up --watch --limit-rate 200k@08:00-18:00,2M
         """
         paths = path or [os.curdir]
+        if opts.watch:
+            wcs = [wc for wc, p in wcs_from_paths(paths[:1])]
+            if wcs[0] is None:
+                raise PicsError("'%s' is not in a working copy" % paths[0])
+            wcs[0].limit_download_rate(opts.limit_rate)
+            wcs[0].use_api_cache = opts.cache
+            self._watch(wcs[0], opts)
+            return
         for wc, path in wcs_from_paths(paths):
             if wc is None:
                 log.info("skipped '%s'", path)
             else:
-                wc.update(dry_run=opts.dry_run)
+                wc.limit_download_rate(opts.limit_rate)
+                wc.use_api_cache = opts.cache
+                wc.update(dry_run=opts.dry_run, jobs=opts.jobs)
+                if opts.stats:
+                    print wc.stats.summary()
+
+    def _watch(self, wc, opts):
+        def on_signal(signum, frame):
+            if wc.stopping:
+                raise KeyboardInterrupt
+            log.info("stopping (signal %d) ...", signum)
+            wc.stop()
+        signums = [signal.SIGINT, signal.SIGTERM]
+        old_handlers = [signal.signal(s, on_signal) for s in signums]
+        try:
+            wc.watch(jobs=opts.jobs, min_interval=opts.interval,
+                     max_interval=opts.max_interval)
+        finally:
+            for signum, handler in zip(signums, old_handlers):
+                signal.signal(signum, handler)
+
+    @cmdln.option("--remove", action="store_true", default=False,
+                  help="remove the vanished photos from the working copy")
+    def do_reconcile(self, subcmd, opts, *path):
+        """${cmd_name}: Find photos deleted on flickr.
+
+        `pics update' only hears about changed photos, so photos deleted
+        on flickr (or made invisible with the working copy's permission)
+        stay in the working copy. This lists all the ids of your photos
+        on flickr to find them, and with --remove, removes them. This is
+        quick enough to run, say, weekly even for very large accounts.
+
+        ${cmd_usage}
+        ${cmd_option_list}
+        """
+        paths = path or [os.curdir]
+        for wc, path in wcs_from_paths(paths):
+            if wc is None:
+                log.error("'%s' is not in a working copy", path)
+                break
+            ids = wc.reconcile(remove=opts.remove)
+            if not ids:
+                log.info("No photos deleted on flickr.")
+            elif not opts.remove:
+                log.info("%d photo(s) deleted on flickr (use `--remove' "
+                         "to remove them)", len(ids))
+
+    @cmdln.option("-n", "--dry-run", action="store_true", default=False,
+                  help="just show what would be removed")
+    def do_gc(self, subcmd, opts, *dir):
+        """${cmd_name}: Remove unused files from blob stores.
+
+        ${cmd_usage}
+        ${cmd_option_list}
+        A blob store (see `pics checkout --blob-store') keeps a copy of
+        each photo file downloaded by the working copies using it, so
+        other working copies can link to it rather than downloading it
+        again. This removes the files no longer in any of those working
+        copies. The default DIR is '~/.pics/blobs'.
+        """
+        dirs = dir or [default_blob_store_dir]
+        for d in dirs:
+            if not exists(join(d, "blobs.sqlite3")):
+                raise PicsError("`%s' is not a blob store" % d)
+            store = BlobStore(d)
+            try:
+                num_removed, bytes_freed = store.gc(
+                    lambda wc_dir: WorkingCopy(wc_dir).blob_keys(),
+                    dry_run=opts.dry_run)
+            finally:
+                store.close()
+            log.info("%s %d blob(s), %.1f MB",
+                     opts.dry_run and "Would remove" or "Removed",
+                     num_removed, bytes_freed / (1024.0 * 1024.0))
+
+    def do_stats(self, subcmd, opts, *path):
+        """${cmd_name}: Show request stats for the last update.
+
+        For each Flickr API method and photo download host this shows
+        the number of requests, errors, retries and response cache hits,
+        the bytes transferred and the mean, 90th percentile and max
+        request latency.
+
+        ${cmd_usage}
+        ${cmd_option_list}
+        """
+        paths = path or [os.curdir]
+        for wc, path in wcs_from_paths(paths):
+            if wc is None:
+                log.error("'%s' is not in a working copy", path)
+                break
+            stats = wc.last_update_stats()
+            if stats is None:
+                log.info("no stats for '%s': not yet updated", path)
+            else:
+                print stats.summary()
 
     #TODO: some command(s) for editing pic data
     #   - allow batch changes
@@ -331,13 +547,33 @@ class PicsShell(cmdln.Cmdln):
         raise NotImplementedError("diff")
 
     @cmdln.alias("stat", "st")
-    def _do_status(self, subcmd, opts, *path):
-        """${cmd_name}: NYI. Show the status of working files and dirs.
+    def do_status(self, subcmd, opts, *path):
+        """${cmd_name}: Show the status of working files and dirs.
 
         ${cmd_usage}
         ${cmd_option_list}
+        The first column of the output is:
+            M   modified: the file differs from the downloaded photo
+            !   missing
+            ?   not tracked by pics
+
+        Only files whose size, mtime or inode have changed since they were
+        last checked are read.
         """
-        raise NotImplementedError("status")
+        paths = path or [os.curdir]
+        wcs = []
+        paths_from_wc = {}
+        for wc, path in wcs_from_paths(paths):
+            if wc is None:
+                log.error("'%s' is not in a working copy", path)
+                break
+            if wc not in paths_from_wc:
+                wcs.append(wc)
+                paths_from_wc[wc] = []
+            paths_from_wc[wc].append(path)
+        for wc in wcs:
+            for status, path in wc.status(paths_from_wc[wc]):
+                print "%s  %s" % (status, path)
 
     @cmdln.alias("ci")
     def _do_commit(self, subcmd, opts, *path):
@@ -35,16 +35,23 @@ import re
 import warnings
 import threading
 import urllib
+import urlparse
+import httplib
+import socket
 import cPickle as pickle
 import copy
 import types
 import time
+import random
+import sqlite3
+import Queue
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
 import xml.etree.ElementTree as ET # in python >=2.5
+from xml.parsers.expat import ExpatError
 
 
 
@@ -68,6 +75,642 @@ class FlickrAPIError(Exception):
         else:
             return Exception.__str__(self)
 
+class FlickrHTTPError(FlickrAPIError):
+    """A non-200 HTTP response from a Flickr server."""
+    def __init__(self, url, status, reason):
+        FlickrAPIError.__init__(self, "%s: HTTP %s %s" % (url, status, reason))
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+
+
+#---- HTTP connection pooling
+
+class HTTPConnectionPool(object):
+    """A thread-safe pool of persistent HTTP/1.1 connections.
+
+    Idle connections are kept per (scheme, host, port) and reused for
+    subsequent requests to that host, saving a TCP handshake per request.
+
+    Usage:
+        pool = HTTPConnectionPool()
+        rsp = pool.request("POST", url, body, headers)
+        try:
+            data = rsp.read()
+        finally:
+            rsp.close()     # returns the connection to the pool
+
+    @param max_size {int} Max number of idle connections to keep per
+        host. Default 4.
+    @param idle_timeout {float} Number of seconds after which an idle
+        connection is dropped rather than reused. Default 30.
+    @param timeout {float} Socket timeout for new connections. Default
+        None (the global socket default).
+    """
+    def __init__(self, max_size=4, idle_timeout=30.0, timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle_from_key = {}  # (scheme, host, port) -> [(conn, t), ...]
+
+    def __repr__(self):
+        return "<HTTPConnectionPool max_size=%d idle_timeout=%r>" % (
+            self.max_size, self.idle_timeout)
+
+    def _new_conn(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        if self.timeout is None:
+            return conn_class(host, port)
+        return conn_class(host, port, timeout=self.timeout)
+
+    def _get_conn(self, key):
+        """Return (<conn>, <is-reused>) for the given host key."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            idle = self._idle_from_key.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        finally:
+            self._lock.release()
+        return self._new_conn(key), False
+
+    def _put_conn(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle_from_key.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle_from_key = self._idle_from_key
+            self._idle_from_key = {}
+        finally:
+            self._lock.release()
+        for idle in idle_from_key.values():
+            for conn, last_used in idle:
+                conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Make an HTTP request and return a `PooledResponse`.
+
+        The response must be closed (or fully read) to release its
+        connection back to the pool.
+        """
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+        if ':' in netloc:
+            host, port = netloc.split(':', 1)
+            port = int(port)
+        else:
+            host, port = netloc, (scheme == "https" and 443 or 80)
+        key = (scheme, host, port)
+        selector = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+        headers = dict(headers or {})
+
+        started = time.time()
+        while True:
+            conn, reused = self._get_conn(key)
+            try:
+                conn.request(method, selector, body, headers)
+                rsp = conn.getresponse()
+            except (httplib.HTTPException, socket.error), ex:
+                conn.close()
+                if reused:
+                    # The server likely dropped this idle keep-alive
+                    # connection. Retry on a fresh one.
+                    log.debug("stale pooled connection to %s:%s (%s): "
+                              "retrying", host, port, ex)
+                    continue
+                raise
+            return PooledResponse(self, key, conn, rsp, url, started)
+
+class PooledResponse(object):
+    """An HTTP response whose connection is released to its pool on close.
+
+    If the body was not completely read the connection is closed instead.
+
+    `started` is the time the request was sent and `bytes_read` the
+    number of body bytes read so far.
+    """
+    def __init__(self, pool, key, conn, rsp, url, started=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._rsp = rsp
+        self.url = url
+        self.started = started or time.time()
+        self.bytes_read = 0
+        self.status = rsp.status
+        self.reason = rsp.reason
+        self.msg = rsp.msg
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def read(self, amt=None):
+        if self._rsp is None:
+            return ''
+        data = self._rsp.read(amt)
+        self.bytes_read += len(data)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def close(self):
+        rsp, conn = self._rsp, self._conn
+        if rsp is None:
+            return
+        self._rsp = self._conn = None
+        if rsp.isclosed() and not rsp.will_close:
+            self._pool._put_conn(self._key, conn)
+        else:
+            conn.close()
+
+# The process-wide pool used by `SimpleFlickrAPI` instances by default.
+default_http_pool = HTTPConnectionPool()
+
+
+
+#---- rate limiting and retries
+
+class TokenBucket(object):
+    """A thread-safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second, up to `capacity`. Each request
+    takes a token, blocking until one is available.
+
+    @param rate {float} Number of tokens added per second.
+    @param capacity {int} The max number of tokens in the bucket, i.e.
+        the largest burst of requests allowed.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<TokenBucket rate=%r capacity=%r>" % (self.rate, self.capacity)
+
+    def reserve(self, tokens=1):
+        """Take the given number of tokens without blocking.
+
+        @returns {float} The number of seconds the caller must wait before
+            using the tokens (0 if they were available).
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self.capacity,
+                self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+        finally:
+            self._lock.release()
+
+    def acquire(self, tokens=1):
+        """Take the given number of tokens, sleeping as necessary."""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            log.debug("rate limited: sleeping %.2fs", delay)
+            time.sleep(delay)
+
+# The process-wide rate limiter shared by all `SimpleFlickrAPI` instances
+# by default. Flickr allows 3600 queries per hour per API key. Any hour
+# can see a full bucket plus an hour's refill, so the refill rate leaves
+# room for the (small) burst.
+_api_burst = 30
+default_rate_limiter = TokenBucket(rate=(3600 - _api_burst) / 3600.0,
+                                   capacity=_api_burst)
+
+# Flickr API error codes that indicate a transient failure:
+#   0   Sorry, the Flickr API service is not currently available.
+#   105 Service currently unavailable.
+#   106 Write operation failed.
+_RETRYABLE_API_ERROR_CODES = (0, 105, 106)
+_RETRYABLE_HTTP_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Errors parsing a response. A response body cut short (e.g. by a
+# connection closed mid-response) fails to parse.
+_xml_parse_errors = (SyntaxError, ExpatError)   # ET.ParseError < SyntaxError
+
+# The exceptions from making a call that `is_retryable_error` classifies.
+_retryable_call_errors = (FlickrAPIError, socket.error,
+                          httplib.HTTPException) + _xml_parse_errors
+
+def is_retryable_error(ex):
+    """Return True iff the given exception from a Flickr API call is
+    likely transient, i.e. the call is worth retrying.
+    """
+    if isinstance(ex, FlickrHTTPError):
+        return ex.status in _RETRYABLE_HTTP_STATUSES
+    elif isinstance(ex, FlickrAPIError):
+        return ex.code in _RETRYABLE_API_ERROR_CODES
+    elif isinstance(ex, (socket.error, httplib.HTTPException)):
+        return True
+    elif isinstance(ex, _xml_parse_errors):
+        return True     # most likely a truncated response
+    return False
+
+
+
+#---- instrumentation
+
+class RequestStats(object):
+    """Thread-safe counters of the requests made, per Flickr API method
+    and per download host.
+
+    Each is keyed by (<kind>, <name>), e.g. ("api", "flickr.photos.getInfo")
+    or ("download", "farm4.static.flickr.com").
+
+    Usage:
+        stats = RequestStats()
+        api = SimpleFlickrAPI(api_key, secret, stats=stats)
+        ...
+        print stats.summary()
+        entry = stats.get("api", "flickr.photos.getInfo")
+        print entry.requests, entry.mean_time, entry.percentile(0.9)
+    """
+    # Upper bounds (in seconds) of the latency histogram buckets. The
+    # last bucket (for slower requests) is unbounded.
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry_from_key = {}
+
+    def __repr__(self):
+        return "<RequestStats: %d keys>" % len(self._entry_from_key)
+
+    def __getstate__(self):
+        return {"_entry_from_key": self.entries_by_key()}
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _entry(self, kind, name):
+        # Must be called with the lock held.
+        key = (kind, name)
+        entry = self._entry_from_key.get(key)
+        if entry is None:
+            entry = self._entry_from_key[key] \
+                = RequestStatsEntry(kind, name, self.latency_buckets)
+        return entry
+
+    def record(self, kind, name, latency, nbytes=0, error=False):
+        """Record a completed (or failed) request.
+
+        @param latency {float} Seconds from sending the request to having
+            read the whole response.
+        @param nbytes {int} Number of response body bytes.
+        @param error {bool} Whether the request failed.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entry(kind, name)
+            entry.requests += 1
+            entry.bytes += nbytes
+            if error:
+                entry.errors += 1
+            entry.total_time += latency
+            entry.max_time = max(entry.max_time, latency)
+            for i, bound in enumerate(entry.buckets):
+                if latency <= bound:
+                    break
+            else:
+                i = len(entry.buckets)
+            entry.histogram[i] += 1
+        finally:
+            self._lock.release()
+
+    def record_retry(self, kind, name):
+        self._lock.acquire()
+        try:
+            self._entry(kind, name).retries += 1
+        finally:
+            self._lock.release()
+
+    def record_cache_hit(self, kind, name):
+        self._lock.acquire()
+        try:
+            self._entry(kind, name).cache_hits += 1
+        finally:
+            self._lock.release()
+
+    def get(self, kind, name):
+        """Return a copy of the `RequestStatsEntry` for the given key, or
+        None if nothing has been recorded for it.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entry_from_key.get((kind, name))
+            return entry and copy.deepcopy(entry)
+        finally:
+            self._lock.release()
+
+    def entries_by_key(self):
+        """Return a dict of copies of all entries, keyed by (kind, name)."""
+        self._lock.acquire()
+        try:
+            return copy.deepcopy(self._entry_from_key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entry_from_key = {}
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """Return a table of the stats, one line per key, suitable for
+        printing.
+        """
+        entries = self.entries_by_key().values()
+        if not entries:
+            return "no requests"
+        lines = []
+        template = "%-32s %6s %5s %5s %5s %9s %7s %7s %7s"
+        for kind, heading in (("api", "API method"),
+                              ("download", "download host")):
+            kind_entries = sorted((e for e in entries if e.kind == kind),
+                                  key=lambda e: -e.total_time)
+            if not kind_entries:
+                continue
+            if lines:
+                lines.append("")
+            lines.append(template % (heading, "reqs", "errs", "retry",
+                "hits", "bytes", "mean", "p90", "max"))
+            for e in kind_entries:
+                lines.append(template % (e.name[-32:], e.requests, e.errors,
+                    e.retries, e.cache_hits, _human_size(e.bytes),
+                    "%.2fs" % e.mean_time, "%.2fs" % e.percentile(0.9),
+                    "%.2fs" % e.max_time))
+        return '\n'.join(lines)
+
+class RequestStatsEntry(object):
+    """The stats for one Flickr API method or download host."""
+    def __init__(self, kind, name, buckets):
+        self.kind = kind
+        self.name = name
+        self.buckets = buckets
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # Number of requests per latency bucket (see `buckets`), plus
+        # one for those slower than the last bound.
+        self.histogram = [0] * (len(buckets) + 1)
+
+    def __repr__(self):
+        return "<RequestStatsEntry %s %s: %d requests>" % (
+            self.kind, self.name, self.requests)
+
+    @property
+    def mean_time(self):
+        if not self.requests:
+            return 0.0
+        return self.total_time / self.requests
+
+    def percentile(self, p):
+        """Return an (upper bound) estimate of the given latency
+        percentile, e.g. `entry.percentile(0.5)` for the median.
+        """
+        needed = p * self.requests
+        count = 0
+        for bound, n in zip(self.buckets, self.histogram):
+            count += n
+            if n and count >= needed:
+                return min(bound, self.max_time)
+        return self.max_time
+
+# The process-wide stats used by `SimpleFlickrAPI` instances by default.
+default_request_stats = RequestStats()
+
+
+
+#---- coalescing of identical in-flight calls
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key.
+
+    The first caller for a key does the work. Other callers arriving
+    while it is in progress wait for and share its result (or error),
+    so only one request goes over the wire.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flight_from_key = {}
+
+    def do(self, key, func):
+        """Return `func()`, or the result of an in-progress call of the
+        function for the same key.
+        """
+        self._lock.acquire()
+        try:
+            flight = self._flight_from_key.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flight_from_key[key] = _Flight()
+        finally:
+            self._lock.release()
+
+        if leader:
+            try:
+                flight.value = func()
+            except:
+                flight.exc_info = sys.exc_info()
+            self._lock.acquire()
+            try:
+                del self._flight_from_key[key]
+            finally:
+                self._lock.release()
+            flight.event.set()
+        else:
+            while not flight.event.isSet():
+                # Use a timeout so a KeyboardInterrupt can get through.
+                flight.event.wait(1.0)
+
+        if flight.exc_info is not None:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.value
+
+class _Flight(object):
+    value = None
+    exc_info = None
+    def __init__(self):
+        self.event = threading.Event()
+
+# The process-wide `SingleFlight` used by `SimpleFlickrAPI` instances.
+default_single_flight = SingleFlight()
+
+
+
+#---- response caching
+
+class ResponseCache(object):
+    """An on-disk (sqlite) cache of raw XML responses for read-only Flickr
+    API methods.
+
+    Entries are keyed by method name plus the normalized call arguments
+    and an optional "version" value supplied by the caller (e.g. the
+    photo's `lastupdate`, so that a changed photo is a cache miss). Each
+    cacheable method has its own TTL. When the cache grows beyond
+    `max_size` bytes, the least recently used entries are evicted.
+
+    @param path {str} Path to the sqlite database file.
+    @param ttl_from_method {dict} Mapping of method name to TTL (in
+        seconds) for the methods to cache. Default is
+        `default_ttl_from_method`.
+    @param max_size {int} Max total size (in bytes) of cached responses.
+        Default 100MB.
+    """
+    # Idempotent methods whose responses can be cached.
+    default_ttl_from_method = {
+        "flickr.photos.getInfo": 24*60*60,
+        "flickr.photos.getSizes": 24*60*60,
+        "flickr.photos.comments.getList": 24*60*60,
+    }
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS response (
+            key TEXT PRIMARY KEY,
+            method TEXT,
+            rsp BLOB,
+            size INTEGER,
+            created REAL,
+            accessed REAL
+        );
+        CREATE INDEX IF NOT EXISTS response_accessed ON response(accessed);
+    """
+
+    def __init__(self, path, ttl_from_method=None, max_size=100*1024*1024):
+        self.path = path
+        if ttl_from_method is None:
+            ttl_from_method = self.default_ttl_from_method
+        self.ttl_from_method = ttl_from_method
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        d = dirname(path)
+        if d and not exists(d):
+            os.makedirs(d)
+        self._cx = sqlite3.connect(path, isolation_level=None,
+                                   check_same_thread=False)
+        self._cx.text_factory = str
+        self._cx.execute("PRAGMA synchronous=OFF")
+        self._cx.executescript(self.schema)
+        self._size = self._cx.execute(
+            "SELECT total(size) FROM response").fetchone()[0]
+
+    def __repr__(self):
+        return "<ResponseCache %s>" % self.path
+
+    def is_cacheable(self, method):
+        return method in self.ttl_from_method
+
+    def key(self, method, args, version=None):
+        """Return the cache key for a call of the given method and args."""
+        parts = [method, str(version)]
+        for k, v in sorted(args.items()):
+            if v is not None and k != "api_sig":
+                parts.append("%s=%s" % (k, v))
+        return md5('&'.join(parts)).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for the given key, or None."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            row = self._cx.execute(
+                "SELECT method, rsp, size, created FROM response WHERE key=?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            method, rsp, size, created = row
+            if now - created > self.ttl_from_method.get(method, 0):
+                self._cx.execute("DELETE FROM response WHERE key=?", (key,))
+                self._size -= size
+                return None
+            self._cx.execute("UPDATE response SET accessed=? WHERE key=?",
+                             (now, key))
+            return str(rsp)
+        finally:
+            self._lock.release()
+
+    def put(self, key, method, rsp):
+        """Cache the given raw response."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._cx.execute("INSERT OR REPLACE INTO response "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, method, sqlite3.Binary(rsp), len(rsp),
+                              now, now))
+            self._size += len(rsp)
+            if self._size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        """Drop least recently used entries until at 90% of `max_size`."""
+        target = self.max_size * 0.9
+        cu = self._cx.execute(
+            "SELECT key, size FROM response ORDER BY accessed")
+        keys = []
+        size = self._cx.execute(
+            "SELECT total(size) FROM response").fetchone()[0]
+        for key, key_size in cu:
+            if size <= target:
+                break
+            keys.append((key,))
+            size -= key_size
+        cu.close()
+        log.debug("response cache: evicting %d entries", len(keys))
+        self._cx.executemany("DELETE FROM response WHERE key=?", keys)
+        self._size = size
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cx.execute("DELETE FROM response")
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._cx.close()
+
+_ok_rsp_pat = re.compile(r'<rsp\s+stat="ok"')
+
+
 
 #---- the raw Flickr API
 
@@ -79,20 +722,42 @@ class AuthTokenMixin(object):
     (Derived from beej's FlickrAPI module.)
     """
     auth_token = None
+    # Number of seconds for which a validated cached token is trusted
+    # without another `flickr.auth.checkToken` call. If a signed call
+    # fails with an invalid token error, the token is revalidated anyway.
+    auth_token_check_interval = 24*60*60
+
+    _auth_perms = None  # the perms of `auth_token`, if from `get_auth_token`
 
     _lock = threading.Lock()
+    # Held while getting a new auth token after one is rejected, so that
+    # concurrent callers run one auth flow between them. The flow's own
+    # calls are made without the rejected token (`_auth_flow.active`).
+    _auth_flow_lock = threading.Lock()
+    _auth_flow = threading.local()
     #TODO: Windows-ify
     _auth_token_cache_path = expanduser("~/.simpleflickrapi/auth_token.cache")
+    # In-process token store, shared by all instances:
+    #   {<cache-path>: {(<api-key>, <perms>): (<token>, <last-validated>)}}
+    _token_cache_from_path = {}
     def _load_token_cache(self):
-        if not exists(self._auth_token_cache_path):
-            return {}
-        f = open(self._auth_token_cache_path, 'rb')
-        try:
-            return pickle.load(f)
-        except EOFError:  # corrupted cache file
-            return {}
-        finally:
-            f.close()
+        path = self._auth_token_cache_path
+        if path in self._token_cache_from_path:
+            return self._token_cache_from_path[path]
+        cache = {}
+        if exists(path):
+            f = open(path, 'rb')
+            try:
+                cache = pickle.load(f)
+            except EOFError:  # corrupted cache file
+                pass
+            finally:
+                f.close()
+        for key, value in cache.items():
+            if isinstance(value, basestring):  # token w/o validation time
+                cache[key] = (value, None)
+        self._token_cache_from_path[path] = cache
+        return cache
     def _save_token_cache(self, cache):
         d = dirname(self._auth_token_cache_path)
         if not exists(d):
@@ -103,20 +768,35 @@ class AuthTokenMixin(object):
         finally:
             f.close()
     def _get_cached_token(self, perms):
+        """Return (<auth-token>, <last-validated-time>) for the given
+        perms. Either may be None.
+        """
         key = (self.api_key, perms)
-        cache = self._load_token_cache()
-        return cache.get(key)
+        self._lock.acquire()
+        try:
+            cache = self._load_token_cache()
+            return cache.get(key, (None, None))
+        finally:
+            self._lock.release()
     def _del_cached_token(self, perms):
         key = (self.api_key, perms)
-        cache = self._load_token_cache()
-        if key in cache:
-            del cache[key]
-        self._save_token_cache(cache)
-    def _set_cached_token(self, perms, auth_token):
+        self._lock.acquire()
+        try:
+            cache = self._load_token_cache()
+            if key in cache:
+                del cache[key]
+            self._save_token_cache(cache)
+        finally:
+            self._lock.release()
+    def _set_cached_token(self, perms, auth_token, validated=None):
         key = (self.api_key, perms)
-        cache = self._load_token_cache()
-        cache[key] = auth_token
-        self._save_token_cache(cache)
+        self._lock.acquire()
+        try:
+            cache = self._load_token_cache()
+            cache[key] = (auth_token, validated)
+            self._save_token_cache(cache)
+        finally:
+            self._lock.release()
 
     def _get_auth_url(self, frob, perms):
         assert perms in ("read", "write", "delete"), \
@@ -131,9 +811,10 @@ class AuthTokenMixin(object):
     def get_auth_token(self, perms="read", exact_perms=True):
         """Get an authorization token.
         
-        First attempts to find one locally cached. If found it is
-        validated with `auth_checkToken()`. If not found, or if invalid,
-        then:
+        First attempts to find one locally cached. If found, and it
+        hasn't been validated in the last `auth_token_check_interval`
+        seconds, it is validated with `auth_checkToken()`. If not found,
+        or if invalid, then:
         
         1. Gets a new frob with `auth_getFrob()`.
         2. Opens the default browser to validate the frob.
@@ -152,10 +833,16 @@ class AuthTokenMixin(object):
             raise FlickrAPIError("'exact_perms == False' not implemented")
 
         # Look for a sufficient auth token in the cache.
-        auth_token = self._get_cached_token(perms)
+        auth_token, validated = self._get_cached_token(perms)
 
         # see if it's valid
-        if auth_token is not None:
+        if auth_token is None:
+            pass
+        elif (validated is not None
+              and time.time() - validated < self.auth_token_check_interval):
+            log.debug("using auth token validated at %s",
+                      time.ctime(validated))
+        else:
             try:
                 rsp = self.call("flickr.auth.checkToken",
                     auth_token=auth_token, 
@@ -164,6 +851,8 @@ class AuthTokenMixin(object):
             except FlickrAPIError:
                 self._del_cached_token(perms)
                 auth_token = None
+            else:
+                self._set_cached_token(perms, auth_token, time.time())
 
         # get a new token if we need one
         if auth_token is None:
@@ -194,11 +883,49 @@ class AuthTokenMixin(object):
             #xpprint(rsp)
             auth_token = rsp[0].find("token").text
             #print "XXX auth_token", auth_token
-            self._set_cached_token(perms, auth_token)
+            self._set_cached_token(perms, auth_token, time.time())
 
         self.auth_token = auth_token    # remember for subsequent API usage
+        self._auth_perms = perms
         return auth_token
 
+    def _revalidate_auth_token(self, rejected_token):
+        """Called when a signed call fails with an invalid auth token
+        error. Drops the cached token and gets a new one.
+
+        @returns {bool} True iff there is a new auth token to retry with.
+        """
+        if (self._auth_perms is None or rejected_token is None
+            or getattr(self._auth_flow, "active", False)):
+            return False
+        self._auth_flow_lock.acquire()
+        try:
+            if self.auth_token != rejected_token:
+                return True     # another thread already got a new one
+            # Re-read the token cache: another instance or process may
+            # have got a new one.
+            self._lock.acquire()
+            try:
+                self._token_cache_from_path.pop(self._auth_token_cache_path,
+                                                None)
+            finally:
+                self._lock.release()
+            auth_token, validated = self._get_cached_token(self._auth_perms)
+            if auth_token is not None and auth_token != rejected_token:
+                self.auth_token = auth_token
+                return True
+            log.info("auth token rejected: getting a new one")
+            if auth_token == rejected_token:
+                self._del_cached_token(self._auth_perms)
+            self._auth_flow.active = True
+            try:
+                self.get_auth_token(self._auth_perms)
+            finally:
+                self._auth_flow.active = False
+            return self.auth_token != rejected_token
+        finally:
+            self._auth_flow_lock.release()
+
 class SimpleFlickrAPI(AuthTokenMixin):
     # What form to return an API response:
     #   etree       ElementTree of XML response (default)
@@ -207,10 +934,50 @@ class SimpleFlickrAPI(AuthTokenMixin):
     # Whether to raise a FlickrAPIError on an error response.
     # This option is only used when `response_format != 'raw'`.
     raise_on_api_error = True
-
-    def __init__(self, api_key=None, secret=None):
+    # Number of pages `paging_call` fetches ahead of its consumer.
+    paging_read_ahead = 4
+    # Retrying of transient failures (see `is_retryable_error`). The
+    # delay before retry N is random in [0, retry_backoff * 2**(N-1)),
+    # capped at `retry_max_delay` seconds.
+    max_retries = 4
+    retry_backoff = 1.0
+    retry_max_delay = 60.0
+    # Coalescing of concurrent identical calls. Set to None to disable.
+    single_flight = default_single_flight
+
+    # The Flickr REST endpoint.
+    rest_url = "http://api.flickr.com/services/rest/"
+
+    def __init__(self, api_key=None, secret=None, http_pool=None,
+                 rate_limiter=None, response_cache=None, stats=None):
+        """
+        @param api_key {str} Your Flickr API key.
+        @param secret {str} The shared secret for that key, used for
+            signing calls.
+        @param http_pool {HTTPConnectionPool} The pool of keep-alive
+            connections to use for API calls. By default the
+            process-wide `default_http_pool` is used.
+        @param rate_limiter {TokenBucket} The rate limiter to use for API
+            calls. By default the process-wide `default_rate_limiter` is
+            used.
+        @param response_cache {ResponseCache} An optional cache for the
+            responses of read-only API methods.
+        @param stats {RequestStats} Where to record request counts,
+            latencies, etc. By default the process-wide
+            `default_request_stats` is used.
+        """
         self.api_key = api_key
         self.secret = secret
+        if http_pool is None:
+            http_pool = default_http_pool
+        self.http_pool = http_pool
+        if rate_limiter is None:
+            rate_limiter = default_rate_limiter
+        self.rate_limiter = rate_limiter
+        self.response_cache = response_cache
+        if stats is None:
+            stats = default_request_stats
+        self.stats = stats
         #TODO: take as arg what response form to use, default 'rest'
 
     def _api_sig_from_args(self, args):
@@ -227,61 +994,272 @@ class SimpleFlickrAPI(AuthTokenMixin):
 
     def raw_unsigned_call(self, method, **kwargs):
         """Call a Flickr API method without signing."""
-        assert '_' not in method, \
-            "%r: illegal method, use the read *dotted* method names" % method
-        assert method.startswith("flickr."), \
-            "%r: illegal method, doesn't start with 'flickr.'" % method
-        url = "http://api.flickr.com/services/rest/"
-        args = dict((k,v) for k,v in kwargs.iteritems() if v is not None)
-        args["method"] = method
-        if "auth_token" not in args and self.auth_token is not None:
-            args["auth_token"] = self.auth_token
-        if "api_key" not in args and self.api_key is not None:
-            args["api_key"] = self.api_key
-        post_data = urllib.urlencode(args) 
-        log.debug("call url: %r", url)
-        log.debug("call post data: %r", post_data)
-        f = urllib.urlopen(url, post_data)
-        try:
-            return f.read()
-        finally:
-            f.close()
+        post_data = self._post_data(method, kwargs, sign=False)
+        return self._post(self.rest_url, post_data, method)
 
     def raw_call(self, method, **kwargs):
         """Call a Flickr API method with signing.
         http://www.flickr.com/services/api/auth.spec.html#signing
         """
+        post_data = self._post_data(method, kwargs)
+        return self._post(self.rest_url, post_data, method)
+
+    def _post_data(self, method, kwargs, sign=True):
+        """Return the (urlencoded) POST data for a call of the given
+        method.
+        """
         assert '_' not in method, \
             "%r: illegal method, use the read *dotted* method names" % method
         assert method.startswith("flickr."), \
             "%r: illegal method, doesn't start with 'flickr.'" % method
-        url = "http://api.flickr.com/services/rest/"
         args = dict((k,v) for k,v in kwargs.iteritems() if v is not None)
         args["method"] = method
-        if "auth_token" not in args and self.auth_token is not None:
+        if ("auth_token" not in args and self.auth_token is not None
+            and not getattr(self._auth_flow, "active", False)):
             args["auth_token"] = self.auth_token
         if "api_key" not in args and self.api_key is not None:
             args["api_key"] = self.api_key
-        args["api_sig"] = self._api_sig_from_args(args) # sign
+        if sign:
+            args["api_sig"] = self._api_sig_from_args(args)
         post_data = urllib.urlencode(args)
-        log.debug("call url: %r", url)
+        log.debug("call url: %r", self.rest_url)
         log.debug("call post data: %r", post_data)
-        f = urllib.urlopen(url, post_data)
+        return post_data
+
+    def _open(self, url, post_data, method=None):
+        """POST the given form data on a pooled connection and return the
+        (unread) `PooledResponse`.
+
+        @param method {str} The API method being called, for `self.stats`.
+        """
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        self.rate_limiter.acquire()
+        started = time.time()
         try:
-            return f.read()
-        finally:
-            f.close()
+            rsp = self.http_pool.request("POST", url, post_data, headers)
+        except (socket.error, httplib.HTTPException):
+            self._record_request(method, started, error=True)
+            raise
+        if rsp.status != 200:
+            rsp.close()
+            self._record_request(method, started, error=True)
+            raise FlickrHTTPError(url, rsp.status, rsp.reason)
+        return rsp
+
+    def _post(self, url, post_data, method=None):
+        """POST the given form data on a pooled connection and return the
+        response body.
+        """
+        rsp = self._open(url, post_data, method)
+        try:
+            try:
+                data = rsp.read()
+            finally:
+                rsp.close()
+        except (socket.error, httplib.HTTPException):
+            self._record_request(method, rsp.started, rsp.bytes_read, True)
+            raise
+        self._record_request(method, rsp.started, rsp.bytes_read,
+                             not _ok_rsp_pat.search(data))
+        return data
+
+    def _record_request(self, method, started, nbytes=0, error=False):
+        self.stats.record("api", method or "(unknown)",
+                          time.time() - started, nbytes, error)
 
     def call(self, method_name_, response_format_=None,
-             raise_on_api_error_=None, **args):
-        rsp = self.raw_call(method_name_, **args)
-        return self._handle_rsp(rsp, response_format=response_format_,
-                                raise_on_api_error=raise_on_api_error_)
+             raise_on_api_error_=None, cache_version_=None, **args):
+        """Call a Flickr API method with signing and handle the response.
+
+        @param cache_version_ {str} Optional. A value that changes when
+            the response would change (e.g. the photo's `lastupdate`).
+            It is made part of the response cache key, if a response
+            cache is being used.
+        """
+        return self._call(self.raw_call, method_name_, response_format_,
+                          raise_on_api_error_, cache_version_, args)
     def unsigned_call(self, method_name_, response_format_=None, 
-                      raise_on_api_error_=None, **args):
-        rsp = self.raw_unsigned_call(method_name_, **args)
-        return self._handle_rsp(rsp, response_format=response_format_,
-                                raise_on_api_error=raise_on_api_error_)
+                      raise_on_api_error_=None, cache_version_=None, **args):
+        return self._call(self.raw_unsigned_call, method_name_,
+                          response_format_, raise_on_api_error_,
+                          cache_version_, args)
+
+    def _call(self, raw_call, method_name, response_format,
+              raise_on_api_error, cache_version, args):
+        auth_token = self.auth_token
+        try:
+            return self._call_once(raw_call, method_name, response_format,
+                                   raise_on_api_error, cache_version, args)
+        except FlickrAPIError, ex:
+            # 98: Invalid auth token. The cached token may have been
+            # revoked since it was last validated.
+            if (ex.code != 98 or args.get("auth_token") is not None
+                or not self._revalidate_auth_token(auth_token)):
+                raise
+            return self._call_once(raw_call, method_name, response_format,
+                                   raise_on_api_error, cache_version, args)
+
+    def _call_once(self, raw_call, method_name, response_format,
+                   raise_on_api_error, cache_version, args):
+        """Make the call and handle the response, retrying transient
+        failures with jittered exponential backoff.
+
+        If an identical call is already in flight (from another thread or
+        `SimpleFlickrAPI` instance), this waits for and shares its
+        response rather than making another request.
+        """
+        cache = self.response_cache
+        cache_key = None
+        if cache is not None and cache.is_cacheable(method_name):
+            key_args = dict(args)
+            if key_args.get("auth_token") is None:
+                key_args["auth_token"] = self.auth_token
+            cache_key = cache.key(method_name, key_args, cache_version)
+            rsp = cache.get(cache_key)
+            if rsp is not None:
+                log.debug("%s: response cache hit", method_name)
+                self.stats.record_cache_hit("api", method_name)
+                return self._handle_rsp(rsp, response_format=response_format,
+                                        raise_on_api_error=raise_on_api_error)
+
+        # The result of handling the response, if made by this thread.
+        results = []
+        def fetch():
+            attempt = 0
+            while True:
+                try:
+                    rsp = raw_call(method_name, **args)
+                    result = self._handle_rsp(rsp,
+                        response_format=response_format,
+                        raise_on_api_error=raise_on_api_error)
+                except _retryable_call_errors, ex:
+                    attempt += 1
+                    if not self._backoff(method_name, ex, attempt):
+                        raise
+                else:
+                    results.append(result)
+                    return rsp
+
+        if self.single_flight is None:
+            rsp = fetch()
+        else:
+            flight_key = (self.rest_url, self.api_key, self.auth_token,
+                raw_call.__name__, method_name, raise_on_api_error,
+                tuple(sorted((k, str(v)) for k, v in args.items()
+                             if v is not None)))
+            rsp = self.single_flight.do(flight_key, fetch)
+        if not results:
+            # Another thread made this identical call: handle its response.
+            log.debug("%s: shared in-flight response", method_name)
+            return self._handle_rsp(rsp, response_format=response_format,
+                                    raise_on_api_error=raise_on_api_error)
+        if cache_key is not None and _ok_rsp_pat.search(rsp):
+            cache.put(cache_key, method_name, rsp)
+        return results[0]
+
+    def _retry_delay(self, method_name, ex, attempt):
+        """Return the number of seconds to wait before retrying a failed
+        call, or None if it should not be retried.
+        """
+        if attempt > self.max_retries or not is_retryable_error(ex):
+            return None
+        delay = random.uniform(0, min(self.retry_max_delay,
+            self.retry_backoff * 2 ** (attempt-1)))
+        log.debug("%s failed (%s): retry %d of %d in %.2fs",
+                  method_name, ex, attempt, self.max_retries, delay)
+        return delay
+
+    def _backoff(self, method_name, ex, attempt):
+        """Sleep before retrying a failed call, if appropriate.
+
+        @returns {bool} False if the call should not be retried.
+        """
+        delay = self._retry_delay(method_name, ex, attempt)
+        if delay is None:
+            return False
+        self.stats.record_retry("api", method_name)
+        time.sleep(delay)
+        return True
+
+    def _iter_call_items(self, method_name, args, raise_on_api_error=None):
+        """Make a signed call and incrementally parse the response as it is
+        read from the socket.
+
+        The first thing yielded is the container element (e.g. <photos>)
+        with its attributes but no children. Then each item element is
+        yielded as soon as it is complete. Items are detached from the
+        response tree once yielded, so memory use stays flat however
+        large the page.
+
+        Failed calls are retried, and a rejected auth token renewed, as
+        for `.call(...)`. Unlike `.call(...)`, the response cache and
+        single-flight coalescing aren't used: the response is consumed
+        as it streams in, and paged listings aren't cacheable anyway.
+
+        @param raise_on_api_error {bool} Optional. If false, an error
+            response ends the items (after logging it) rather than
+            raising. Defaults to `self.raise_on_api_error`.
+        """
+        if raise_on_api_error is None:
+            raise_on_api_error = self.raise_on_api_error
+        auth_token = self.auth_token
+        revalidated = False
+        while True:
+            try:
+                for elem in self._iter_call_items_once(method_name, args):
+                    yield elem
+                return
+            except FlickrHTTPError:
+                raise
+            except FlickrAPIError, ex:
+                # 98: Invalid auth token (see `_call`). An error response
+                # has no items, so nothing has been yielded.
+                if (ex.code == 98 and not revalidated
+                    and args.get("auth_token") is None
+                    and self._revalidate_auth_token(auth_token)):
+                    revalidated = True
+                    continue
+                if raise_on_api_error:
+                    raise
+                log.error("%s: %s", method_name, ex)
+                return
+
+    def _iter_call_items_once(self, method_name, args):
+        """The guts of `_iter_call_items`: make the call, retrying
+        transient failures with jittered exponential backoff, unless
+        items have already been yielded.
+        """
+        attempt = 0
+        yielded_container = False
+        while True:
+            started = False
+            try:
+                rsp = self._open(self.rest_url,
+                                 self._post_data(method_name, args),
+                                 method_name)
+                try:
+                    try:
+                        for i, elem in enumerate(_iter_rsp_items(rsp)):
+                            if i > 0:
+                                started = True
+                            elif yielded_container:
+                                continue    # yielded by an earlier attempt
+                            else:
+                                yielded_container = True
+                            yield elem
+                    except _retryable_call_errors:
+                        self._record_request(method_name, rsp.started,
+                                             rsp.bytes_read, True)
+                        raise
+                    self._record_request(method_name, rsp.started,
+                                         rsp.bytes_read)
+                finally:
+                    rsp.close()
+                return
+            except _retryable_call_errors, ex:
+                attempt += 1
+                if started or not self._backoff(method_name, ex, attempt):
+                    raise
 
     def _handle_rsp(self, rsp, response_format=None, raise_on_api_error=None):
         response_format = response_format or self.response_format
@@ -303,25 +1281,59 @@ class SimpleFlickrAPI(AuthTokenMixin):
                 raise FlickrAPIError("unexpected <rsp> stat: %r" % stat)
 
     def paging_call(self, method_name_, response_format_=None,
-                    raise_on_api_error_=None, **args):
+                    raise_on_api_error_=None, read_ahead_=None, **args):
         """A version of `.call(...)' that handles paging of results for the
         particular Flickr API methods that return pages. Yields each
         individual item.
+
+        Responses are parsed incrementally: each item is yielded as soon
+        as it has been read off the socket. Once the first page has
+        revealed the number of pages, subsequent pages are fetched
+        concurrently, up to `read_ahead_` pages ahead of the consumer.
+        Items are still yielded in page order.
+
+        @param raise_on_api_error_ {bool} Optional. If false, an error
+            response for a page is logged and ends the items from that
+            page rather than raising.
+        @param read_ahead_ {int} Number of pages to prefetch. If not
+            given, `self.paging_read_ahead` is used. Use 1 to fetch pages
+            strictly one after another.
         """
-        page = args.get("page", 1)
-        num_pages = None
-        while num_pages is None or page < num_pages:
+        assert response_format_ in (None, "etree"), \
+            "paging_call only supports the 'etree' response format"
+        if read_ahead_ is None:
+            read_ahead_ = self.paging_read_ahead
+        page = int(args.get("page", 1))
+
+        def iter_page(page):
             log.debug("paging_call: page=%r", page)
-            args["page"] = page
-            rsp = self.call(method_name_, response_format_,
-                            raise_on_api_error_, **args)
-            container = rsp[0]
-            if num_pages is None:
-                num_pages = int(container.get("pages"))
-                log.debug("paging_call: num_pages=%r", num_pages)
-            for item in container:
+            page_args = dict(args)
+            page_args["page"] = page
+            return self._iter_call_items(method_name_, page_args,
+                                         raise_on_api_error_)
+
+        items = iter_page(page)
+        try:
+            try:
+                container = items.next()
+            except StopIteration:
+                return  # an error response (see `raise_on_api_error_`)
+            num_pages = int(container.get("pages"))
+            log.debug("paging_call: num_pages=%r", num_pages)
+            for item in items:
                 yield item
-            page += 1
+        finally:
+            items.close()
+        if page >= num_pages:
+            return
+
+        prefetcher = _PagePrefetcher(iter_page, page+1, num_pages, read_ahead_)
+        try:
+            for page in range(page+1, num_pages+1):
+                for item in prefetcher.iter_page(page):
+                    yield item
+        finally:
+            prefetcher.close()
 
     _handler_cache = None
     def __getattr__(self, name):
@@ -402,6 +1414,136 @@ class SimpleFlickrAPI(AuthTokenMixin):
 
 #---- internal support stuff
 
+def _human_size(nbytes):
+    if nbytes < 1024:
+        return "%dB" % nbytes
+    for unit in ("KB", "MB", "GB"):
+        nbytes /= 1024.0
+        if nbytes < 1024:
+            break
+    return "%.1f%s" % (nbytes, unit)
+
+def _iter_rsp_items(f):
+    """Incrementally parse a Flickr <rsp> from the given file-like object.
+
+    See `SimpleFlickrAPI._iter_call_items` for what is yielded.
+    """
+    depth = 0
+    stat = container = None
+    for event, elem in ET.iterparse(f, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                assert elem.tag == "rsp"
+                stat = elem.get("stat")
+                if stat not in ("ok", "fail"):
+                    raise FlickrAPIError("unexpected <rsp> stat: %r" % stat)
+            elif depth == 2 and stat == "ok":
+                container = elem
+                yield container
+        else:
+            depth -= 1
+            if depth == 1 and stat == "fail":
+                raise FlickrAPIError(elem.get("msg"), int(elem.get("code")))
+            elif depth == 2 and container is not None:
+                container.remove(elem)
+                yield elem
+
+class _PagePrefetcher(object):
+    """Fetch and parse pages `first` to `last` (inclusive) on worker
+    threads and hand back their items in page order.
+
+    `iter_page(page)` must return an iterator that yields the page's
+    container element and then its items. Workers stay at most `window`
+    pages ahead of the page being consumed, so memory use is bounded for
+    long result sets. Items of a page being downloaded are handed over as
+    soon as they are parsed.
+    """
+    _END = object()  # end-of-page marker
+
+    def __init__(self, iter_page, first, last, window):
+        self.iter_page_items = iter_page
+        self.last = last
+        self.window = max(1, window)
+        self._cond = threading.Condition()
+        self._next_page = first     # the next page for a worker to fetch
+        self._wanted_page = first   # the page the consumer is on
+        self._queue_from_page = {}
+        self._closed = False
+        num_workers = min(self.window, last - first + 1)
+        for i in range(num_workers):
+            t = threading.Thread(target=self._worker,
+                                 name="paging_call worker %d" % i)
+            t.setDaemon(True)
+            t.start()
+
+    def _worker(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while (not self._closed and self._next_page <= self.last
+                       and self._next_page >= self._wanted_page + self.window):
+                    self._cond.wait()
+                if self._closed or self._next_page > self.last:
+                    return
+                page = self._next_page
+                self._next_page += 1
+                queue = self._queue_from_page[page] = Queue.Queue()
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+            try:
+                items = self.iter_page_items(page)
+                try:
+                    for i, item in enumerate(items):
+                        if i == 0:
+                            continue    # skip the container element
+                        if self._closed:
+                            return
+                        queue.put((True, item))
+                finally:
+                    items.close()
+                queue.put((True, self._END))
+            except:
+                queue.put((False, sys.exc_info()))
+
+    def iter_page(self, page):
+        """Yield the items of the given page, waiting for them as necessary.
+        Pages must be consumed in order.
+        """
+        self._cond.acquire()
+        try:
+            self._wanted_page = page
+            self._cond.notifyAll()
+            while page not in self._queue_from_page:
+                # Use a timeout so a KeyboardInterrupt can get through.
+                self._cond.wait(1.0)
+            queue = self._queue_from_page.pop(page)
+        finally:
+            self._cond.release()
+
+        while True:
+            try:
+                success, value = queue.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            if not success:
+                raise value[0], value[1], value[2]
+            elif value is self._END:
+                break
+            yield value
+
+    def close(self):
+        """Stop fetching further pages."""
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._queue_from_page.clear()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
 if sys.version_info[:2] == (2, 5):
     _datetime_strptime = datetime.strptime
 else:
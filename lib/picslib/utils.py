@@ -11,7 +11,14 @@ from picslib.errors import PicsError
 
 
 
+# The following can be overridden with environment variables, e.g. to
+# point pics at a stand-in Flickr server (see "picslib/fakeflickr.py"):
+#   PICS_FLICKR_API_KEY, PICS_FLICKR_SECRET, PICS_FLICKR_AUTH_TOKEN,
+#   PICS_FLICKR_REST_URL, PICS_FLICKR_PHOTO_URL
+
 def get_flickr_api_key():
+    if os.environ.get("PICS_FLICKR_API_KEY"):
+        return os.environ["PICS_FLICKR_API_KEY"]
     path = expanduser("~/.flickr/API_KEY")
     try:
         return open(path, 'rb').read().strip()
@@ -19,12 +26,31 @@ def get_flickr_api_key():
         raise PicsError("couldn't determine Flickr API key: %s" % ex)
 
 def get_flickr_secret():
+    if os.environ.get("PICS_FLICKR_SECRET"):
+        return os.environ["PICS_FLICKR_SECRET"]
     path = expanduser("~/.flickr/SECRET")
     try:
         return open(path, 'rb').read().strip()
     except EnvironmentError, ex:
         raise PicsError("couldn't determine Flickr secret: %s" % ex)
 
+def get_flickr_auth_token():
+    """Return a preset Flickr auth token, or None to use the normal
+    (cached) authorization flow.
+    """
+    return os.environ.get("PICS_FLICKR_AUTH_TOKEN") or None
+
+def get_flickr_rest_url():
+    """Return the Flickr API REST endpoint, or None for the default."""
+    return os.environ.get("PICS_FLICKR_REST_URL") or None
+
+def get_flickr_photo_url_template():
+    """Return the template for the base of a Flickr static photo URL.
+    The "farm", "server" and "id" photo attributes are interpolated.
+    """
+    return os.environ.get("PICS_FLICKR_PHOTO_URL",
+        "http://farm%(farm)s.static.flickr.com/%(server)s/%(id)s_")
+
 
 _g_source_url_pats = [
     ("flickr", re.compile("^flickr://(?P<user>.*?)/?$")),
@@ -11,18 +11,35 @@ from os.path import normpath, exists, join, expanduser, dirname, isdir, \
 import logging
 import datetime
 import re
+import time
+import threading
+import Queue
+from collections import deque
+from array import array
 import urllib
+import zlib
 import cPickle as pickle
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from xml.etree import ElementTree as ET
 from glob import glob
 import sqlite3
 from hashlib import md5
 import webbrowser
 from contextlib import contextmanager
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 from picslib.filesystem import FileSystem
+from picslib.download import Downloader, RateLimiter
+from picslib.blobstore import BlobStore
 from picslib import utils
 from picslib.utils import xpprint
+from pprint import pformat
 from picslib import simpleflickrapi
 from picslib.errors import PicsError
 
@@ -61,6 +78,26 @@ class WorkingCopy(object):
     """
     VERSION = "1.0.0"
 
+    # Default number of concurrent info fetches and downloads in `update`.
+    update_jobs = 4
+    # Number of concurrent video downloads in `update` (videos have their
+    # own download workers, so they don't hold up photos). If None, a
+    # quarter of the jobs.
+    update_video_jobs = None
+    # `update` commits its progress every `update_batch_size` photos, or
+    # every `update_batch_interval` seconds, whichever comes first.
+    update_batch_size = 100
+    update_batch_interval = 10.0
+    # `watch` polls for updates every `watch_min_interval` seconds,
+    # backing off (doubling) to `watch_max_interval` while idle.
+    watch_min_interval = 60.0
+    watch_max_interval = 900.0
+    # Whether API responses (photo info, sizes and comments) are cached
+    # in ".pics/api-cache.sqlite3", and the max size (in bytes) of that
+    # cache before the least recently used responses are evicted.
+    use_api_cache = True
+    api_cache_max_size = 100*1024*1024
+
     @staticmethod
     def _db_path_from_base_dir(base_dir):
         return join(base_dir, ".pics", "photos.sqlite3")
@@ -69,6 +106,7 @@ class WorkingCopy(object):
         self.base_dir = normpath(base_dir)
         self.fs = FileSystem(log.debug)
         self._cache = {}
+        self._stop_event = threading.Event()
 
         db_path = self._db_path_from_base_dir(self.base_dir)
         if exists(db_path):  # Otherwise `.create()` will set `self.db`.
@@ -76,7 +114,7 @@ class WorkingCopy(object):
 
     @classmethod
     def create(cls, base_dir, ilk, user, base_date=None, size="original",
-            permission="all"):
+            permission="all", blob_store=None):
         """Create a working copy and return a `WorkingCopy` instance for it.
 
         @param base_dir {str} The base directory for the working copy.
@@ -86,10 +124,12 @@ class WorkingCopy(object):
         @param base_date {datetime.date} The date (UTC) from which to
             start getting photos. If not given, then all photos for
             that user are retrieved.
-        @param size {str} The name of photos sizes to download. Supported
-            values are: "small", "medium" and "original". The actual size
-            that the former two mean depends on the pics repository. Default
-            is "original".
+        @param size {str|list} The name of the photo size to download, or
+            a list of sizes (or a comma-separated string of them) to
+            download each photo in. Supported values are: "small",
+            "medium" and "original". The actual size that the former two
+            mean depends on the pics repository. Default is "original".
+            The first size is the one listed by `list()` and `find()`.
             TODO: specify the sizes for flickr.
         @param permission {str} Photo permissions to retrieve.
             Valid values:
@@ -97,12 +137,23 @@ class WorkingCopy(object):
                 'family' only photos that family would see,
                 'friend' only photos that friends would see,
                 'public' only public photos
+        @param blob_store {str} Optional. The dir of a `BlobStore` to
+            share downloaded photo files with other working copies.
         @returns {WorkingCopy} The working copy instance.
         """
         # Sanity checks.
         assert ilk == "flickr", "unknown pics repo ilk: %r" % ilk
         assert isinstance(base_date, (type(None), datetime.date))
-        assert size in ("small", "medium", "original")
+        if isinstance(size, basestring):
+            size = size.split(',')
+        sizes = []
+        for s in size:
+            s = s.strip()
+            if s not in ("small", "medium", "original"):
+                raise PicsError("invalid photo size: %r (must be one of "
+                                "small, medium or original)" % s)
+            if s not in sizes:
+                sizes.append(s)
         assert permission in ("all", "family", "friend", "public")
         if exists(base_dir):
             raise PicsError("cannot create working copy: `%s' exists" % base_dir)
@@ -122,10 +173,15 @@ class WorkingCopy(object):
         with self.db.connect(True) as cu:
             self.db.set_meta("ilk", ilk)
             self.db.set_meta("user", user)
-            self.db.set_meta("size", size)
+            self.db.set_meta("size", ','.join(sizes))
             self.db.set_meta("permission", permission)
             if base_date:
                 self.db.set_meta("base_date", base_date)
+            if blob_store:
+                blob_store = abspath(expanduser(blob_store))
+                self.db.set_meta("blob_store", blob_store)
+        if blob_store:
+            self.blob_store.register(self.base_dir)
 
         return self
 
@@ -137,9 +193,36 @@ class WorkingCopy(object):
     def user(self):
         return self.db.get_meta("user")
 
+    @property
+    def sizes(self):
+        """The list of photo sizes downloaded by this working copy."""
+        return self.db.get_meta("size").split(',')
+
     @property
     def size(self):
-        return self.db.get_meta("size")
+        """The primary (first) photo size of this working copy."""
+        return self.sizes[0]
+
+    @property
+    def blob_store(self):
+        """The `BlobStore` shared with other working copies, or None."""
+        with self._blob_store_lock:
+            if self._blob_store_cache is None:
+                dir = self.db.get_meta("blob_store")
+                if dir:
+                    self._blob_store_cache = BlobStore(dir)
+        return self._blob_store_cache
+    _blob_store_cache = None
+    _blob_store_lock = threading.Lock()
+
+    def blob_keys(self):
+        """Generate the `BlobStore` key of each downloaded photo file."""
+        with self.db.connect() as cu:
+            cu.execute("SELECT f.id, f.size, i.secret, i.originalsecret "
+                       "FROM pics_file f JOIN pics_info i ON i.id = f.id")
+            for id, size, secret, originalsecret in cu:
+                yield _blob_key_from_info({"id": str(id), "secret": secret,
+                    "originalsecret": originalsecret}, size)
 
     @property
     def base_date(self):
@@ -173,17 +256,64 @@ class WorkingCopy(object):
     @property
     def api(self):
         if self._api_cache is None:
+            response_cache = None
+            if self.use_api_cache:
+                response_cache = simpleflickrapi.ResponseCache(
+                    join(self.base_dir, ".pics", "api-cache.sqlite3"),
+                    max_size=self.api_cache_max_size)
             self._api_cache = simpleflickrapi.SimpleFlickrAPI(
-                utils.get_flickr_api_key(), utils.get_flickr_secret())
+                utils.get_flickr_api_key(), utils.get_flickr_secret(),
+                response_cache=response_cache, stats=self.stats)
+            rest_url = utils.get_flickr_rest_url()
+            if rest_url:
+                self._api_cache.rest_url = rest_url
             #TODO: For now 'pics' is just read-only so this is good
             #      enough. However, eventually we'll want separate
             #      `self.read_api', `self.write_api' and
             #      `self.delete_api' or similar mechanism.
             #TODO: cache this auth token in the pics user data dir
-            self._api_cache.get_auth_token("read")
+            auth_token = utils.get_flickr_auth_token()
+            if auth_token:
+                self._api_cache.auth_token = auth_token
+            else:
+                self._api_cache.get_auth_token("read")
         return self._api_cache
     _api_cache = None
 
+    @property
+    def stats(self):
+        """The `simpleflickrapi.RequestStats` for API calls and downloads
+        made by this working copy.
+        """
+        if self._stats_cache is None:
+            self._stats_cache = simpleflickrapi.RequestStats()
+        return self._stats_cache
+    _stats_cache = None
+
+    @property
+    def _stats_path(self):
+        return join(self.base_dir, ".pics", "update-stats.pickle")
+
+    def save_stats(self):
+        """Save `self.stats` as the stats for the last update."""
+        fout = open(self._stats_path, 'wb')
+        try:
+            pickle.dump(self.stats, fout, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fout.close()
+
+    def last_update_stats(self):
+        """Return the `simpleflickrapi.RequestStats` saved by the last
+        update, or None if there aren't any.
+        """
+        if not exists(self._stats_path):
+            return None
+        fin = open(self._stats_path, 'rb')
+        try:
+            return pickle.load(fin)
+        finally:
+            fin.close()
+
     # Getter and setter for `last-update`, a `datetime.datetime` field for
     # the latest photo update sync'd to the working copy.
     _last_update_cache = None
@@ -203,193 +333,279 @@ class WorkingCopy(object):
                 value.strftime("%Y-%m-%d %H:%M:%S"), cu=cu)
             self._last_update_cache = value
 
-    def _add_photo(self, id, dry_run=False):
-        """Add the given photo to the working copy."""
-        # Gather necessary info.
-        info = self.api.photos_getInfo(photo_id=id)[0]  # <photo> elem
-        datedir = info.find("dates").get("taken")[:7]
-        dir = join(self.base_dir, datedir)
-        url, filename = self._download_info_from_info(info, size=self.size)
-        path = join(dir, filename)
-        title = info.findtext("title")
-        log.info("A  %s  [%s]", path,
-                 utils.one_line_summary_from_text(title, 40))
-        last_update = _photo_last_update_from_info(info)
+    def _plan_photo_update(self, upd):
+        """First stage of an update: determine what work needs to be done
+        for the given `_PhotoUpdate`, and the download info.
 
+        This is normally decided from the photo's `recentlyUpdated` list
+        element (which has the necessary extras), without a getInfo call.
+        Videos still need a getSizes call for the download URL.
+        """
+        if upd.elem is not None:
+            photo = upd.elem
+            upd.title = photo.get("title")
+        else:
+            photo = upd.info = self._fetch_info_from_photo_id(upd.id,
+                                                              upd.lastupdate)
+            upd.title = photo.findtext("title")
+        upd.datedir = _photo_datedir_from_info(photo)
+        upd.last_update = _photo_last_update_from_info(photo)
+
+        if upd.action == "A":
+            upd.todos = ["photo", "info"]
+        else:
+            # From *experimentation* it looks like the "secret" attribute
+            # changes if the photo itself changes (i.e. is replaced or
+            # "Edited" or rotated).
+            local_info = upd.local_info
+            if upd.datedir != upd.local_datedir:
+                log.debug("update %s: datedir change: %r -> %r",
+                          upd.id, upd.local_datedir, upd.datedir)
+                upd.todos.append("remove-old")
+                upd.todos.append("photo")
+            elif photo.get("secret") != local_info.get("secret"):
+                log.debug("update %s: photo secret change: %r -> %r",
+                          upd.id, local_info.get("secret"),
+                          photo.get("secret"))
+                upd.todos.append("photo")
+            upd.todos.append("info")
+
+        upd.filename = self._filename_from_info(photo, size=self.size)
+        if "photo" in upd.todos:
+            upd.downloads = self._download_info_from_info(photo,
+                                                          sizes=self.sizes)
+            if self.blob_store is not None:
+                upd.blob_key_from_size = dict(
+                    (size, _blob_key_from_info(photo, size))
+                    for size, url, filename in upd.downloads)
+
+    def _fetch_photo_update(self, upd):
+        """Metadata stage of an update: gather the full photo info (if
+        not already fetched) and comments to save.
+
+        The info is saved as the photo's "info" data, which includes
+        metadata (e.g. notes, comment count) that isn't available as
+        a `recentlyUpdated` extra.
+        """
+        if upd.info is None:
+            upd.info = self._fetch_info_from_photo_id(upd.id, upd.lastupdate)
+        if _photo_num_comments_from_info(upd.info):
+            upd.comments = self.api.photos_comments_getList(photo_id=upd.id,
+                cache_version_=_photo_lastupdate_from_info(upd.info))[0]
+
+    def _download_photo_update(self, upd, download):
+        """Download stage of an update: get one size of the photo itself
+        (from the blob store, if there is one and it has it).
+
+        @param download {tuple} One of the photo update's `downloads`:
+            (<size>, <url>, <filename>).
+        """
+        size, url, filename = download
+        dir = join(self.base_dir, upd.datedir)
+        self._ensure_photo_dir(dir)
+        path = join(dir, filename)
+        blob_key = upd.blob_key_from_size.get(size)
+        result = blob_key and self.blob_store.get(blob_key, path,
+            join(dir, ".pics", filename + ".part"))
+        if result:
+            nbytes, md5 = result
+            self.stats.record_cache_hit("download", "blob store")
+        else:
+            #TODO: add a reporthook for progressbar (unless too quick to
+            #      bother)
+            nbytes, md5 = self._download(url, path,
+                                         priority=upd.is_video and 1 or 0)
+            mtime = utils.timestamp_from_datetime(upd.last_update)
+            os.utime(path, (mtime, mtime))
+            if blob_key:
+                self.blob_store.add(blob_key, path, nbytes, md5)
+        upd.files[size] = (filename, nbytes, md5, _stat_key(os.stat(path)))
+
+    def _apply_photo_update(self, upd, cu, dry_run=False):
+        """Writer stage of an update: save the photo data and record the
+        update in the database. Photo updates are applied one at a time,
+        in order.
+        """
+        id, info = upd.id, upd.info
+        dir = join(self.base_dir, upd.datedir)
+        title = utils.one_line_summary_from_text(upd.title, 40)
+        # `pics_photo.size` and `.md5` are for the first of `self.sizes`.
+        nbytes, md5 = upd.files.get(self.size, (None, None, None))[1:3]
+
+        if upd.action == "A":
+            for size, url, filename in upd.downloads:
+                log.info("A  %s  [%s]", join(dir, filename), title)
+            if not dry_run:
+                self._save_photo_data(id, info, upd.comments, cu=cu)
+            cu.execute("INSERT OR REPLACE INTO pics_photo VALUES (?,?,?,?)",
+                       (id, upd.datedir, nbytes, md5))
+        elif upd.action == "U":
+            # - Remove the old bits, if the datedir has changed.
+            if "remove-old" in upd.todos:
+                self._remove_photo_files(id, upd.local_datedir,
+                    self._local_filenames(id, upd.local_info, cu=cu),
+                    upd.local_info.findtext("title"), cu, dry_run=dry_run)
+
+            # - Add the new stuff.
+            if "photo" in upd.todos:
+                for size, url, filename in upd.downloads:
+                    log.info("U  %s  [%s]", join(dir, filename), title)
+            else:
+                log.info(" u %s  [%s]", join(dir, upd.filename), title)
+            if not dry_run:
+                self._save_photo_data(id, info, upd.comments, cu=cu)
+            if "photo" in upd.todos:
+                cu.execute("UPDATE pics_photo SET datedir=?, size=?, md5=? "
+                           "WHERE id=?", (upd.datedir, nbytes, md5, id))
+        else:
+            raise PicsError("unexpected update action: %r" % upd.action)
+
+        # Record the downloaded files, and add them to the stat cache.
+        for size, (filename, nbytes, md5, stat_key) in upd.files.items():
+            cu.execute("INSERT OR REPLACE INTO pics_file VALUES (?,?,?,?,?)",
+                       (id, size, filename, nbytes, md5))
+            cu.execute("INSERT OR REPLACE INTO pics_stat VALUES (?,?,?,?,?)",
+                self._stat_cache_row(join(upd.datedir, filename),
+                                     stat_key, md5))
+
+        # Note this update.
+        cu.execute("DELETE FROM pics_update WHERE id=?", (id,))
+
+    def _remove_photo_files(self, id, datedir, filenames, title, cu,
+                            dry_run=False):
+        """Remove the given downloaded files of a photo, and their
+        `pics_file` and stat cache records. The date dir is removed if
+        that leaves it empty.
+        """
+        d = join(self.base_dir, datedir)
+        title = utils.one_line_summary_from_text(title, 40)
+        for filename in filenames:
+            path = join(d, filename)
+            log.info("D  %s  [%s]", path, title)
+            if not dry_run:
+                log.debug("rm `%s'", path)
+                if exists(path):
+                    os.remove(path)
+            cu.execute("DELETE FROM pics_stat WHERE path=?",
+                       (join(datedir, filename),))
+        cu.execute("DELETE FROM pics_file WHERE id=?", (id,))
+        if not dry_run and isdir(d):
+            remaining_paths = set(os.listdir(d))
+            remaining_paths.difference_update(set([".pics"]))
+            if not remaining_paths:
+                log.info("D  %s", d)
+                self.fs.rm(d)
+
+    def _local_filenames(self, id, local_info, cu=None):
+        """Return the filenames of the given photo's downloaded files."""
+        with self.db.connect(cu=cu) as cu:
+            cu.execute("SELECT filename FROM pics_file WHERE id=?", (id,))
+            filenames = [row[0] for row in cu.fetchall()]
+        return filenames or [self._filename_from_info(local_info, size)
+                             for size in self.sizes]
+
+    def _commit_update_batch(self, cu, last_update, dry_run=False):
+        """Commit the bookkeeping for a batch of applied photo updates.
+
+        @param last_update {datetime.datetime} The latest "lastupdate" of
+            the photos in the batch.
+        """
+        self.set_last_update(last_update, cu)
         if not dry_run:
-            # Create the dirs, as necessary.
-            pics_dir = join(dir, ".pics")
+            cu.connection.commit()
+
+    _photo_dir_lock = threading.Lock()
+    def _ensure_photo_dir(self, dir):
+        """Create the given photo dir and its ".pics" subdir, as
+        necessary. This is safe to call from concurrent update stages.
+        """
+        pics_dir = join(dir, ".pics")
+        with self._photo_dir_lock:
             if not exists(dir):
                 self.fs.mkdir(dir)
             if not exists(pics_dir):
                 self.fs.mkdir(pics_dir, hidden=True)
 
-            # Get the photo itself.
-            #TODO: add a reporthook for progressbar (unless too quick to bother)
-            #TODO: handle ContentTooShortError (py2.5)
-            fname, headers = urllib.urlretrieve(url, path)
-            mtime = utils.timestamp_from_datetime(last_update)
-            os.utime(path, (mtime, mtime))
+    @property
+    def downloader(self):
+        if self._downloader_cache is None:
+            self._downloader_cache = Downloader(stats=self.stats)
+        return self._downloader_cache
+    _downloader_cache = None
 
-            # Gather and save all metadata.
-            if _photo_num_comments_from_info(info):
-                comments = self.api.photos_comments_getList(photo_id=id)[0]
-            else:
-                comments = None
-            self._save_photo_data(dir, id, info, comments)
-        return datedir, last_update
+    def limit_download_rate(self, spec):
+        """Limit the total rate of photo downloads.
+
+        When the limit is reached, photos are downloaded ahead of videos.
+        API calls (for metadata) are not limited.
+
+        @param spec {str} A `download.RateLimiter` spec, e.g. "500k", or
+            "200k@08:00-18:00,2M" to vary the limit by time of day. None
+            for no limit.
+        """
+        if spec:
+            self.downloader.rate_limiter = RateLimiter.from_spec(spec)
+        else:
+            self.downloader.rate_limiter = None
+
+    def _download(self, url, path, priority=0):
+        """Download the given photo/video URL to `path` and return its
+        (<size>, <md5-hexdigest>).
+
+        The partial download is kept in the ".pics" dir, so an
+        interrupted download is resumed by the next update.
+        """
+        part_path = join(dirname(path), ".pics", basename(path) + ".part")
+        return self.downloader.download(url, path, part_path, priority)
 
-    def _fetch_info_from_photo_id(self, id):
-        info = self.api.photos_getInfo(photo_id=id)[0]  # <photo> elem
+    def _fetch_info_from_photo_id(self, id, lastupdate=None):
+        info = self.api.photos_getInfo(photo_id=id,
+            cache_version_=lastupdate)[0]  # <photo> elem
         # Drop tail for canonicalization to allow diffing of the
         # serialized XML.
         info.tail = None
         return info
 
-    def _update_photo(self, id, local_datedir, local_info, dry_run=False):
-        """Update the given photo in the working copy."""
-        info = self._fetch_info_from_photo_id(id)
-        datedir = info.find("dates").get("taken")[:7]
-        last_update = _photo_last_update_from_info(info)
-
-        # Figure out what work needs to be done.
-        # From *experimentation* it looks like the "secret" attribute
-        # changes if the photo itself changes (i.e. is replaced or
-        # "Edited" or rotated).
-        todos = []
-        if datedir != local_datedir:
-            log.debug("update %s: datedir change: %r -> %r",
-                      id, local_datedir, datedir)
-            todos.append("remove-old")
-            todos.append("photo")
-        elif info.get("secret") != local_info.get("secret"):
-            log.debug("update %s: photo secret change: %r -> %r",
-                      id, local_info.get("secret"), info.get("secret"))
-            todos.append("photo")
-        todos.append("info")
-        if _photo_num_comments_from_info(info):
-            todos.append("comments")
-        if not todos:
-            return datedir, last_update
-
-        # Do the necessary updates.
-        XXX # Figure out ext for videos. _download_info_from_info is wrong
-            # here b/c is isn't using  *local* info.
-        url, filename = self._download_info_from_info(info, size=self.size)
-        #XXX
-        #size_ext = (self.size != "original" and "."+self.size or "")
-        #ext = (self.size != "original" and ".jpg"
-        #       or "."+local_info.get("originalformat"))
-
-        # - Remove the old bits, if the datedir has changed.
-        if "remove-old" in todos:
-            d = join(self.base_dir, local_datedir)
-            path = join(d, filename)
-            log.info("D  %s  [%s]", path,
-                utils.one_line_summary_from_text(local_info.findtext("title"), 40))
-            if not dry_run:
-                log.debug("rm `%s'", path)
-                os.remove(path)
-                self._remove_photo_data(d, id)
-                remaining_paths = set(os.listdir(d))
-                remaining_paths.difference_update(set([".pics"]))
-                if not remaining_paths:
-                    log.info("D  %s", d)
-                    self.fs.rm(d)
-
-        # - Add the new stuff.
-        d = join(self.base_dir, datedir)
-        action_str = ("photo" in todos and "U " or " u")
-        path = join(d, filename)
-        log.info("%s %s  [%s]", action_str, path,
-            utils.one_line_summary_from_text(info.findtext("title"), 40))
-        if not dry_run:
-            if not exists(d):
-                self.fs.mkdir(d)
-                pics_dir = join(d, ".pics")
-                if not exists(pics_dir):
-                    self.fs.mkdir(pics_dir, hidden=True)
-            if "photo" in todos:
-                fname, headers = urllib.urlretrieve(url, path)
-                mtime = utils.timestamp_from_datetime(last_update)
-                os.utime(path, (mtime, mtime))
-            if "comments" in todos:
-                comments = self.api.photos_comments_getList(photo_id=id)[0]
-            else:
-                comments = None
-            self._save_photo_data(d, id, info, comments=comments)
-
-        #print "... %s" % id
-        #print "originalsecret: %s <- %s" % (info.get("originalsecret"), local_info.get("originalsecret"))
-        #print "secret: %s <- %s" % (info.get("secret"), local_info.get("secret"))
-        #print "rotation: %s <- %s" % (info.get("rotation"), local_info.get("rotation"))
-        return datedir, last_update
-
     def check_version(self):
         if self.version != self.VERSION:
             raise PicsError("out of date working copy (v%s != v%s): you must "
                             "first upgrade", self.version, self.VERSION)
 
-    def _remove_photo_data(self, dir, id):
-        #TODO: 'dir' correct here? need to use self.base_dir?
-        paths = [join(dir, ".pics", "%s-%s.xml" % (id, name))
-                 for name in ("info", "comments")]
-        for path in paths:
-            if exists(path):
-                log.debug("remove photo data: `%s'", path)
-                #TODO:XXX use self.fs.rm for this?
-                os.remove(path)
-
-    def _save_photo_data(self, dir, id, info, comments=None):
-        """Save the given photo metadata.
+    def _save_photo_data(self, id, info, comments=None, cu=None):
+        """Save the given photo metadata to the `pics_info` catalog.
 
-        @param dir {str} The photo's dir in the working copy.
         @param id {int} The photo's id.
         @param info {xml.etree.Element} The <photo> element to save.
         @param comments {xml.etree.Element} Optional. The <comments> element
             to save, if any.
+        @param cu {sqlite3.Cursor} An existing cursor to use.
         """
-        info_path = join(dir, ".pics", "%s-info.xml" % id)
-        log.debug("save photo data: `%s'", info_path)
-        f = open(info_path, 'wb')
-        try:
-            f.write(ET.tostring(info))
-        finally:
-            f.close()
-        if comments:
-            comments_path = join(dir, ".pics", "%s-comments.xml" % id)
-            f = open(comments_path, 'wb')
-            try:
-                f.write(ET.tostring(comments))
-            finally:
-                f.close()
-
-    def _get_photo_data(self, datedir, id, type):
-        """Read and return the given photo data.
+        log.debug("save photo data: %s", id)
+        row = _catalog_row_from_xml(ET.tostring(info),
+            comments is not None and ET.tostring(comments) or None, info)
+        with self.db.connect(True, cu=cu) as cu:
+            cu.execute(_catalog_insert_sql, _catalog_db_row(row))
+            # Keep the full-text search index up to date.
+            cu.execute("DELETE FROM pics_search WHERE docid=?", (row[0],))
+            cu.execute(_search_insert_sql,
+                       _search_row_from_info(info, comments))
+
+    def _get_photo_data(self, id, type, cu=None):
+        """Read and return the given photo data from the `pics_info`
+        catalog.
 
-        Photo data is one or more XML files in the photos dirs ".pics" subdir.
-
-        @param datedir {str} A datedir of the form YYYYMM in which the photo
-            lives.
         @param id {int} The photo's id.
         @param type {str} The photo data type. One of "info" or "comments".
-        @returns {xml.etree.Element} or None, if no such data file.
+        @param cu {sqlite3.Cursor} An existing cursor to use.
+        @returns {xml.etree.Element} or None, if no such data.
         """
-        path = join(self.base_dir, datedir, ".pics", "%s-%s.xml" % (id, type))
-        if exists(path):
-            log.debug("load photo data: `%s'", path)
-            f = open(path, 'rb')
-            try:
-                return ET.parse(f).getroot()
-            except pyexpat.ParserError, ex:
-                log.debug("corrupt photo data: XXX")
-                #TODO: what to do with it?
-                XXX
-                return None
-            finally:
-                f.close()
-        else:
+        assert type in ("info", "comments")
+        with self.db.connect(cu=cu) as cu:
+            cu.execute("SELECT %s FROM pics_info WHERE id=?" % type, (id,))
+            row = cu.fetchone()
+        if row is None or row[0] is None:
             return None
+        return ET.fromstring(zlib.decompress(str(row[0])))
 
     def _local_photo_dirs_and_ids_from_target(self, target):
         """Yield the identified photos from the given target.
@@ -398,102 +614,105 @@ class WorkingCopy(object):
         """
         if isdir(target):
             if not exists(join(target, ".pics")):
-                raise PicsError("`%s' is not a pics working copy dir" % path)
-            for f in glob(join(target, ".pics", "*.data")):
-                yield target, splitext(basename(f))[0]
+                raise PicsError("`%s' is not a pics working copy dir" % target)
+            datedir = basename(abspath(target))
+            with self.db.connect() as cu:
+                cu.execute("SELECT id FROM pics_photo WHERE datedir=? "
+                           "ORDER BY id", (datedir,))
+                ids = [str(row[0]) for row in cu]
+            for id in ids:
+                yield target, id
         else:
             id = basename(target).split('.', 1)[0]
-            path = join(dirname(target), ".pics", "%s-info.xml" % id)
-            if isfile(path):
+            with self.db.connect() as cu:
+                cu.execute("SELECT datedir FROM pics_photo WHERE id=?", (id,))
+                row = cu.fetchone()
+            if row is not None:
                 yield dirname(target) or '.', id
 
-    def _photo_data_from_local_path(self, path):
-        """Yield photo data for the given path.
-
-        If the given path does not identify a photo then the following
-        is returned:
-            {"id": path}
-        """
-        log.debug("list local path '%s'", path)
-        found_at_least_one = False
-        for dir, id in self._local_photo_dirs_and_ids_from_target(path):
-            found_at_least_one = True
-            yield self._get_photo_data(dir, id, "info")
-        if not found_at_least_one:
-            # This is how we say the equivalent of:
-            #   $ ls bogus
-            #   ls: bogus: No such file or directory
-            yield {"id": path}
-
-    def _photo_data_from_paths(self, paths):
-        for path in paths:
-            if path.startswith("flickr://"):
-                for d in self._photo_data_from_url(path):
-                    yield d
-            else:
-                for p in utils.paths_from_path_patterns([path],
-                            dirs="if-not-recursive",
-                            recursive=False,
-                            on_error="yield"):
-                    for d in self._photo_data_from_local_path(p):
-                        yield d
-
-    def _download_info_from_info(self, info, size="original"):
-        """Return (url, filename) download info for the given photo/video."""
-        id = info.get("id")
-        if info.get("media") == "video":
-            sizes = self.api.photos_getSizes(photo_id=id)[0]
-            label = {  # "label" attribute on `getSizes` <size> elem to use.
-                "square": "Mobile MP4",
-                "thumbnail": "Mobile MP4",
-                "small": "Mobile MP4",
-                "medium": "HD MP4",
-                "medium640": "HD MP4",
-                "large": "HD MP4",
-                "original": "Video Original",
-            }[size]
-            for size in sizes:
-                if size.get("label") == label:
-                    url = size.get("source")
-                    break
+    def _download_info_from_info(self, info, sizes=("original",)):
+        """Return download info for the given sizes of the given
+        photo/video: a list of (<size>, <url>, <filename>).
+
+        All sizes are resolved from the given info, plus (for a video)
+        one getSizes call.
+
+        @param info {xml.etree.Element} The <photo> elem from a getInfo
+            response, or from a photo list response with the
+            "original_format" and "media" extras.
+        """
+        size_elems = None
+        downloads = []
+        for size in sizes:
+            if info.get("media") == "video":
+                # Note: the "url_*" extras for a video are of JPEG stills.
+                if size_elems is None:
+                    size_elems = self.api.photos_getSizes(
+                        photo_id=info.get("id"),
+                        cache_version_=_photo_lastupdate_from_info(info))[0]
+                url = self._video_url_from_sizes(info, size, size_elems)
+            elif info.get(_url_extra_from_size[size]):
+                # A photo list response with the "url_*" extra for this
+                # size.
+                url = info.get(_url_extra_from_size[size])
             else:
-                raise PicsError("`%s': no '%s' size for this photo" % (
-                    id, label))
-            #TODO: Is it always a ".mov" container? If not, then should
-            #  HTTP GET this URL (without following the redirect) to get
-            #  expected response which includes the extension.
-            #        HTTP/1.1 302 Found
-            #        Location: http://c-6485818293.a-flickr.i-ae076ec5.http.atlas.cdn.yimg.com/flickr/36364074@N00/6485818293/6485818293_5363d53b05.mov?dt=flickr&fn=6485818293_orig.mov&bt=0&d=cp_d%3Dwww.flickr.com%26cp_t%3Ds%26cp%3D792600246%26mid%3D6485818293%26ufn%3D6485818293_orig.mov&s=1860a91264a558909aae98ea1adbf88b
-            #        ...
-            filename = "%s.%s.mov" % (id, label.lower().replace(' ', '-'))
+                url = self._photo_url_from_info(info, size)
+            downloads.append((size, url, self._filename_from_info(info, size)))
+        return downloads
+
+    def _video_url_from_sizes(self, info, size, size_elems):
+        """Return the URL of the given size of a video.
+
+        @param size_elems {xml.etree.Element} The <sizes> elem from the
+            video's getSizes response.
+        """
+        label = _video_label_from_size[size]
+        for size_elem in size_elems:
+            if size_elem.get("label") == label:
+                url = size_elem.get("source")
+                break
         else:
-            assert info.get("media") == "photo"
-            url = "http://farm%(farm)s.static.flickr.com/%(server)s/%(id)s_" % info.attrib
-            if size == "original":
-                url += info.get("originalsecret")
-            else:
-                url += info.get("secret")
-            url += {
-                "square": "_s",
-                "thumbnail": "_t",
-                "small": "_m",
-                "medium": "",
-                "medium640": "_z",
-                "large": "_b",
-                "original": "_o",
-            }[size]
-            if info.get("originalsecret") != info.get("secret"):
-                # If there has been some transformation on the photo (e.g.
-                # replacement or a rotation) then the download urls need this
-                # suffix.
-                url += "_d"
-            if size == "original":
-                ext = '.' + info.get("originalformat")
-            else:
-                ext = ".jpg"
-            url += ext
-            filename = "%s.%s%s" % (id, size, ext)
-        return url, filename
+            raise PicsError("`%s': no '%s' size for this photo" % (
+                info.get("id"), label))
+        #TODO: Is it always a ".mov" container? If not, then should
+        #  HTTP GET this URL (without following the redirect) to get
+        #  expected response which includes the extension.
+        #        HTTP/1.1 302 Found
+        #        Location: http://c-6485818293.a-flickr.i-ae076ec5.http.atlas.cdn.yimg.com/flickr/36364074@N00/6485818293/6485818293_5363d53b05.mov?dt=flickr&fn=6485818293_orig.mov&bt=0&d=cp_d%3Dwww.flickr.com%26cp_t%3Ds%26cp%3D792600246%26mid%3D6485818293%26ufn%3D6485818293_orig.mov&s=1860a91264a558909aae98ea1adbf88b
+        #        ...
+        return url
+
+    def _photo_url_from_info(self, info, size):
+        """Return the static URL of the given size of a photo."""
+        assert info.get("media") == "photo"
+        url = utils.get_flickr_photo_url_template() % info.attrib
+        if size == "original":
+            url += info.get("originalsecret")
+        else:
+            url += info.get("secret")
+        url += {
+            "square": "_s",
+            "thumbnail": "_t",
+            "small": "_m",
+            "medium": "",
+            "medium640": "_z",
+            "large": "_b",
+            "original": "_o",
+        }[size]
+        if info.get("originalsecret") != info.get("secret"):
+            # If there has been some transformation on the photo (e.g.
+            # replacement or a rotation) then the download urls need this
+            # suffix.
+            url += "_d"
+        if size == "original":
+            url += '.' + info.get("originalformat")
+        else:
+            url += ".jpg"
+        return url
+
+    def _filename_from_info(self, info, size="original"):
+        """Return the working copy filename for the given photo/video."""
+        return _photo_filename_from_info(info, size)
 
     def url_from_target(self, target):
         """Return the best URL for this target (a photo or dir)."""
@@ -525,35 +744,298 @@ class WorkingCopy(object):
             #                "can't yet handle that" % target)
         return url
 
-    def list(self, paths, format="short", tags=False):
-        for photo_data in self._photo_data_from_paths(paths):
-            log.debug("list %r", photo_data)
+    def find(self, query):
+        """Search the working copy's photo metadata.
 
-            if photo_data.keys() == ["id"]:
-                log.error("%s: no such photo or directory", photo_data["id"])
-            elif format == "short":
-                print photo_data["id"]
-            elif format == "long":
+        Free text terms are matched against the full-text index of photo
+        titles, descriptions, tags and comments. A term ending in '*'
+        is a prefix match. The following field filters are supported:
+
+            title:TEXT, desc:TEXT, tag:TEXT, comment:TEXT
+                Match the term against just that field.
+            taken:DATE, taken:DATE..DATE
+                Taken on the given date (a prefix of "YYYY-MM-DD"), or
+                in the given range, inclusive.
+            media:photo, media:video
+            is:public, is:private, is:friend, is:family
+                Photo visibility.
+            id:ID
+
+        Results are generated as they are found, in order of the date
+        taken.
+
+        @param query {list} The query terms.
+        @returns {generator} of (<path>, <title>) for each match.
+        """
+        for photo in self._iter_photos(query):
+            yield photo["path"], photo["title"]
+
+    def _iter_photos(self, query, sort="taken", reverse=False,
+                     datedirs=None, tags=False):
+        """Generate a dict of catalog data for each photo matching the
+        given `find` query terms, streamed from the database.
+
+        @param sort {str} The sort key. One of "taken" (default),
+            "lastupdate" or "id".
+        @param reverse {bool} Whether to reverse the sort order.
+        @param datedirs {list} Optional. Limit to photos in these date dirs.
+        @param tags {bool} Whether to include the photo's (raw) tags as
+            the "tags" list.
+        """
+        sql, args = _search_sql_from_query(query, sort=sort,
+            reverse=reverse, datedirs=datedirs)
+        log.debug("query photos: %s %r", sql, args)
+        size = self.size
+        with self.db.connect() as cu:
+            cu.execute(sql, args)
+            for row in cu:
+                photo = dict(zip(_photo_list_columns, row))
+                tags_str = photo.pop("tags")
+                filename = self._filename_from_info(photo, size=size)
+                photo["path"] = normpath(join(self.base_dir,
+                                              photo["datedir"], filename))
                 if tags:
-                    template = "%(mode)s %(numtags)2s %(ownername)s "\
-                               "%(lastupdate)s  %(id)s  %(title)s [%(tags)s]"
-                else:
-                    template = "%(mode)s %(numtags)2s %(ownername)s "\
-                               "%(lastupdate)s  %(id)s  %(title)s"
-                list_data = {
-                    "mode": self._mode_str_from_photo_dict(photo_data),
-                    "lastupdate": photo_data["lastupdate"].strftime("%Y-%m-%d %H:%M"),
-                    "id": photo_data["id"],
-                    "ownername": photo_data["ownername"],
-                    "numtags": len(photo_data["tags"]) + len(photo_data["machine_tags"]),
-                    "tags": ', '.join(photo_data["tags"] + photo_data["machine_tags"]),
-                    "title": photo_data["title"],
-                }
-                print template % list_data
-            elif format == "dict":
-                pprint(photo_data)
+                    photo["tags"] = tags_str and tags_str.split('\n') or []
+                yield photo
+
+    def _photo_targets_from_paths(self, paths):
+        """Resolve the given photo dir and file paths.
+
+        @returns {tuple} (<datedirs>, <whole-datedirs>, <ids>): the set of
+            date dirs identified (None if the working copy base dir is
+            one of the paths, i.e. all of them), the set of date dirs in
+            which *all* photos are identified, and the set of ids of
+            photos identified by file path.
+        """
+        base_dir = abspath(self.base_dir)
+        datedirs = set()
+        whole_datedirs = set()
+        ids = set()
+        def on_error(p):
+            log.error("%s: no such photo or directory", p)
+        for p in utils.paths_from_path_patterns(paths,
+                    dirs="if-not-recursive", recursive=False,
+                    on_error=on_error):
+            if isdir(p):
+                if abspath(p) == base_dir:
+                    datedirs = None
+                    continue
+                if not exists(join(p, ".pics")):
+                    raise PicsError("`%s' is not a pics working copy dir" % p)
+                datedir = basename(abspath(p))
+                whole_datedirs.add(datedir)
+            else:
+                datedir = basename(dirname(abspath(p)))
+                ids.add(basename(p).split('.', 1)[0])
+            if datedirs is not None:
+                datedirs.add(datedir)
+        return datedirs, whole_datedirs, ids
+
+    def list(self, paths, format="long", tags=False, sort="taken",
+             reverse=False, taken=None, visibility=None,
+             stream=sys.stdout):
+        """List the photos identified by the given paths.
+
+        The listing is a query of the photo catalog: it doesn't read the
+        photo dirs.
+
+        @param paths {list} Photo dirs and files in this working copy.
+            The working copy base dir identifies all photos.
+        @param format {str} One of "short" (just the id), "long"
+            (default), "json" (a JSON object per line), "tsv" (with a
+            header line) or "dict".
+        @param tags {bool} Whether to include the tags.
+        @param sort {str} The sort key: "taken" (default), "lastupdate"
+            or "id".
+        @param reverse {bool} Whether to reverse the sort order.
+        @param taken {str} Optional. Limit to photos taken on the given
+            date, or "DATE..DATE" range. See `find()`.
+        @param visibility {str} Optional. Limit to photos with the given
+            visibility: "public", "private", "friend" or "family".
+        @param stream {file} The stream to which to write the listing.
+        """
+        if sort not in _sort_columns_from_key:
+            raise PicsError("unknown sort key: %r (must be one of %s)"
+                            % (sort, ', '.join(sorted(_sort_columns_from_key))))
+        if format not in ("short", "long", "json", "tsv", "dict"):
+            raise PicsError("unknown listing format: %r" % format)
+
+        datedirs, whole_datedirs, ids = self._photo_targets_from_paths(paths)
+        if datedirs is not None and not datedirs:
+            return
+
+        query = []
+        if taken:
+            query.append("taken:" + taken)
+        if visibility:
+            query.append("is:" + visibility)
+        if format == "tsv":
+            stream.write('\t'.join(_list_fields
+                                   + (tags and ["tags"] or [])) + '\n')
+
+        # Output is buffered, as writing many small lines is slow.
+        lines = []
+        for photo in self._iter_photos(query, sort=sort, reverse=reverse,
+                                       datedirs=datedirs, tags=tags):
+            if not (datedirs is None or photo["datedir"] in whole_datedirs
+                    or str(photo["id"]) in ids):
+                continue
+            ids.discard(str(photo["id"]))
+            log.debug("list %r", photo)
+            lines.append(self._list_line_from_photo(photo, format, tags))
+            if len(lines) >= 256:
+                _write_lines(stream, lines)
+                del lines[:]
+        _write_lines(stream, lines)
+        if not query:
+            for id in sorted(ids):
+                log.error("%s: no such photo in the working copy", id)
+
+    def _list_line_from_photo(self, photo, format, tags=False):
+        """Return the `list()` output line for the given photo dict."""
+        if format == "short":
+            return "%s\n" % photo["id"]
+        elif format == "long":
+            if tags:
+                template = u"%(mode)s %(numtags)2s %(ownername)s "\
+                           u"%(lastupdate)s  %(id)s  %(title)s [%(tags)s]\n"
             else:
-                raise PicsError("unknown listing format: '%r" % format)
+                template = u"%(mode)s %(numtags)2s %(ownername)s "\
+                           u"%(lastupdate)s  %(id)s  %(title)s\n"
+            return template % {
+                "mode": self._mode_str_from_photo_dict(photo),
+                "lastupdate": datetime.datetime.utcfromtimestamp(
+                    photo["lastupdate"]).strftime("%Y-%m-%d %H:%M"),
+                "id": photo["id"],
+                "ownername": photo["ownername"],
+                "numtags": photo["num_tags"],
+                "tags": ', '.join(photo.get("tags", [])),
+                "title": photo["title"] or '',
+            }
+        elif format == "json":
+            fields = _list_fields + (tags and ["tags"] or [])
+            return json.dumps(dict((f, photo[f]) for f in fields),
+                              sort_keys=True) + '\n'
+        elif format == "tsv":
+            values = [photo[f] for f in _list_fields]
+            if tags:
+                values.append(','.join(photo["tags"]))
+            return u'\t'.join(
+                _tsv_escape_pat.sub(' ', v is not None and unicode(v) or u'')
+                for v in values) + u'\n'
+        elif format == "dict":
+            return pformat(photo) + '\n'
+
+    # The stat cache doesn't trust a file whose mtime is within this many
+    # seconds of when its stat was recorded: it could still change
+    # without its stat data changing (within the filesystem's mtime
+    # granularity).
+    stat_cache_racy_window = 2.0
+
+    def _stat_cache_row(self, relpath, stat_key, md5):
+        """Return a `pics_stat` row for the given file and its content
+        MD5.
+
+        @param stat_key {tuple} The `_stat_key()` of the file when its
+            MD5 was computed.
+        """
+        size, mtime, ino = stat_key
+        if time.time() - mtime < self.stat_cache_racy_window:
+            mtime = None  # a "racy" entry: re-hash next time
+        return (relpath, size, mtime, ino, md5)
+
+    def status(self, paths):
+        """Generate the status of the photo files identified by the given
+        paths, compared to the photos as downloaded.
+
+        Yields (<status>, <path>) in path order, where <status> is one of:
+            M   modified: the content differs from that downloaded
+            !   missing
+            ?   not tracked by pics
+
+        The content of a file is only re-hashed if its size, mtime or
+        inode have changed since it was last hashed (this "stat cache" is
+        the `pics_stat` table, which is updated here). Hashing is done in
+        parallel.
+        """
+        datedirs, whole_datedirs, ids = self._photo_targets_from_paths(paths)
+        if datedirs is not None and not datedirs:
+            return
+
+        status_from_relpath = {}
+        md5_from_relpath = {}
+        base_md5_from_relpath = {}
+        with self.db.connect(True) as cu:
+            cu.execute("SELECT path, size, mtime, ino, md5 FROM pics_stat")
+            cache = dict((row[0], row[1:]) for row in cu)
+
+            # One stat per tracked file.
+            sql = ("SELECT f.id, p.datedir, f.filename, f.md5 FROM pics_file f "
+                   "JOIN pics_photo p ON p.id = f.id")
+            args = []
+            if datedirs is not None:
+                sql += " WHERE p.datedir IN (%s)" % ','.join(['?']*len(datedirs))
+                args = sorted(datedirs)
+            cu.execute(sql, args)
+            to_hash = []
+            for id, datedir, filename, base_md5 in cu.fetchall():
+                if not (datedirs is None or datedir in whole_datedirs
+                        or str(id) in ids):
+                    continue
+                relpath = join(datedir, filename)
+                base_md5_from_relpath[relpath] = base_md5
+                try:
+                    st = os.stat(join(self.base_dir, relpath))
+                except OSError:
+                    status_from_relpath[relpath] = "!"
+                    continue
+                cached = cache.get(relpath)
+                if cached is not None and cached[:3] == _stat_key(st):
+                    md5_from_relpath[relpath] = cached[3]
+                else:
+                    to_hash.append(relpath)
+
+            # Re-hash changed files.
+            if to_hash:
+                log.debug("status: hashing %d files", len(to_hash))
+                results = _parallel_imap(_stat_key_and_md5_from_path,
+                    [join(self.base_dir, rp) for rp in to_hash], chunksize=1)
+                for relpath, result in zip(to_hash, results):
+                    if result is None:
+                        status_from_relpath[relpath] = "!"
+                        continue
+                    stat_key, md5 = result
+                    md5_from_relpath[relpath] = md5
+                    cu.execute("INSERT OR REPLACE INTO pics_stat "
+                               "VALUES (?,?,?,?,?)",
+                               self._stat_cache_row(relpath, stat_key, md5))
+
+            if datedirs is None:
+                # Drop cache entries for files no longer tracked.
+                cu.executemany("DELETE FROM pics_stat WHERE path=?",
+                    [(rp,) for rp in cache if rp not in base_md5_from_relpath])
+                cu.execute("SELECT DISTINCT datedir FROM pics_photo")
+                whole_datedirs = [row[0] for row in cu]
+
+        for relpath, md5 in md5_from_relpath.items():
+            base_md5 = base_md5_from_relpath[relpath]
+            # `base_md5` is NULL for photos downloaded by an older pics.
+            if base_md5 is not None and md5 != base_md5:
+                status_from_relpath[relpath] = "M"
+
+        # Untracked files.
+        for datedir in whole_datedirs:
+            dir = join(self.base_dir, datedir)
+            if not isdir(dir):
+                continue
+            for name in os.listdir(dir):
+                relpath = join(datedir, name)
+                if name != ".pics" and relpath not in base_md5_from_relpath:
+                    status_from_relpath[relpath] = "?"
+
+        for relpath in sorted(status_from_relpath):
+            yield (status_from_relpath[relpath],
+                   normpath(join(self.base_dir, relpath)))
 
     def info(self, path):
         """Dump info (retrieved from flickr) about the identified photos."""
@@ -569,7 +1051,233 @@ class WorkingCopy(object):
                 pprint(info)
                 XXX
 
-    def update(self, dry_run=False):
+    def update(self, dry_run=False, jobs=None):
+        """Update the working copy with recent changes on Flickr.
+
+        Stats on the API calls and downloads made are saved for
+        `last_update_stats()`, even if the update fails part way.
+
+        @param jobs {int} The number of photos for which to concurrently
+            fetch info, and the number to concurrently download. If not
+            given, `self.update_jobs` is used.
+        @returns {int} The number of photos updated.
+        """
+        self._stop_event.clear()    # in case of an earlier `stop()`
+        return self._update_and_save_stats(dry_run=dry_run, jobs=jobs)
+
+    def _update_and_save_stats(self, dry_run=False, jobs=None):
+        try:
+            return self._update(dry_run=dry_run, jobs=jobs)
+        finally:
+            if not dry_run:
+                self.save_stats()
+
+    def watch(self, jobs=None, min_interval=None, max_interval=None):
+        """Keep the working copy up to date, until `stop()` is called.
+
+        This polls for updates, applying them with `update()`, reusing
+        the API client (and its connections) and database connection.
+        The poll interval starts at `min_interval` and doubles (up to
+        `max_interval`) after each poll without updates. Errors are
+        logged, and also back off the interval.
+
+        Progress is committed as photos are updated (see
+        `update_batch_size`), and the database WAL is checkpointed after
+        each poll, so the process can be stopped at any time.
+
+        @param jobs {int} See `update()`.
+        @param min_interval {float} Seconds. Default `watch_min_interval`.
+        @param max_interval {float} Seconds. Default `watch_max_interval`.
+        """
+        min_interval = min_interval or self.watch_min_interval
+        max_interval = max(max_interval or self.watch_max_interval,
+                           min_interval)
+        interval = min_interval
+        self._stop_event.clear()
+        log.info("watching for updates (every %gs, up to %gs when idle)",
+                 min_interval, max_interval)
+        while not self._stop_event.isSet():
+            self.stats.clear()  # `last_update_stats()` is for this poll
+            try:
+                # Not `update()`: that would clear a `stop()` made since
+                # the check above.
+                num_updates = self._update_and_save_stats(jobs=jobs)
+            except Exception, ex:
+                log.error("update failed: %s", ex)
+                log.debug("update error", exc_info=True)
+                num_updates = 0
+            if num_updates:
+                interval = min_interval
+            elif not self._stop_event.isSet():
+                interval = min(interval * 2, max_interval)
+            self.db.checkpoint()
+            if not self._stop_event.isSet():
+                log.debug("next update check in %gs", interval)
+                self._stop_event.wait(interval)
+        log.info("stopped watching for updates")
+
+    def stop(self):
+        """Stop `watch()`, and any update in progress (after the photo
+        being applied). This can be called from a signal handler or
+        another thread. It doesn't affect later calls to `update()` or
+        `watch()`.
+        """
+        self._stop_event.set()
+
+    @property
+    def stopping(self):
+        return self._stop_event.isSet()
+
+    # Number of pages of remote photo ids to fetch concurrently in
+    # `reconcile()`.
+    reconcile_read_ahead = 8
+    # Photos posted within this many seconds before `reconcile()` starts
+    # listing the remote photos are never considered vanished: they may
+    # have been uploaded after the listing got to them.
+    reconcile_grace_period = 60*60
+
+    def reconcile(self, remove=False):
+        """Find photos in the working copy that are no longer on Flickr
+        (deleted, or no longer visible with the working copy's
+        permission), and optionally remove them.
+
+        `photos.recentlyUpdated` doesn't report deleted photos, so this
+        lists the ids of *all* the user's photos -- 500 per page, without
+        extras, with pages fetched concurrently -- into a sorted array,
+        and merges that with the ids in `pics_photo` (in id order, from
+        its index). For 200k photos that is 400 API calls and ~2MB of
+        memory. Each photo missing from the listing is then confirmed
+        gone with a getInfo call: photos deleted during the listing shift
+        the later pages, so others can be missed.
+
+        @param remove {bool} Whether to remove the vanished photos (their
+            files and all their records). By default they are only
+            reported.
+        @returns {list} The ids of the vanished photos.
+        """
+        started = time.time()
+        permission = self.db.get_meta("permission")
+        remote_ids = array("d")  # 8 bytes per id on all platforms
+        for elem in self.api.paging_call("flickr.people.getPhotos",
+                                         read_ahead_=self.reconcile_read_ahead,
+                                         user_id="me", per_page=500):
+            if _is_visible_with_permission(elem, permission):
+                remote_ids.append(int(elem.get("id")))
+        remote_ids = array("d", sorted(remote_ids))
+        log.debug("reconcile: %d remote photos (listed in %.1fs)",
+                  len(remote_ids), time.time() - started)
+
+        vanished = []
+        with self.db.connect(remove) as cu:
+            cu.execute("SELECT p.id, p.datedir, i.title, i.posted "
+                       "FROM pics_photo p LEFT JOIN pics_info i ON i.id = p.id "
+                       "ORDER BY p.id")
+            i, num_remote = 0, len(remote_ids)
+            candidates = []
+            for id, datedir, title, posted in cu.fetchall():
+                while i < num_remote and remote_ids[i] < id:
+                    i += 1
+                if i < num_remote and remote_ids[i] == id:
+                    continue
+                if posted and posted >= started - self.reconcile_grace_period:
+                    continue
+                candidates.append((id, datedir, title or ""))
+            if candidates and not remote_ids:
+                # More likely a problem with the listing than the user
+                # having deleted all their photos.
+                raise PicsError("no photos listed on flickr: refusing to "
+                                "reconcile %d photos" % len(candidates))
+            for id, datedir, title in candidates:
+                if self._is_photo_gone(id, permission, started):
+                    vanished.append((id, datedir, title))
+                else:
+                    log.debug("reconcile: photo %s missed by the listing", id)
+
+            for id, datedir, title in vanished:
+                cu.execute("SELECT filename FROM pics_file WHERE id=?", (id,))
+                filenames = [row[0] for row in cu.fetchall()]
+                if not filenames:
+                    # Photos downloaded by an older pics.
+                    info = self._get_photo_data(id, "info", cu=cu)
+                    if info is not None:
+                        filenames = [self._filename_from_info(info, size)
+                                     for size in self.sizes]
+                if not remove:
+                    summary = utils.one_line_summary_from_text(title, 40)
+                    for filename in filenames:
+                        log.info("gone: %s  [%s]",
+                                 join(self.base_dir, datedir, filename),
+                                 summary)
+                    continue
+                self._remove_photo_files(id, datedir, filenames, title, cu)
+                for table, column in (("pics_photo", "id"),
+                                      ("pics_info", "id"),
+                                      ("pics_search", "docid"),
+                                      ("pics_update", "id")):
+                    cu.execute("DELETE FROM %s WHERE %s=?" % (table, column),
+                               (id,))
+        return [id for id, datedir, title in vanished]
+
+    def _is_photo_gone(self, id, permission, as_of):
+        """Whether the given photo is gone from Flickr, or no longer
+        visible with the given permission, according to getInfo. Only
+        error 1 ("Photo not found") means it is gone.
+
+        @param as_of {float} The time of the reconcile. It is the cache
+            version of the getInfo call, so a cached response isn't used.
+        """
+        try:
+            info = self.api.photos_getInfo(photo_id=id,
+                cache_version_="reconcile-%d" % as_of)[0]
+        except simpleflickrapi.FlickrAPIError, ex:
+            if ex.code == 1:
+                return True
+            raise
+        return not _is_visible_with_permission(info.find("visibility"),
+                                               permission)
+
+    def _iter_update_rows(self, recents, permission):
+        """Generate `pics_update` rows for the given `recentlyUpdated`
+        <photo> elems that are visible with the given permission.
+        """
+        for elem in recents:
+            if not _is_visible_with_permission(elem, permission):
+                continue
+            elem.tail = None
+            yield (elem.get("id"), elem.get("lastupdate"), ET.tostring(elem))
+
+    def _iter_photo_updates(self, cu):
+        """Generate a `_PhotoUpdate` for each photo in the `pics_update`
+        queue.
+        """
+        for id, lastupdate, photo in cu.fetchall():
+            # `photo` is NULL for photos queued by an older pics. (Note: an
+            # Element without children is false, so no and/or idiom here.)
+            if photo:
+                elem = ET.fromstring(photo)
+            else:
+                elem = None
+            # Determine if this is an add, update, conflict or merge.
+            # (Deleted photos aren't in `recentlyUpdated`: see
+            # `reconcile()`.)
+            cu.execute("SELECT * FROM pics_photo WHERE id=?", (id,))
+            row = cu.fetchone()
+            if row is None:
+                yield _PhotoUpdate(id, lastupdate, elem, "A") # adding a new photo
+                continue
+            local_datedir = row[1]
+            local_info = self._get_photo_data(id, "info", cu=cu)
+            if local_info is None:
+                #TODO: might have been a locally deleted file
+                yield _PhotoUpdate(id, lastupdate, elem, "A")  # restore?
+            else:
+                #TODO: support local changes would be handled here:
+                #  `status()` detects changed photo files (comparing
+                #  with the MD5 of the download, via the stat cache).
+                yield _PhotoUpdate(id, lastupdate, elem, "U", local_datedir,
+                                   local_info)
+
+    def _update(self, dry_run=False, jobs=None):
         #TODO: when support local edits, need to check for conflicts
         #      and refuse to update if hit one
 
@@ -597,73 +1305,76 @@ class WorkingCopy(object):
             # After commiting this it is okay if this script is aborted
             # during the actual update: a subsequent 'pics up' will
             # continue where we left off.
+            # The extras allow deciding what to download without a
+            # getInfo call per photo.
+            extras = "last_update,date_taken,original_format,media,o_dims"
+            for size in self.sizes:
+                if size in _url_extra_from_size:
+                    extras += "," + _url_extra_from_size[size]
             recents = self.api.paging_call(
                 "flickr.photos.recentlyUpdated",
                 min_date=min_date,
-                extras="last_update")
-            for elem in recents:
-                id = elem.get("id")
-                isfamily = bool(int(elem.get("isfamily")))
-                isfriend = bool(int(elem.get("isfriend")))
-                ispublic = bool(int(elem.get("ispublic")))
-                if permission == "all":
-                    pass
-                elif ispublic:
-                    pass
-                elif permission == "family" and isfamily:
-                    pass
-                elif permission == "friend" and isfriend:
-                    pass
-                else:
-                    continue
-                cu.execute("INSERT OR REPLACE INTO pics_update VALUES (?)", (id,))
+                extras=extras)
+            cu.executemany("INSERT OR REPLACE INTO pics_update VALUES (?,?,?)",
+                           self._iter_update_rows(recents, permission))
             if not dry_run:
                 cu.connection.commit()
 
-            # Do each update.
-            cu.execute("SELECT id FROM pics_update")
-            ids = [row[0] for row in cu]
-            for id in ids:
-                # Determine if this is an add, update, conflict, merge or delete.
-                #TODO: test a delete (does recent updates show that?)
-                cu.execute("SELECT * FROM pics_photo WHERE id=?", (id,))
-                row = cu.fetchone()
-                if row is None:
-                    action = "A" # adding a new photo
-                else:
-                    local_datedir = row[1]
-                    local_info = self._get_photo_data(local_datedir, id, "info")
-                    if local_info is None:
-                        #TODO: might have been a locally deleted file
-                        action = "A"  # restore?
-                    else:
-                        #TODO: support local changes would be handled here:
-                        #  Maintain MD5 of photo and info files and
-                        #  detect changes that way.
-                        action = "U"
-
-                # Handle the action.
-                if action == "A":
-                    datedir, last_update = self._add_photo(id, dry_run=dry_run)
-                    cu.execute("INSERT INTO pics_photo VALUES (?,?)", (id, datedir))
-                elif action == "U":
-                    datedir, last_update = self._update_photo(
-                        id, local_datedir, local_info, dry_run=dry_run)
-                    if datedir != local_datedir:
-                        XXX # test this case
-                        cu.execute("UPDATE pics_photo SET datedir=? WHERE id=?",
-                                   (datedir, id))
-                else:
-                    raise PicsError("unexpected update action: %r" % action)
-
-                # Note this update.
-                self.set_last_update(last_update, cu)
-                cu.execute("DELETE FROM pics_update WHERE id=?", (id,))
-                if not dry_run:
-                    cu.connection.commit()
+            # Do each update, newest first.
+            # Photo info and downloads are fetched concurrently (see
+            # `_UpdatePipeline`), and the updates are applied from this
+            # thread as they complete.
+            cu.execute("SELECT id, lastupdate, photo FROM pics_update "
+                       "ORDER BY CAST(lastupdate AS INTEGER) DESC")
+            if dry_run:
+                pipeline = _UpdatePipeline(self._plan_photo_update, None,
+                    None, jobs or self.update_jobs)
+            else:
+                pipeline = _UpdatePipeline(self._plan_photo_update,
+                    self._fetch_photo_update, self._download_photo_update,
+                    jobs or self.update_jobs,
+                    video_jobs=self.update_video_jobs)
+            # The bookkeeping for applied updates is committed in batches
+            # (see `update_batch_size` and `update_batch_interval`).
+            # Photos not yet committed stay in the `pics_update` queue,
+            # and "last-update" is only advanced in the batch's
+            # transaction, so an aborted update is still resumed.
+            batch_size = 0
+            batch_last_update = None
+            batch_started = time.time()
+            num_updates = 0
+            for upd in pipeline.run(self._iter_photo_updates(cu)):
+                self._apply_photo_update(upd, cu, dry_run=dry_run)
+                num_updates += 1
+                batch_size += 1
+                if batch_last_update is None \
+                   or upd.last_update > batch_last_update:
+                    batch_last_update = upd.last_update
+                if (batch_size >= self.update_batch_size
+                    or time.time() - batch_started
+                       >= self.update_batch_interval):
+                    self._commit_update_batch(cu, batch_last_update,
+                                              dry_run=dry_run)
+                    batch_size = 0
+                    batch_last_update = None
+                    batch_started = time.time()
+                if self._stop_event.isSet():
+                    log.info("update stopped: the remaining updates are "
+                             "queued for the next update")
+                    break
+            if batch_size:
+                self._commit_update_batch(cu, batch_last_update,
+                                          dry_run=dry_run)
 
-        log.info("Up to date (latest update: %s UTC).",
-                 self.get_last_update().strftime("%Y %b %d, %H:%M:%S"))
+        last_update = self.get_last_update()
+        if self._stop_event.isSet():
+            pass
+        elif last_update is None:
+            log.info("Up to date (no photos).")
+        else:
+            log.info("Up to date (latest update: %s UTC).",
+                     last_update.strftime("%Y %b %d, %H:%M:%S"))
+        return num_updates
 
         #TODO: Handle favs, tags, sets.
         #      Need to use activity.userPhotos() to update these?
@@ -684,6 +1395,224 @@ class WorkingCopy(object):
 
 #---- internal support stuff
 
+class _PhotoUpdate(object):
+    """The state of the update of one photo as it passes through the
+    stages of `WorkingCopy.update`.
+    """
+    def __init__(self, id, lastupdate, elem, action, local_datedir=None,
+                 local_info=None):
+        self.id = id
+        self.lastupdate = lastupdate
+        self.elem = elem  # <photo> elem from `recentlyUpdated`, if any
+        self.action = action  # "A" (add) or "U" (update)
+        self.local_datedir = local_datedir
+        self.local_info = local_info
+        # Set by the plan and metadata stages.
+        self.info = None
+        self.comments = None
+        self.title = None
+        self.datedir = None
+        self.last_update = None
+        self.filename = None  # of the primary size
+        self.todos = []
+        # (<size>, <url>, <filename>) for each file to download.
+        self.downloads = []
+        # <size> -> <blob key>, if using a blob store.
+        self.blob_key_from_size = {}
+        # Set by the download stage:
+        #   <size> -> (<filename>, <bytes>, <md5>, <stat-key>)
+        self.files = {}
+        # Set when the update is ready for the writer (or has failed).
+        self.exc_info = None
+        self._done = False
+        self._stages_left = 1
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<_PhotoUpdate %s %s>" % (self.action, self.id)
+
+    @property
+    def is_video(self):
+        # Videos queued by an older pics (without `elem`) are missed.
+        return self.elem is not None and self.elem.get("media") == "video"
+
+    def _add_stage(self):
+        with self._lock:
+            self._stages_left += 1
+
+    def _finish_stage(self):
+        """Returns true if that was the last stage."""
+        with self._lock:
+            self._stages_left -= 1
+            if self._stages_left or self._done:
+                return False
+            self._done = True
+            return True
+
+    def _fail(self, exc_info):
+        """Returns true if the update wasn't already done (or failed)."""
+        with self._lock:
+            if self._done:
+                return False
+            self.exc_info = exc_info
+            self._done = True
+            return True
+
+class _UpdatePipeline(object):
+    """Run photo updates through a pool of metadata workers and pools of
+    download workers, handing each back to the (single) writer as it
+    completes.
+
+    A metadata worker plans a photo update, hands each of its files to
+    download off to the download workers and then fetches the rest of
+    its metadata, while the downloads proceed. The files of a photo
+    (one per size) are downloaded concurrently.
+
+    Videos are downloaded in their own lane, by `video_jobs` workers, and
+    at most `video_jobs * 2` videos are in flight at once (later photos
+    are started ahead of the videos beyond that). Updates are handed to
+    the writer in the order they complete, not the given order, so a
+    multi-GB video doesn't hold up the photos behind it.
+
+    @param plan {callable} The plan stage, called with a `_PhotoUpdate`.
+    @param fetch {callable} The metadata stage, called with a planned
+        `_PhotoUpdate`. If None, there is no metadata stage.
+    @param download {callable} The download stage, called with a planned
+        `_PhotoUpdate` and each of its `downloads`. If None, there is no
+        download stage.
+    @param jobs {int} The number of metadata workers, and of (photo)
+        download workers.
+    @param window {int} Max number of photo updates in flight ahead of
+        the writer. Default is 4 times `jobs`.
+    @param video_jobs {int} The number of video download workers.
+        Default is a quarter of `jobs` (at least 1).
+    """
+    def __init__(self, plan, fetch, download, jobs, window=None,
+                 video_jobs=None):
+        self.plan = plan
+        self.fetch = fetch
+        self.download = download
+        self.jobs = max(1, jobs)
+        self.window = window or self.jobs * 4
+        self.video_jobs = video_jobs or max(1, self.jobs // 4)
+        self.video_window = self.video_jobs * 2
+        self._fetch_queue = Queue.Queue()
+        self._download_queue = Queue.Queue()
+        self._video_download_queue = Queue.Queue()
+        self._done_queue = Queue.Queue()
+        self._stopped = False
+
+    def _start(self):
+        workers = [(self._fetch_queue, self._fetch_stage)] * self.jobs
+        if self.download is not None:
+            workers += [(self._download_queue, self._download_stage)] \
+                       * self.jobs
+            workers += [(self._video_download_queue, self._download_stage)] \
+                       * self.video_jobs
+        for queue, stage in workers:
+            t = threading.Thread(target=self._worker, args=(queue, stage))
+            t.setDaemon(True)
+            t.start()
+
+    def _worker(self, queue, stage):
+        while True:
+            args = queue.get()  # (<photo-update>, ...)
+            if args is None:
+                return
+            upd = args[0]
+            if self._stopped:
+                continue
+            try:
+                done = stage(*args)
+            except:
+                done = upd._fail(sys.exc_info())
+            if done:
+                self._done_queue.put(upd)
+
+    def _fetch_stage(self, upd):
+        self.plan(upd)
+        if self.download is not None:
+            if upd.is_video:
+                queue = self._video_download_queue
+            else:
+                queue = self._download_queue
+            for download in upd.downloads:
+                upd._add_stage()
+                queue.put((upd, download))
+        if self.fetch is not None:
+            self.fetch(upd)
+        return upd._finish_stage()
+
+    def _download_stage(self, upd, download):
+        self.download(upd, download)
+        return upd._finish_stage()
+
+    def _next_done(self):
+        # Wait with a timeout so a Ctrl+C isn't blocked.
+        while True:
+            try:
+                upd = self._done_queue.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            break
+        if upd.exc_info is not None:
+            exc_info, upd.exc_info = upd.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return upd
+
+    def run(self, updates):
+        """Generate each of the given `_PhotoUpdate`s once its metadata
+        and download stages are complete. The first error from a stage
+        is re-raised here.
+        """
+        updates = iter(updates)
+        deferred_videos = deque()  # waiting for room in `video_window`
+        num_in_flight = num_videos_in_flight = 0
+        self._start()
+        try:
+            while True:
+                # Start as many updates as the windows allow.
+                while num_in_flight < self.window:
+                    if deferred_videos \
+                       and num_videos_in_flight < self.video_window:
+                        upd = deferred_videos.popleft()
+                    elif updates is not None \
+                         and len(deferred_videos) < self.window:
+                        try:
+                            upd = updates.next()
+                        except StopIteration:
+                            updates = None
+                            continue
+                        if upd.is_video \
+                           and num_videos_in_flight >= self.video_window:
+                            deferred_videos.append(upd)
+                            continue
+                    else:
+                        break
+                    self._fetch_queue.put((upd,))
+                    num_in_flight += 1
+                    if upd.is_video:
+                        num_videos_in_flight += 1
+                if not num_in_flight:
+                    break
+                upd = self._next_done()
+                num_in_flight -= 1
+                if upd.is_video:
+                    num_videos_in_flight -= 1
+                yield upd
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the workers. Photo updates not yet started are dropped."""
+        self._stopped = True
+        for i in range(self.jobs):
+            self._fetch_queue.put(None)
+            self._download_queue.put(None)
+        for i in range(self.video_jobs):
+            self._video_download_queue.put(None)
+
+
 class Database(object):
     """Wrapper API for the working copy's sqlite database."""
     # Database version.
@@ -698,7 +1627,86 @@ class Database(object):
     #
     # db change log:
     # - 1.0.0: initial version
-    VERSION = "1.0.0"
+    # - 1.1.0: add `pics_update.lastupdate`
+    # - 1.2.0: add `pics_update.photo`
+    # - 1.3.0: add `pics_photo.size` and `pics_photo.md5`
+    # - 1.4.0: add the `pics_info` catalog, replacing the per-photo
+    #   ".pics/<id>-info.xml" and ".pics/<id>-comments.xml" files
+    # - 1.5.0: add the `pics_search` full-text index
+    # - 1.6.0: add `pics_info.tags`
+    # - 1.7.0: add the `pics_stat` stat cache
+    # - 1.8.0: add `pics_file`, for working copies of multiple sizes
+    VERSION = "1.8.0"
+
+    # The photo metadata catalog: structured columns from the photo's
+    # getInfo response, and the raw getInfo and comments.getList
+    # responses, zlib-compressed. `tags` is the newline-separated raw
+    # tags. (`IF NOT EXISTS` so an interrupted
+    # upgrade can be re-run.)
+    catalog_schema = """
+        CREATE TABLE IF NOT EXISTS pics_info (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            ownername TEXT,
+            taken TEXT,
+            posted INTEGER,
+            lastupdate INTEGER,
+            ispublic INTEGER,
+            isfriend INTEGER,
+            isfamily INTEGER,
+            media TEXT,
+            secret TEXT,
+            originalsecret TEXT,
+            originalformat TEXT,
+            num_tags INTEGER,
+            num_comments INTEGER,
+            tags TEXT,
+            info BLOB,
+            comments BLOB
+        );
+        CREATE INDEX IF NOT EXISTS pics_info_taken ON pics_info(taken);
+        CREATE INDEX IF NOT EXISTS pics_info_lastupdate
+            ON pics_info(lastupdate);
+        CREATE INDEX IF NOT EXISTS pics_photo_datedir ON pics_photo(datedir);
+    """
+
+    # Full-text index of photo metadata for `WorkingCopy.find`. The docid
+    # is the photo id.
+    search_schema = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS pics_search USING fts4(
+            title,
+            description,
+            tags,
+            comments
+        );
+    """
+
+    # Stat cache for `WorkingCopy.status`: the size, mtime and inode of
+    # each photo file (path relative to the base dir) when its content
+    # MD5 was last computed.
+    stat_schema = """
+        CREATE TABLE IF NOT EXISTS pics_stat (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            ino INTEGER,
+            md5 TEXT
+        );
+    """
+
+    # The downloaded files of each photo, one per photo size, with the
+    # byte size and MD5 of the download. (`pics_photo.size` and `.md5`
+    # are for the working copy's first size.)
+    file_schema = """
+        CREATE TABLE IF NOT EXISTS pics_file (
+            id INTEGER,
+            size TEXT,
+            filename TEXT,
+            bytes INTEGER,
+            md5 TEXT,
+            PRIMARY KEY (id, size)
+        );
+    """
 
     schema = """
         CREATE TABLE pics_meta (
@@ -706,21 +1714,46 @@ class Database(object):
             value TEXT
         );
 
-        -- List of photos in the working copy.
+        -- List of photos in the working copy, with the size and MD5
+        -- of the downloaded photo file.
         CREATE TABLE pics_photo (
             id INTEGER UNIQUE,
-            datedir TEXT
+            datedir TEXT,
+            size INTEGER,
+            md5 TEXT
         );
 
-        -- List of photos to update.
+        -- List of photos to update. `photo` is the serialized <photo>
+        -- element from `photos.recentlyUpdated`.
         CREATE TABLE pics_update (
-            id INTEGER UNIQUE
+            id INTEGER UNIQUE,
+            lastupdate TEXT,
+            photo TEXT
         );
-    """
+    """ + catalog_schema + search_schema + stat_schema + file_schema
+
+    # Pragmas for each connection. "synchronous=NORMAL" is safe with WAL
+    # journaling and saves an fsync per commit.
+    pragmas = [
+        "synchronous=NORMAL",
+        "cache_size=-8000",       # 8MB
+        "mmap_size=67108864",     # 64MB
+    ]
+    # Number of prepared statements to cache per connection.
+    cached_statements = 256
 
     path = None
     def __init__(self, path):
         self.path = path
+        # Connections are long-lived, one per thread. With WAL journaling
+        # this allows a writer and concurrent readers.
+        self._local = threading.local()
+        self._cxs = []
+        self._cxs_lock = threading.Lock()
+        # Write-through cache of `pics_meta`. It is dropped whenever
+        # another connection (e.g. another `pics` process) has committed
+        # changes: see `_check_data_version()`.
+        self._meta_cache = {}
         if not exists(self.path):
             self.create()
         else:
@@ -729,14 +1762,48 @@ class Database(object):
             except Exception, ex:
                 log.exception("error upgrading `%s': %s", self.path, ex)
                 self.reset()
+        # Use write-ahead logging, so readers (e.g. `pics ls`) don't
+        # block on, or block, an update. This is persistent.
+        with self.connect() as cu:
+            cu.execute("PRAGMA journal_mode=WAL")
 
     def __repr__(self):
         return "<Database %s>" % self.path
 
+    def _get_cx(self):
+        """Return this thread's connection, opening it if necessary."""
+        cx = getattr(self._local, "cx", None)
+        if cx is None:
+            # Only used from this thread, but `close()` may be called
+            # from another.
+            cx = sqlite3.connect(self.path, check_same_thread=False,
+                                 cached_statements=self.cached_statements)
+            for pragma in self.pragmas:
+                cx.execute("PRAGMA " + pragma)
+            self._local.cx = cx
+            self._local.depth = 0
+            self._local.data_version = None
+            with self._cxs_lock:
+                self._cxs.append(cx)
+        return cx
+
+    def close(self):
+        """Close all the connections to the database."""
+        with self._cxs_lock:
+            cxs, self._cxs = self._cxs, []
+        for cx in cxs:
+            cx.close()
+        self._local = threading.local()
+        self._meta_cache.clear()
+
     @contextmanager
     def connect(self, commit=False, cu=None):
-        """A context manager for a database connection/cursor. It will automatically
-        close the connection and cursor.
+        """A context manager for a database cursor. It will automatically
+        close the cursor and end the transaction.
+
+        The connection itself is long-lived (one per thread). If the
+        calling thread is already in a `connect()` block, the outer block
+        decides whether the transaction is committed.
 
         Usage:
             with self.connect() as cu:
@@ -752,22 +1819,51 @@ class Database(object):
             See "Controlling Transations" in Python's sqlite3 docs for
             details.
         @param cu {sqlite3.Cursor} An existing cursor to use. This allows
-            callers to avoid the overhead of another db connection when
+            callers to avoid the overhead of another cursor when
             already have one, while keeping the same "with"-statement
             call structure.
         """
         if cu is not None:
             yield cu
         else:
-            cx = sqlite3.connect(self.path)
+            cx = self._get_cx()
             cu = cx.cursor()
+            if self._local.depth == 0:
+                self._local.changes = cx.total_changes
+                self._check_data_version(cx)
+            self._local.depth += 1
             try:
                 yield cu
             finally:
-                if commit:
-                    cx.commit()
+                self._local.depth -= 1
                 cu.close()
-                cx.close()
+                if self._local.depth == 0:
+                    if commit:
+                        cx.commit()
+                    else:
+                        # Discard uncommitted changes (as closing a
+                        # per-call connection used to), including any
+                        # to cached meta values.
+                        cx.rollback()
+                        if cx.total_changes != self._local.changes:
+                            self._meta_cache.clear()
+
+    def _check_data_version(self, cx):
+        """Drop the meta cache if changes have been committed by other
+        connections since this thread's connection last checked.
+        (`PRAGMA data_version` only changes for commits by others.)
+        """
+        data_version = cx.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._local.data_version:
+            self._local.data_version = data_version
+            self._meta_cache.clear()
+
+    def checkpoint(self):
+        """Checkpoint the write-ahead log into the database file (and
+        truncate it).
+        """
+        with self.connect() as cu:
+            cu.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
     def create(self):
         """Create the database file."""
@@ -784,6 +1880,7 @@ class Database(object):
         @param backup {bool} Should the original database be backed up.
             If so, the backup is $database_file+".bak". Default true.
         """
+        self.close()
         if backup:
             backup_path = self.path + ".bak"
             if exists(backup_path):
@@ -823,9 +1920,116 @@ class Database(object):
         assert result_ver == self.VERSION
         self.reset()
 
+    def _upgrade_add_update_lastupdate(self, curr_ver, result_ver):
+        """Upgrader that adds the `pics_update.lastupdate` column."""
+        with self.connect(True) as cu:
+            cu.execute("ALTER TABLE pics_update ADD COLUMN lastupdate TEXT")
+            self.set_meta("version", result_ver, cu=cu)
+
+    def _upgrade_add_columns(self, curr_ver, result_ver, table_and_columns):
+        """Upgrader that adds the given (<table>, [<column-def>, ...])
+        columns.
+        """
+        table, columns = table_and_columns
+        with self.connect(True) as cu:
+            for column in columns:
+                cu.execute("ALTER TABLE %s ADD COLUMN %s" % (table, column))
+            self.set_meta("version", result_ver, cu=cu)
+
+    def _upgrade_to_catalog(self, curr_ver, result_ver):
+        """Upgrader that moves the photo metadata in the ".pics/<id>-*.xml"
+        files of each photo dir into the `pics_info` catalog.
+
+        The files are read, parsed and compressed in parallel (see
+        `_parallel_imap`). They are only removed once the catalog is
+        committed.
+        """
+        base_dir = dirname(dirname(self.path))
+        with self.connect(True) as cu:
+            cu.executescript(self.catalog_schema)
+            cu.execute("SELECT id, datedir FROM pics_photo")
+            photos = [(base_dir, datedir, id) for id, datedir in cu]
+            log.info("moving metadata for %d photos into the catalog",
+                     len(photos))
+            rows = _parallel_imap(_catalog_row_from_photo_files, photos)
+            cu.executemany(_catalog_insert_sql,
+                (_catalog_db_row(row) for row in rows if row is not None))
+            self.set_meta("version", result_ver, cu=cu)
+
+        for base_dir, datedir, id in photos:
+            for type in ("info", "comments"):
+                path = _photo_data_path(base_dir, datedir, id, type)
+                if exists(path):
+                    os.remove(path)
+
+    def _upgrade_add_search(self, curr_ver, result_ver):
+        """Upgrader that adds the `pics_search` full-text index and
+        indexes the photos in the catalog.
+        """
+        with self.connect(True) as cu:
+            cu.executescript(self.search_schema)
+            cu.execute("DELETE FROM pics_search")
+            cu.execute("SELECT info, comments FROM pics_info")
+            blobs = [(str(info), comments and str(comments) or None)
+                     for info, comments in cu]
+            log.info("indexing %d photos for search", len(blobs))
+            cu.executemany(_search_insert_sql,
+                           _parallel_imap(_search_row_from_blobs, blobs))
+            self.set_meta("version", result_ver, cu=cu)
+
+    def _upgrade_add_info_tags(self, curr_ver, result_ver):
+        """Upgrader that adds the `pics_info.tags` column and fills it in
+        from the catalog's info XML.
+        """
+        with self.connect(True) as cu:
+            cu.execute("PRAGMA table_info(pics_info)")
+            # The column is already there if the catalog was created by
+            # the 1.3.0 upgrader.
+            if "tags" not in [row[1] for row in cu.fetchall()]:
+                cu.execute("ALTER TABLE pics_info ADD COLUMN tags TEXT")
+            cu.execute("SELECT id, info FROM pics_info WHERE tags IS NULL")
+            blobs = [(id, str(info)) for id, info in cu]
+            cu.executemany("UPDATE pics_info SET tags=? WHERE id=?",
+                           _parallel_imap(_tags_row_from_blob, blobs))
+            self.set_meta("version", result_ver, cu=cu)
+
+    def _upgrade_run_script(self, curr_ver, result_ver, script):
+        """Upgrader that runs the given SQL script, e.g. to add tables."""
+        with self.connect(True) as cu:
+            cu.executescript(script)
+            self.set_meta("version", result_ver, cu=cu)
+
+    def _upgrade_add_files(self, curr_ver, result_ver):
+        """Upgrader that adds the `pics_file` table, with the files of the
+        (then single size) working copy.
+        """
+        with self.connect(True) as cu:
+            cu.executescript(self.file_schema)
+            size = self.get_meta("size", cu=cu)
+            cu.execute("SELECT p.id, i.media, i.originalformat, p.size, p.md5 "
+                       "FROM pics_photo p JOIN pics_info i ON i.id = p.id")
+            rows = []
+            for id, media, originalformat, nbytes, md5 in cu.fetchall():
+                filename = _photo_filename_from_info({"id": id,
+                    "media": media, "originalformat": originalformat}, size)
+                rows.append((id, size, filename, nbytes, md5))
+            cu.executemany("INSERT OR REPLACE INTO pics_file "
+                           "VALUES (?,?,?,?,?)", rows)
+            self.set_meta("version", result_ver, cu=cu)
+
     _upgrade_info_from_curr_ver = {
         # <current version>: (<resultant version>, <upgrader method>, <upgrader args>)
         # e.g.: "1.0.0": (VERSION, _upgrade_reset_db, None),
+        "1.0.0": ("1.1.0", _upgrade_add_update_lastupdate, None),
+        "1.1.0": ("1.2.0", _upgrade_add_columns,
+                  ("pics_update", ["photo TEXT"])),
+        "1.2.0": ("1.3.0", _upgrade_add_columns,
+                  ("pics_photo", ["size INTEGER", "md5 TEXT"])),
+        "1.3.0": ("1.4.0", _upgrade_to_catalog, None),
+        "1.4.0": ("1.5.0", _upgrade_add_search, None),
+        "1.5.0": ("1.6.0", _upgrade_add_info_tags, None),
+        "1.6.0": ("1.7.0", _upgrade_run_script, stat_schema),
+        "1.7.0": ("1.8.0", _upgrade_add_files, None),
     }
 
     @property
@@ -844,12 +2048,19 @@ class Database(object):
         @param cu {sqlite3.Cursor} An existing cursor to use.
         @returns {str} The value in the database for this key, or `default`.
         """
-        with self.connect(cu=cu) as cu:
-            cu.execute("SELECT value FROM pics_meta WHERE key=?", (key,))
-            row = cu.fetchone()
-            if row is None:
-                return default
-            return row[0]
+        if cu is None and not getattr(self._local, "depth", 0):
+            # Not in a `connect()` block, which would have checked.
+            self._check_data_version(self._get_cx())
+        try:
+            value = self._meta_cache[key]
+        except KeyError:
+            with self.connect(cu=cu) as cu:
+                cu.execute("SELECT value FROM pics_meta WHERE key=?", (key,))
+                row = cu.fetchone()
+            value = self._meta_cache[key] = row and row[0]
+        if value is None:
+            return default
+        return value
 
     def set_meta(self, key, value, cu=None):
         """Set a value into the meta table.
@@ -862,6 +2073,7 @@ class Database(object):
         with self.connect(True, cu=cu) as cu:
             cu.execute("INSERT INTO pics_meta(key, value) VALUES (?, ?)",
                 (key, value))
+        self._meta_cache[key] = unicode(value)
 
     def del_meta(self, key):
         """Delete a key/value pair from the meta table.
@@ -870,16 +2082,354 @@ class Database(object):
         """
         with self.connect(True) as cu:
             cu.execute("DELETE FROM pics_meta WHERE key=?", (key,))
+        self._meta_cache[key] = None
+
+# The "label" attribute of the `getSizes` <size> element to download
+# for a video, for each pics size.
+_video_label_from_size = {
+    "square": "Mobile MP4",
+    "thumbnail": "Mobile MP4",
+    "small": "Mobile MP4",
+    "medium": "HD MP4",
+    "medium640": "HD MP4",
+    "large": "HD MP4",
+    "original": "Video Original",
+}
+
+# The `recentlyUpdated` extra for the URL of each pics size.
+_url_extra_from_size = {
+    "square": "url_sq",
+    "thumbnail": "url_t",
+    "small": "url_s",
+    "medium": "url_m",
+    "medium640": "url_z",
+    "large": "url_l",
+    "original": "url_o",
+}
+
+# The following helpers work with the <photo> elem from either a getInfo
+# response or a photo list response (with the relevant extras).
+
+def _photo_lastupdate_from_info(info):
+    """The raw "lastupdate" timestamp string from the <photo> elem."""
+    dates = info.find("dates")
+    if dates is None:
+        return info.get("lastupdate")
+    return dates.get("lastupdate")
+
+def _photo_datedir_from_info(info):
+    """The working copy date dir, YYYY-MM of the date taken, for the
+    <photo> elem.
+    """
+    dates = info.find("dates")
+    if dates is None:
+        return info.get("datetaken")[:7]
+    return dates.get("taken")[:7]
 
 def _photo_last_update_from_info(info):
-    lastupdate = info.find("dates").get("lastupdate")
+    lastupdate = _photo_lastupdate_from_info(info)
     return datetime.datetime.utcfromtimestamp(float(lastupdate))
 
+def _photo_filename_from_info(info, size="original"):
+    """The working copy filename for the given size of the <photo> elem
+    (or a dict with its "id", "media" and "originalformat").
+    """
+    id = info.get("id")
+    if info.get("media") == "video":
+        label = _video_label_from_size[size]
+        return "%s.%s.mov" % (id, label.lower().replace(' ', '-'))
+    elif size == "original":
+        ext = '.' + info.get("originalformat")
+    else:
+        ext = ".jpg"
+    return "%s.%s%s" % (id, size, ext)
+
+def _is_visible_with_permission(elem, permission):
+    """Whether the given <photo> elem (from a photo list API call) is
+    visible with the given working copy permission.
+    """
+    if permission == "all" or int(elem.get("ispublic")):
+        return True
+    elif permission == "family":
+        return bool(int(elem.get("isfamily")))
+    elif permission == "friend":
+        return bool(int(elem.get("isfriend")))
+    return False
+
+def _blob_key_from_info(info, size):
+    """The `BlobStore` key for the given size of the given photo: its id,
+    the secret for that size, and the size.
+
+    @param info {xml.etree.Element|dict} A <photo> elem, or a dict with
+        "id", "secret" and "originalsecret".
+    """
+    secret = (size == "original" and info.get("originalsecret")
+              or info.get("secret"))
+    return "%s_%s_%s" % (info.get("id"), secret, size)
+
 def _photo_num_comments_from_info(info):
     """The number of comments from the <photo> elem."""
     comments = info.findtext("comments")
     return int(comments)
 
+# The `pics_info` columns, in the order of a `_catalog_row_from_xml` row.
+_catalog_columns = ["id", "title", "ownername", "taken", "posted",
+    "lastupdate", "ispublic", "isfriend", "isfamily", "media", "secret",
+    "originalsecret", "originalformat", "num_tags", "num_comments", "tags",
+    "info", "comments"]
+
+_catalog_insert_sql = "INSERT OR REPLACE INTO pics_info (%s) VALUES (%s)" \
+    % (', '.join(_catalog_columns), ','.join(['?'] * len(_catalog_columns)))
+
+def _photo_tags_from_info(info):
+    """The newline-separated raw tags of the getInfo <photo> elem."""
+    return '\n'.join(t.get("raw") or t.text or ''
+                     for t in info.findall("tags/tag"))
+
+def _tags_row_from_blob(id_and_blob):
+    """Return a (<tags>, <id>) row from the given compressed info XML."""
+    id, blob = id_and_blob
+    return _photo_tags_from_info(ET.fromstring(zlib.decompress(blob))), id
+
+def _catalog_row_from_xml(info_xml, comments_xml=None, info=None):
+    """Return a `pics_info` row for the given serialized getInfo <photo>
+    and comments.getList <comments> elements.
+
+    The XML blobs in the row are zlib-compressed strings: use
+    `_catalog_db_row()` to insert the row. (Plain strings so that rows
+    can be passed between processes.)
+
+    @param info {xml.etree.Element} Optional. The parsed `info_xml`, if
+        already available.
+    """
+    if info is None:
+        info = ET.fromstring(info_xml)
+    dates = info.find("dates")
+    visibility = info.find("visibility")
+    owner = info.find("owner")
+    return (
+        int(info.get("id")),
+        info.findtext("title"),
+        owner is not None and owner.get("username") or None,
+        dates.get("taken"),
+        int(dates.get("posted")),
+        int(dates.get("lastupdate")),
+        int(visibility.get("ispublic")),
+        int(visibility.get("isfriend")),
+        int(visibility.get("isfamily")),
+        info.get("media", "photo"),
+        info.get("secret"),
+        info.get("originalsecret"),
+        info.get("originalformat"),
+        len(info.findall("tags/tag")),
+        _photo_num_comments_from_info(info),
+        _photo_tags_from_info(info),
+        zlib.compress(info_xml),
+        comments_xml and zlib.compress(comments_xml) or None,
+    )
+
+def _catalog_db_row(row):
+    """Wrap the compressed XML of the given `pics_info` row as blobs."""
+    info, comments = row[-2:]
+    return row[:-2] + (sqlite3.Binary(info),
+                       comments and sqlite3.Binary(comments) or None)
+
+def _photo_data_path(base_dir, datedir, id, type):
+    """The path of a pre-v1.4.0 ".pics/<id>-<type>.xml" photo data file."""
+    return join(base_dir, datedir, ".pics", "%s-%s.xml" % (id, type))
+
+def _catalog_row_from_photo_files(photo):
+    """Return a `pics_info` row from the given photo's pre-v1.4.0 photo
+    data files, or None if it has none.
+
+    @param photo {tuple} (<base-dir>, <datedir>, <id>)
+    """
+    base_dir, datedir, id = photo
+    xmls = []
+    for type in ("info", "comments"):
+        path = _photo_data_path(base_dir, datedir, id, type)
+        if not exists(path):
+            xmls.append(None)
+            continue
+        f = open(path, 'rb')
+        try:
+            xmls.append(f.read())
+        finally:
+            f.close()
+    info_xml, comments_xml = xmls
+    if info_xml is None:
+        return None
+    try:
+        return _catalog_row_from_xml(info_xml, comments_xml)
+    except SyntaxError, ex:  # ElementTree's parse error
+        log.warn("`%s': corrupt photo data (skipping): %s",
+                 _photo_data_path(base_dir, datedir, id, "info"), ex)
+        return None
+
+_search_insert_sql = "INSERT INTO pics_search(docid, title, description, "\
+                     "tags, comments) VALUES (?,?,?,?,?)"
+
+def _search_row_from_info(info, comments=None):
+    """Return a `pics_search` row for the given getInfo <photo> and
+    comments.getList <comments> elements.
+    """
+    tags = []
+    for tag in info.findall("tags/tag"):
+        tags.append(tag.text or '')
+        if tag.get("raw") and tag.get("raw") != tag.text:
+            tags.append(tag.get("raw"))
+    return (
+        int(info.get("id")),
+        info.findtext("title"),
+        info.findtext("description"),
+        ' '.join(tags),
+        comments is not None
+            and '\n'.join(c.text or '' for c in comments.findall("comment"))
+            or None,
+    )
+
+def _search_row_from_blobs(blobs):
+    """Return a `pics_search` row from the given compressed
+    (<info-xml>, <comments-xml>) of a `pics_info` row.
+    """
+    info, comments = blobs
+    if comments is not None:
+        comments = ET.fromstring(zlib.decompress(comments))
+    return _search_row_from_info(ET.fromstring(zlib.decompress(info)),
+                                 comments)
+
+# The columns selected by `_search_sql_from_query`.
+_photo_list_columns = ["id", "datedir", "title", "ownername", "taken",
+    "posted", "lastupdate", "ispublic", "isfriend", "isfamily", "media",
+    "originalformat", "num_tags", "num_comments", "tags"]
+
+# The fields in the "json" and "tsv" `WorkingCopy.list` formats.
+_list_fields = ["id", "path", "title", "ownername", "taken", "posted",
+    "lastupdate", "ispublic", "isfriend", "isfamily", "media", "num_tags",
+    "num_comments"]
+
+_tsv_escape_pat = re.compile(r"[\t\r\n]")
+
+# The ORDER BY columns for each `WorkingCopy.list` sort key.
+_sort_columns_from_key = {
+    "taken": ["i.taken", "i.id"],
+    "lastupdate": ["i.lastupdate", "i.id"],
+    "id": ["i.id"],
+}
+
+def _write_lines(stream, lines):
+    s = ''.join(lines)
+    if isinstance(s, unicode):
+        s = s.encode(getattr(stream, "encoding", None) or "utf-8", "replace")
+    stream.write(s)
+
+# `WorkingCopy.find` field filters that match a `pics_search` column.
+_search_column_from_field = {
+    "title": "title",
+    "desc": "description",
+    "tag": "tags",
+    "comment": "comments",
+}
+
+# SQL conditions for the `WorkingCopy.find` "is:" filters.
+_search_condition_from_visibility = {
+    "public": "i.ispublic = 1",
+    "private": "i.ispublic = 0 AND i.isfriend = 0 AND i.isfamily = 0",
+    "friend": "i.isfriend = 1",
+    "family": "i.isfamily = 1",
+}
+
+def _search_sql_from_query(query, sort="taken", reverse=False,
+                           datedirs=None):
+    """Return (<sql>, <args>) for the given `WorkingCopy.find` query
+    terms. The `_photo_list_columns` are selected.
+
+    @param sort {str} A key of `_sort_columns_from_key`.
+    @param reverse {bool} Whether to reverse the sort order.
+    @param datedirs {list} Optional. Limit to photos in these date dirs.
+    """
+    # FTS phrases to match, keyed by column (or by the table name, to
+    # match any column).
+    matches = {}
+    conditions = []
+    args = []
+    for term in query:
+        if ':' in term:
+            field, value = term.split(':', 1)
+        else:
+            field, value = None, term
+        if not value:
+            raise PicsError("invalid search term: `%s'" % term)
+        if field is None or field in _search_column_from_field:
+            # A quoted FTS phrase, so query syntax in the term is literal
+            # (other than a trailing '*' for a prefix match).
+            phrase = '"%s"' % value.replace('"', ' ')
+            column = _search_column_from_field.get(field, "pics_search")
+            matches.setdefault(column, []).append(phrase)
+        elif field == "taken":
+            if ".." in value:
+                start, end = value.split("..", 1)
+            else:
+                start = end = value
+            if start:
+                conditions.append("i.taken >= ?")
+                args.append(start)
+            if end:
+                conditions.append("substr(i.taken, 1, ?) <= ?")
+                args += [len(end), end]
+        elif field == "media":
+            conditions.append("i.media = ?")
+            args.append(value)
+        elif field == "is":
+            if value not in _search_condition_from_visibility:
+                raise PicsError("invalid visibility in `%s': must be one "
+                    "of %s" % (term,
+                    ', '.join(sorted(_search_condition_from_visibility))))
+            conditions.append(_search_condition_from_visibility[value])
+        elif field == "id":
+            conditions.append("i.id = ?")
+            args.append(value)
+        else:
+            raise PicsError("unknown search field: `%s'" % field)
+    for column, phrases in sorted(matches.items(), reverse=True):
+        conditions.insert(0, "i.id IN (SELECT docid FROM pics_search "
+                             "WHERE %s MATCH ?)" % column)
+        args.insert(0, ' '.join(phrases))
+    if datedirs is not None:
+        datedirs = sorted(datedirs)
+        conditions.append("p.datedir IN (%s)" % ','.join(['?']*len(datedirs)))
+        args += datedirs
+    columns = [(c == "datedir" and "p." or "i.") + c
+               for c in _photo_list_columns]
+    sql = ("SELECT %s FROM pics_info i JOIN pics_photo p ON p.id = i.id"
+           % ', '.join(columns))
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ', '.join(
+        [c + (reverse and " DESC" or "") for c in _sort_columns_from_key[sort]])
+    return sql, args
+
+def _parallel_imap(func, items, chunksize=100):
+    """Generate `func(item)` for each of the given items, in order.
+
+    This is done in a pool of processes, if `multiprocessing` is
+    available and there are enough items to be worth it. `func` and the
+    items must be picklable.
+
+    @param items {list} The items.
+    """
+    if multiprocessing is None or len(items) <= chunksize:
+        for item in items:
+            yield func(item)
+        return
+    pool = multiprocessing.Pool()
+    try:
+        for result in pool.imap(func, items, chunksize=chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
 def _find_wc_base_dir(path):
     """Determine the working copy base dir from the given path.
 
@@ -899,9 +2449,30 @@ def _find_wc_base_dir(path):
         return normpath(join(dir, os.pardir))
     return None
 
+def _stat_key(st):
+    """The stat data of a file that `pics_stat` caches."""
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def _stat_key_and_md5_from_path(path):
+    """Return (<stat-key>, <md5-hexdigest>) for the given file, or None
+    if it doesn't exist. The file is stat'd *before* it is read, so a
+    change while hashing is caught next time.
+    """
+    try:
+        stat_key = _stat_key(os.stat(path))
+        return stat_key, _md5_path(path)
+    except (OSError, IOError):
+        return None
+
 def _md5_path(path):
+    hash = md5()
     f = open(path, 'rb')
     try:
-        return md5(f.read()).hexdigest()
+        while True:
+            chunk = f.read(64*1024)
+            if not chunk:
+                break
+            hash.update(chunk)
     finally:
         f.close()
+    return hash.hexdigest()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Tests of blob stores shared by working copies, against the fake Flickr
+server.
+
+Usage:
+    python test/test_blobstore.py
+"""
+
+from __future__ import with_statement
+
+import os
+from os.path import join, dirname, abspath, exists, getsize
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import simpleflickrapi
+from picslib.blobstore import BlobStore
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+from picslib.workingcopy import WorkingCopy
+
+
+
+class BlobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=10, video_ratio=0.0, seed=1,
+                                 photo_size=1000)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        self.old_environ = os.environ.copy()
+        os.environ.update(self.server.environ)
+        self.tmp_dir = tempfile.mkdtemp()
+        # Flickr's API rate limit doesn't apply to the fake server.
+        self.old_rate_limiter = simpleflickrapi.default_rate_limiter
+        simpleflickrapi.default_rate_limiter = simpleflickrapi.TokenBucket(
+            rate=1000, capacity=1000)
+        self.store_dir = join(self.tmp_dir, "blobs")
+        self.wcs = []
+
+    def tearDown(self):
+        for wc in self.wcs:
+            wc.db.close()
+        simpleflickrapi.default_rate_limiter = self.old_rate_limiter
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def _checkout(self, name, size):
+        wc = WorkingCopy.create(join(self.tmp_dir, name), "flickr",
+                                "fakeuser", size=size,
+                                blob_store=self.store_dir)
+        wc.update()
+        self.wcs.append(wc)
+        return wc
+
+    def _gc(self, dry_run=False):
+        store = BlobStore(self.store_dir)
+        try:
+            return store.gc(lambda wc_dir: WorkingCopy(wc_dir).blob_keys(),
+                            dry_run=dry_run)
+        finally:
+            store.close()
+
+    def _refs(self):
+        store = BlobStore(self.store_dir)
+        try:
+            return dict(store._execute("SELECT key, refs FROM blob"))
+        finally:
+            store.close()
+
+    def _downloaded_bytes(self, wc):
+        return sum(e.bytes for (kind, name), e
+                   in wc.stats.entries_by_key().items() if kind == "download")
+
+    def test_shared_downloads(self):
+        wc1 = self._checkout("wc1", "small")
+        self.assertTrue(self._downloaded_bytes(wc1) > 0)
+        wc2 = self._checkout("wc2", "small")
+        self.assertEqual(self._downloaded_bytes(wc2), 0)
+        self.assertEqual(sorted(wc1.blob_keys()), sorted(wc2.blob_keys()))
+        store = BlobStore(self.store_dir)
+        for key in wc1.blob_keys():
+            self.assertTrue(exists(store.path(key)))
+        store.close()
+
+    def test_gc_refcounts(self):
+        wc1 = self._checkout("wc1", "small")
+        wc2 = self._checkout("wc2", "small,medium")
+        small_keys = set(wc1.blob_keys())
+        medium_keys = set(wc2.blob_keys()) - small_keys
+        self.assertEqual(len(small_keys), len(self.flickr.photos))
+        self.assertEqual(len(medium_keys), len(self.flickr.photos))
+
+        self.assertEqual(self._gc(), (0, 0))
+        refs = self._refs()
+        for key in small_keys:
+            self.assertEqual(refs[key], 2)
+        for key in medium_keys:
+            self.assertEqual(refs[key], 1)
+
+        # Once a working copy is gone, the blobs only it used are removed.
+        store = BlobStore(self.store_dir)
+        medium_bytes = sum(getsize(store.path(key)) for key in medium_keys)
+        store.close()
+        wc2.db.close()
+        self.wcs.remove(wc2)
+        shutil.rmtree(wc2.base_dir)
+        self.assertEqual(self._gc(dry_run=True),
+                         (len(medium_keys), medium_bytes))
+        self.assertEqual(set(self._refs()), small_keys | medium_keys)
+        self.assertEqual(self._gc(), (len(medium_keys), medium_bytes))
+        refs = self._refs()
+        self.assertEqual(set(refs), small_keys)
+        for key in small_keys:
+            self.assertEqual(refs[key], 1)
+        store = BlobStore(self.store_dir)
+        self.assertEqual(store.wc_dirs(), [wc1.base_dir])
+        store.close()
+
+        # The remaining working copy's files are intact.
+        with wc1.db.connect() as cu:
+            cu.execute("SELECT p.datedir, f.filename, f.bytes "
+                       "FROM pics_file f JOIN pics_photo p ON p.id = f.id")
+            for datedir, filename, nbytes in cu.fetchall():
+                self.assertEqual(getsize(join(wc1.base_dir, datedir,
+                                              filename)), nbytes)
+
+    def test_gc_orphans(self):
+        self._checkout("wc1", "small")
+        store = BlobStore(self.store_dir)
+        old_path = join(self.store_dir, "42", "99942_abc_small.tmp")
+        new_path = join(self.store_dir, "42", "99942_def_small.tmp")
+        os.makedirs(dirname(old_path))
+        for path in (old_path, new_path):
+            open(path, 'wb').write('x' * 100)
+        then = time.time() - store.orphan_age - 60
+        os.utime(old_path, (then, then))
+        store.close()
+
+        self.assertEqual(self._gc(dry_run=True), (1, 100))
+        self.assertTrue(exists(old_path))
+        self.assertEqual(self._gc(), (1, 100))
+        self.assertFalse(exists(old_path))
+        self.assertTrue(exists(new_path))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
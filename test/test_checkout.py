@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""End-to-end tests of `pics checkout` against the fake Flickr server.
+
+Usage:
+    python test/test_checkout.py
+"""
+
+from __future__ import with_statement
+
+import os
+from os.path import join, dirname, abspath, getsize
+import sys
+import shutil
+import tempfile
+import unittest
+from hashlib import md5
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import simpleflickrapi
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+from picslib.workingcopy import WorkingCopy
+
+
+
+class CheckoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=20, video_ratio=0.3, seed=1,
+                                 photo_size=5000)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        self.old_environ = os.environ.copy()
+        os.environ.update(self.server.environ)
+        self.tmp_dir = tempfile.mkdtemp()
+        # Flickr's API rate limit doesn't apply to the fake server.
+        self.old_rate_limiter = simpleflickrapi.default_rate_limiter
+        simpleflickrapi.default_rate_limiter = simpleflickrapi.TokenBucket(
+            rate=1000, capacity=1000)
+
+    def tearDown(self):
+        simpleflickrapi.default_rate_limiter = self.old_rate_limiter
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_video_original(self):
+        # The "url_o" extra is requested for an "original" checkout, and
+        # Flickr gives it for videos too: the URL of a still.
+        wc = WorkingCopy.create(join(self.tmp_dir, "wc"), "flickr",
+                                "fakeuser", size="original")
+        wc.update()
+        videos = [p for p in self.flickr.photos if p.is_video]
+        self.assertTrue(videos)
+        with wc.db.connect() as cu:
+            for p in videos:
+                cu.execute("SELECT p.datedir, f.filename, f.bytes, f.md5 "
+                           "FROM pics_file f JOIN pics_photo p ON p.id = f.id "
+                           "WHERE f.id=?", (p.id,))
+                datedir, filename, nbytes, md5_hex = cu.fetchone()
+                path = join(wc.base_dir, datedir, filename)
+                expected = self.flickr.photo_size_bytes(p, "video-original",
+                                                        video=True)
+                self.assertEqual(getsize(path), expected)
+                self.assertEqual(nbytes, expected)
+                self.assertEqual(md5(open(path, 'rb').read()).hexdigest(),
+                                 md5_hex)
+        wc.db.close()
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Tests of photo downloading against the fake Flickr server.
+
+Usage:
+    python test/test_download.py
+"""
+
+import os
+from os.path import join, dirname, abspath, exists, getsize
+import sys
+import shutil
+import tempfile
+import time
+import threading
+import urlparse
+import unittest
+from hashlib import md5
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import download
+from picslib.download import Downloader, RateLimiter
+from picslib.errors import PicsError
+from picslib.simpleflickrapi import RequestStats
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+
+
+
+class ResumeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=2, video_ratio=0.0, seed=1,
+                                 photo_size=100000)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.photo = self.flickr.photos[0]
+        self.url = (self.server.photo_url_template % self.photo.__dict__
+                    + self.photo.secret + "_m.jpg")
+        self.size = self.flickr.photo_size_bytes(self.photo, "_m")
+        self.downloader = Downloader(stats=RequestStats())
+        self.downloader.retry_backoff = 0.001
+
+        # The whole file, and a partial download of it.
+        self.full_path = join(self.tmp_dir, "full.jpg")
+        self.full_md5 = self.downloader.download(self.url, self.full_path)[1]
+        self.path = join(self.tmp_dir, "photo.jpg")
+        self.part_path = self.path + ".part"
+        self.part_size = self.size // 3
+        fout = open(self.part_path, 'wb')
+        fout.write(open(self.full_path, 'rb').read(self.part_size))
+        fout.close()
+        self.downloader.stats.clear()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _etag(self):
+        rsp = self.downloader.http_pool.request("GET", self.url)
+        rsp.read()
+        rsp.close()
+        return rsp.getheader("ETag")
+
+    def _bytes_downloaded(self):
+        host = urlparse.urlparse(self.url)[1]
+        return self.downloader.stats.entries_by_key()[("download", host)].bytes
+
+    def _check_download(self):
+        self.assertEqual(self.downloader.download(self.url, self.path),
+                         (self.size, self.full_md5))
+        self.assertEqual(md5(open(self.path, 'rb').read()).hexdigest(),
+                         self.full_md5)
+        self.assertFalse(exists(self.part_path))
+        self.assertFalse(exists(self.part_path + ".src"))
+
+    def test_resume(self):
+        download._write_part_source(self.part_path, self.url, self._etag())
+        self.downloader.stats.clear()
+        self._check_download()
+        self.assertEqual(self._bytes_downloaded(),
+                         self.size - self.part_size)
+
+    def test_if_range_mismatch(self):
+        # The file has changed since the partial download: the server
+        # ignores the Range and sends the whole (new) file.
+        fout = open(self.part_path, 'wb')
+        fout.write('x' * self.part_size)
+        fout.close()
+        download._write_part_source(self.part_path, self.url, '"stale"')
+        self._check_download()
+        self.assertEqual(self._bytes_downloaded(), self.size)
+
+    def test_different_url(self):
+        # E.g. the photo was replaced on Flickr, so its secret changed.
+        other_url = self.url.replace(self.photo.secret, "0123456789")
+        download._write_part_source(self.part_path, other_url, self._etag())
+        self.downloader.stats.clear()
+        self._check_download()
+        self.assertEqual(self._bytes_downloaded(), self.size)
+
+    def test_complete_part(self):
+        # The download was interrupted after the last byte was written.
+        shutil.copy(self.full_path, self.part_path)
+        download._write_part_source(self.part_path, self.url, self._etag())
+        self.downloader.stats.clear()
+        self._check_download()
+        self.assertEqual(self._bytes_downloaded(), 0)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def _time_at(self, hhmm):
+        """The time today at the given (local) time of day."""
+        tm = list(time.localtime())
+        tm[3:6] = int(hhmm[:2]), int(hhmm[3:]), 0
+        return time.mktime(tuple(tm))
+
+    def test_from_spec(self):
+        limiter = RateLimiter.from_spec("500k")
+        self.assertEqual((limiter.rate, limiter.windows), (500*1024, []))
+        limiter = RateLimiter.from_spec(" 200KB@08:00-18:00 , 2m ")
+        self.assertEqual(limiter.rate, 2*1024*1024)
+        self.assertEqual(limiter.windows, [(8*60, 18*60, 200*1024)])
+        limiter = RateLimiter.from_spec("1.5M@22:00-6:30")
+        self.assertEqual(limiter.rate, None)
+        self.assertEqual(limiter.windows, [(22*60, 6*60+30, 1.5*1024*1024)])
+        self.assertEqual(RateLimiter.from_spec("100").rate, 100)
+
+    def test_invalid_spec(self):
+        for spec in ("0", "0k", "0.0M@08:00-18:00", "-5k", "500k,", ",2M",
+                     "500k,,2M", "fast", "5x", "500k@8-18",
+                     "500k@25:00-18:00", "500k@08:60-18:00"):
+            self.assertRaises(PicsError, RateLimiter.from_spec, spec)
+
+    def test_rate_at(self):
+        limiter = RateLimiter.from_spec("200k@08:00-18:00,1M@23:00-02:00,2M")
+        for hhmm, rate in (("07:59", 2*1024*1024), ("08:00", 200*1024),
+                           ("17:59", 200*1024), ("18:00", 2*1024*1024),
+                           ("23:30", 1024*1024), ("01:59", 1024*1024),
+                           ("02:00", 2*1024*1024)):
+            self.assertEqual(limiter.rate_at(self._time_at(hhmm)), rate,
+                             hhmm)
+
+    def test_priority(self):
+        # When the limit is reached, a waiting photo (priority 0) goes
+        # ahead of a video (priority 1) that was waiting first.
+        limiter = RateLimiter(rate=10000)
+        limiter.consume(2000)   # into debt: the next consumers must wait
+        order = []
+        def consume(priority):
+            limiter.consume(2000, priority)
+            order.append(priority)
+        video = threading.Thread(target=consume, args=(1,))
+        video.start()
+        time.sleep(0.05)
+        photo = threading.Thread(target=consume, args=(0,))
+        photo.start()
+        video.join()
+        photo.join()
+        self.assertEqual(order, [0, 1])
+
+    def test_rate(self):
+        limiter = RateLimiter(rate=100000)
+        start = time.time()
+        for i in range(10):
+            limiter.consume(10000)
+        # The first chunk goes at once, then each waits for its bytes.
+        self.assertTrue(0.8 < time.time() - start < 3.0)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Tests of `pics find` queries, against the fake Flickr server.
+
+Usage:
+    python test/test_find.py
+"""
+
+import os
+from os.path import join, dirname, abspath, basename
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import simpleflickrapi
+from picslib.errors import PicsError
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+from picslib.workingcopy import WorkingCopy, _search_sql_from_query
+
+
+
+class QueryParsingTestCase(unittest.TestCase):
+    def test_free_text(self):
+        sql, args = _search_sql_from_query(["sea", "sky*"])
+        self.assertTrue("pics_search MATCH ?" in sql)
+        self.assertEqual(args, ['"sea" "sky*"'])
+
+    def test_fields(self):
+        sql, args = _search_sql_from_query(["title:cat", "tag:dog",
+                                            "desc:a b", "comment:hi"])
+        for column in ("title", "tags", "description", "comments"):
+            self.assertTrue("WHERE %s MATCH ?" % column in sql, column)
+        self.assertEqual(sorted(args),
+                         ['"a b"', '"cat"', '"dog"', '"hi"'])
+
+    def test_fts_syntax_is_literal(self):
+        sql, args = _search_sql_from_query(['title:"OR x" NEAR'])
+        self.assertEqual(args, ['" OR x  NEAR"'])
+
+    def test_taken(self):
+        sql, args = _search_sql_from_query(["taken:2007-05"])
+        self.assertTrue("i.taken >= ?" in sql)
+        self.assertTrue("substr(i.taken, 1, ?) <= ?" in sql)
+        self.assertEqual(args, ["2007-05", 7, "2007-05"])
+        sql, args = _search_sql_from_query(["taken:2007..2008-02"])
+        self.assertEqual(args, ["2007", 7, "2008-02"])
+        sql, args = _search_sql_from_query(["taken:..2008"])
+        self.assertEqual(args, [4, "2008"])
+
+    def test_filters(self):
+        sql, args = _search_sql_from_query(["media:video", "is:family",
+                                            "id:123"])
+        self.assertTrue("i.media = ?" in sql)
+        self.assertTrue("i.isfamily = 1" in sql)
+        self.assertTrue("i.id = ?" in sql)
+        self.assertEqual(args, ["video", "123"])
+
+    def test_sort(self):
+        sql, args = _search_sql_from_query([], sort="lastupdate",
+                                           reverse=True)
+        self.assertTrue(sql.endswith(
+            " ORDER BY i.lastupdate DESC, i.id DESC"))
+        self.assertFalse(" WHERE " in sql)
+
+    def test_errors(self):
+        for query in (["title:"], ["is:secret"], ["bogus:1"], [""]):
+            self.assertRaises(PicsError, _search_sql_from_query, query)
+
+
+class FindTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=30, video_ratio=0.2, seed=1,
+                                 photo_size=500)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        self.old_environ = os.environ.copy()
+        os.environ.update(self.server.environ)
+        self.tmp_dir = tempfile.mkdtemp()
+        # Flickr's API rate limit doesn't apply to the fake server.
+        self.old_rate_limiter = simpleflickrapi.default_rate_limiter
+        simpleflickrapi.default_rate_limiter = simpleflickrapi.TokenBucket(
+            rate=1000, capacity=1000)
+        self.wc = WorkingCopy.create(join(self.tmp_dir, "wc"), "flickr",
+                                     "fakeuser", size="small")
+        self.wc.update()
+
+    def tearDown(self):
+        self.wc.db.close()
+        simpleflickrapi.default_rate_limiter = self.old_rate_limiter
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def _find_ids(self, *query):
+        return [basename(path).split('.', 1)[0]
+                for path, title in self.wc.find(list(query))]
+
+    def _ids_by_taken(self, photos):
+        return [p.id for p in sorted(photos, key=lambda p: (p.taken, p.id))]
+
+    def test_tag(self):
+        cats = [p for p in self.flickr.photos if "cat" in p.tags]
+        self.assertTrue(cats)
+        self.assertEqual(self._find_ids("tag:cat"), self._ids_by_taken(cats))
+
+    def test_media_and_visibility(self):
+        photos = [p for p in self.flickr.photos
+                  if p.is_video and p.ispublic]
+        self.assertEqual(self._find_ids("media:video", "is:public"),
+                         self._ids_by_taken(photos))
+
+    def test_taken_range(self):
+        photos = sorted(self.flickr.photos, key=lambda p: p.taken)
+        start, end = photos[5].taken[:10], photos[15].taken[:7]
+        expected = [p for p in photos
+                    if start <= p.taken[:10] and p.taken[:7] <= end]
+        self.assertEqual(self._find_ids("taken:%s..%s" % (start, end)),
+                         self._ids_by_taken(expected))
+
+    def test_title(self):
+        photo = self.flickr.photos[7]
+        self.assertEqual(self._find_ids("title:%s" % photo.title),
+                         [photo.id])
+        self.assertEqual(self._find_ids("title:description"), [])
+        self.assertEqual(len(self._find_ids("desc:description")),
+                         len(self.flickr.photos))
+        self.assertEqual(self._find_ids("id:%s" % photo.id, "photo"),
+                         [photo.id])
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Tests of `pics reconcile` against the fake Flickr server.
+
+Usage:
+    python test/test_reconcile.py
+"""
+
+from __future__ import with_statement
+
+import os
+from os.path import join, dirname, abspath, exists
+import sys
+import shutil
+import tempfile
+import logging
+import unittest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import simpleflickrapi
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+from picslib.workingcopy import WorkingCopy
+
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class ReconcileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=20, video_ratio=0.0, seed=1,
+                                 photo_size=500)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        self.old_environ = os.environ.copy()
+        os.environ.update(self.server.environ)
+        self.tmp_dir = tempfile.mkdtemp()
+        # Flickr's API rate limit doesn't apply to the fake server.
+        self.old_rate_limiter = simpleflickrapi.default_rate_limiter
+        simpleflickrapi.default_rate_limiter = simpleflickrapi.TokenBucket(
+            rate=1000, capacity=1000)
+        self.log = logging.getLogger("pics")
+        self.handler = _ListHandler()
+        self.old_level = self.log.level
+        self.log.addHandler(self.handler)
+        self.log.setLevel(logging.INFO)
+
+        self.wc = WorkingCopy.create(join(self.tmp_dir, "wc"), "flickr",
+                                     "fakeuser", size="small")
+        self.wc.update()
+        self.deleted = self.flickr.photos[5]
+        self.flickr.delete(self.deleted.id)
+        del self.handler.messages[:]
+
+    def tearDown(self):
+        self.wc.db.close()
+        self.log.removeHandler(self.handler)
+        self.log.setLevel(self.old_level)
+        simpleflickrapi.default_rate_limiter = self.old_rate_limiter
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def _rows(self, id):
+        rows = []
+        with self.wc.db.connect() as cu:
+            for table, column in (("pics_photo", "id"), ("pics_info", "id"),
+                                  ("pics_file", "id"),
+                                  ("pics_search", "docid")):
+                cu.execute("SELECT count(*) FROM %s WHERE %s=?"
+                           % (table, column), (id,))
+                rows.append(cu.fetchone()[0])
+        return rows
+
+    def _path(self, id):
+        with self.wc.db.connect() as cu:
+            cu.execute("SELECT p.datedir, f.filename FROM pics_file f "
+                       "JOIN pics_photo p ON p.id = f.id WHERE f.id=?", (id,))
+            datedir, filename = cu.fetchone()
+        return join(self.wc.base_dir, datedir, filename)
+
+    def test_report(self):
+        id = int(self.deleted.id)
+        path = self._path(id)
+        rows_before = self._rows(id)
+        self.assertEqual(rows_before, [1, 1, 1, 1])
+
+        self.assertEqual(self.wc.reconcile(), [id])
+        self.assertTrue(exists(path))
+        self.assertEqual(self._rows(id), rows_before)
+        self.assertTrue(any(m.startswith("gone: %s" % path)
+                            for m in self.handler.messages))
+        self.assertFalse(any(m.startswith("D ")
+                             for m in self.handler.messages))
+
+    def test_remove(self):
+        id = int(self.deleted.id)
+        path = self._path(id)
+
+        self.assertEqual(self.wc.reconcile(remove=True), [id])
+        self.assertFalse(exists(path))
+        self.assertEqual(self._rows(id), [0, 0, 0, 0])
+        self.assertTrue(any(m.startswith("D  %s" % path)
+                            for m in self.handler.messages))
+        self.assertFalse(any(m.startswith("gone: ")
+                             for m in self.handler.messages))
+        # The other photos are kept.
+        self.assertEqual(self.wc.reconcile(remove=True), [])
+        with self.wc.db.connect() as cu:
+            cu.execute("SELECT count(*) FROM pics_photo")
+            self.assertEqual(cu.fetchone()[0], len(self.flickr.photos))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
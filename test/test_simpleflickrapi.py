@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Tests of the Flickr API client against the fake Flickr server.
+
+Usage:
+    python test/test_simpleflickrapi.py
+"""
+
+import os
+from os.path import join, dirname, abspath
+import sys
+import shutil
+import tempfile
+import time
+import socket
+import httplib
+import unittest
+import xml.etree.ElementTree as ET
+from xml.parsers.expat import ExpatError
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import simpleflickrapi
+from picslib.simpleflickrapi import SimpleFlickrAPI, FlickrAPIError, \
+    FlickrHTTPError, RequestStats, ResponseCache, is_retryable_error
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+
+
+
+class _FakeServerTestCase(unittest.TestCase):
+    error_rate = 0.0
+
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=10, video_ratio=0.0, seed=1,
+                                 error_rate=self.error_rate)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        # Flickr's API rate limit doesn't apply to the fake server.
+        self.old_rate_limiter = simpleflickrapi.default_rate_limiter
+        simpleflickrapi.default_rate_limiter = simpleflickrapi.TokenBucket(
+            rate=1000, capacity=1000)
+
+    def tearDown(self):
+        simpleflickrapi.default_rate_limiter = self.old_rate_limiter
+        self.server.stop()
+
+    def api(self, **kwargs):
+        environ = self.server.environ
+        api = SimpleFlickrAPI(environ["PICS_FLICKR_API_KEY"],
+                              environ["PICS_FLICKR_SECRET"],
+                              stats=RequestStats(), **kwargs)
+        api.rest_url = environ["PICS_FLICKR_REST_URL"]
+        api.auth_token = environ["PICS_FLICKR_AUTH_TOKEN"]
+        api.retry_backoff = 0.001
+        return api
+
+class RetryTestCase(_FakeServerTestCase):
+    error_rate = 0.3
+
+    def test_is_retryable_error(self):
+        for ex in (FlickrHTTPError("url", 503, "Service Unavailable"),
+                   FlickrHTTPError("url", 429, "Too Many Requests"),
+                   FlickrAPIError("Service currently unavailable", 105),
+                   FlickrAPIError("Sorry, the Flickr API service is not "
+                                  "currently available", 0),
+                   socket.error(104, "Connection reset by peer"),
+                   socket.timeout("timed out"),
+                   httplib.IncompleteRead("partial"),
+                   ET.ParseError("no element found: line 1, column 0"),
+                   ExpatError("unclosed token")):
+            self.assertTrue(is_retryable_error(ex), repr(ex))
+        for ex in (FlickrHTTPError("url", 404, "Not Found"),
+                   FlickrHTTPError("url", 403, "Forbidden"),
+                   FlickrAPIError("Photo not found", 1),
+                   FlickrAPIError("Invalid auth token", 98),
+                   FlickrAPIError("unexpected <rsp> stat: 'foo'"),
+                   ValueError("bogus")):
+            self.assertFalse(is_retryable_error(ex), repr(ex))
+
+    def test_retries_transient_errors(self):
+        api = self.api()
+        api.max_retries = 20
+        for photo in self.flickr.photos:
+            rsp = api.call("flickr.photos.getInfo", photo_id=photo.id)
+            self.assertEqual(rsp[0].get("id"), photo.id)
+        ids = [elem.get("id") for elem in
+               api.paging_call("flickr.people.getPhotos", user_id="me",
+                               per_page=3)]
+        self.assertEqual(sorted(ids),
+                         sorted(p.id for p in self.flickr.photos))
+        retries = sum(e.retries for e in api.stats.entries_by_key().values())
+        self.assertTrue(retries > 0)
+
+    def test_gives_up(self):
+        api = self.api()
+        api.max_retries = 2
+        self.flickr.error_rate = 1.0
+        before = self.flickr.num_requests
+        self.assertRaises(FlickrAPIError, api.call,
+                          "flickr.photos.getInfo",
+                          photo_id=self.flickr.photos[0].id)
+        self.assertEqual(self.flickr.num_requests - before, 3)
+
+    def test_no_retry_for_permanent_error(self):
+        api = self.api()
+        self.flickr.error_rate = 0.0
+        before = self.flickr.num_requests
+        try:
+            api.call("flickr.photos.getInfo", photo_id="42")
+        except FlickrAPIError, ex:
+            self.assertEqual(ex.code, 1)
+        else:
+            self.fail("expected 'Photo not found' error")
+        self.assertEqual(self.flickr.num_requests - before, 1)
+
+
+class _FakeClock(object):
+    """Stands in for the `time` module in `simpleflickrapi`."""
+    def __init__(self):
+        self.now = time.time()
+    def time(self):
+        return self.now
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class ResponseCacheTestCase(_FakeServerTestCase):
+    def setUp(self):
+        _FakeServerTestCase.setUp(self)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clock = _FakeClock()
+        simpleflickrapi.time = self.clock
+
+    def tearDown(self):
+        simpleflickrapi.time = time
+        shutil.rmtree(self.tmp_dir)
+        _FakeServerTestCase.tearDown(self)
+
+    def cache(self, **kwargs):
+        return ResponseCache(join(self.tmp_dir, "cache.sqlite3"), **kwargs)
+
+    def test_ttl(self):
+        cache = self.cache(ttl_from_method={"flickr.photos.getInfo": 60})
+        self.assertTrue(cache.is_cacheable("flickr.photos.getInfo"))
+        self.assertFalse(cache.is_cacheable("flickr.people.getPhotos"))
+        key = cache.key("flickr.photos.getInfo", {"photo_id": "1"})
+        cache.put(key, "flickr.photos.getInfo", "<rsp/>")
+        self.clock.now += 59
+        self.assertEqual(cache.get(key), "<rsp/>")
+        self.clock.now += 2
+        self.assertEqual(cache.get(key), None)
+        cache.close()
+
+    def test_key(self):
+        cache = self.cache()
+        key = cache.key("flickr.photos.getInfo", {"photo_id": "1"}, "100")
+        self.assertEqual(key, cache.key("flickr.photos.getInfo",
+            {"photo_id": "1", "api_sig": "abc", "extras": None}, "100"))
+        self.assertNotEqual(key, cache.key("flickr.photos.getInfo",
+                                           {"photo_id": "1"}, "101"))
+        self.assertNotEqual(key, cache.key("flickr.photos.getSizes",
+                                           {"photo_id": "1"}, "100"))
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = self.cache(max_size=1000)
+        method = "flickr.photos.getInfo"
+        keys = [cache.key(method, {"photo_id": str(i)}) for i in range(4)]
+        for key in keys[:3]:
+            cache.put(key, method, 'x' * 300)
+            self.clock.now += 1
+        # Touch the oldest so that the second oldest is the LRU entry.
+        self.assertTrue(cache.get(keys[0]))
+        self.clock.now += 1
+        cache.put(keys[3], method, 'y' * 300)   # over 1000 bytes
+        self.assertEqual(cache.get(keys[1]), None)
+        for key in (keys[0], keys[2], keys[3]):
+            self.assertTrue(cache.get(key))
+        cache.close()
+
+    def test_api_uses_cache(self):
+        cache = self.cache()
+        api = self.api(response_cache=cache)
+        photo = self.flickr.photos[0]
+        before = self.flickr.num_requests
+        for i in range(3):
+            rsp = api.call("flickr.photos.getInfo", photo_id=photo.id,
+                           cache_version_=photo.lastupdate)
+            self.assertEqual(rsp[0].get("id"), photo.id)
+        self.assertEqual(self.flickr.num_requests - before, 1)
+        # A new version (e.g. the photo was updated) is a miss.
+        api.call("flickr.photos.getInfo", photo_id=photo.id,
+                 cache_version_=photo.lastupdate + 1)
+        self.assertEqual(self.flickr.num_requests - before, 2)
+        # Error responses aren't cached.
+        for i in range(2):
+            self.assertRaises(FlickrAPIError, api.call,
+                              "flickr.photos.getInfo", photo_id="42")
+        self.assertEqual(self.flickr.num_requests - before, 4)
+        cache.close()
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright (c) 2008 ActiveState Software Inc.
+
+"""Tests of upgrading old working copies, against the fake Flickr server.
+
+Usage:
+    python test/test_upgrade.py
+"""
+
+from __future__ import with_statement
+
+import os
+from os.path import join, dirname, abspath, exists
+import sys
+import shutil
+import tempfile
+import sqlite3
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "lib"))
+from picslib import simpleflickrapi
+from picslib.fakeflickr import FakeFlickr, FakeFlickrServer
+from picslib.workingcopy import WorkingCopy, Database
+
+
+
+# The database schema of a v1.0.0 working copy. Photo metadata was kept
+# in ".pics/<id>-info.xml" and ".pics/<id>-comments.xml" files.
+schema_1_0_0 = """
+    CREATE TABLE pics_meta (
+        key TEXT UNIQUE ON CONFLICT REPLACE,
+        value TEXT
+    );
+    CREATE TABLE pics_photo (
+        id INTEGER UNIQUE,
+        datedir TEXT
+    );
+    CREATE TABLE pics_update (
+        id INTEGER UNIQUE
+    );
+"""
+
+class UpgradeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flickr = FakeFlickr(num_photos=20, video_ratio=0.2, seed=1,
+                                 photo_size=500)
+        self.server = FakeFlickrServer(self.flickr)
+        self.server.start()
+        self.old_environ = os.environ.copy()
+        os.environ.update(self.server.environ)
+        self.tmp_dir = tempfile.mkdtemp()
+        # Flickr's API rate limit doesn't apply to the fake server.
+        self.old_rate_limiter = simpleflickrapi.default_rate_limiter
+        simpleflickrapi.default_rate_limiter = simpleflickrapi.TokenBucket(
+            rate=1000, capacity=1000)
+
+    def tearDown(self):
+        simpleflickrapi.default_rate_limiter = self.old_rate_limiter
+        self.server.stop()
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_1_0_0_wc(self):
+        """Check out a working copy and rewrite its metadata as a v1.0.0
+        working copy had it.
+
+        @returns {tuple} (<base-dir>, <photos>) where <photos> is a list
+            of (<id>, <datedir>, <filename>, <title>).
+        """
+        base_dir = join(self.tmp_dir, "wc")
+        wc = WorkingCopy.create(base_dir, "flickr", "fakeuser", size="small")
+        wc.update()
+        photos = []
+        meta = {"version": "1.0.0"}
+        with wc.db.connect() as cu:
+            for key in ("ilk", "user", "size", "permission", "last-update"):
+                meta[key] = wc.db.get_meta(key, cu=cu)
+            cu.execute("SELECT p.id, p.datedir, f.filename FROM pics_photo p "
+                       "JOIN pics_file f ON f.id = p.id")
+            for id, datedir, filename in cu.fetchall():
+                for type in ("info", "comments"):
+                    data = wc._get_photo_data(id, type, cu=cu)
+                    if data is None:
+                        continue
+                    f = open(join(base_dir, datedir, ".pics",
+                                  "%s-%s.xml" % (id, type)), 'wb')
+                    f.write(ET.tostring(data))
+                    f.close()
+                title = wc._get_photo_data(id, "info", cu=cu).findtext("title")
+                photos.append((id, datedir, filename, title))
+        wc.db.close()
+
+        db_path = join(base_dir, ".pics", "photos.sqlite3")
+        for suffix in ("", "-wal", "-shm"):
+            if exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        cx = sqlite3.connect(db_path)
+        cx.executescript(schema_1_0_0)
+        cx.executemany("INSERT INTO pics_meta VALUES (?, ?)", meta.items())
+        cx.executemany("INSERT INTO pics_photo VALUES (?, ?)",
+                       [(id, datedir) for id, datedir, f, t in photos])
+        cx.commit()
+        cx.close()
+        return base_dir, photos
+
+    def test_upgrade_from_1_0_0(self):
+        base_dir, photos = self._make_1_0_0_wc()
+        self.assertEqual(len(photos), len(self.flickr.photos))
+
+        wc = WorkingCopy(base_dir)
+        self.assertEqual(wc.db.version, Database.VERSION)
+        for id, datedir, filename, title in photos:
+            # The metadata files are moved into the catalog ...
+            for type in ("info", "comments"):
+                self.assertFalse(exists(join(base_dir, datedir, ".pics",
+                                             "%s-%s.xml" % (id, type))))
+            self.assertEqual(
+                wc._get_photo_data(id, "info").findtext("title"), title)
+            # ... which is indexed for search ...
+            self.assertEqual(list(wc.find(["id:%s" % id, "title:%s" % title])),
+                             [(join(base_dir, datedir, filename), title)])
+            # ... and the photo's file is recorded.
+            self.assertEqual(wc._local_filenames(id, None), [filename])
+            self.assertTrue(exists(join(base_dir, datedir, filename)))
+
+        # The upgraded working copy can be updated.
+        photo = self.flickr.photos[3]
+        self.flickr.touch(photo.id)
+        self.assertEqual(wc.update(), 1)
+        wc.db.close()
+
+
+
+if __name__ == "__main__":
+    unittest.main()